@@ -1,24 +1,113 @@
+import logging
 import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, Response, request, abort, jsonify
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-
-
-from models import setup_db, Movie, Actor, db
-from auth.auth import AuthError, requires_auth
-
-migrate = Migrate()
-
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+
+from models import setup_db, Movie, Actor, db, error_status, movie_actors, related_rows
+from auth.auth import AuthError, jwks_cache, requires_auth, token_cache
+from pagination import page_args, keyset_page
+from filters import MOVIE_LIST, ACTOR_LIST
+from export import ndjson_export
+from bulk import validate_batch, validate_ids, MOVIE_FIELDS, ACTOR_FIELDS
+from serializers import Serializer
+from conditional import collection_validators, is_not_modified, set_validators
+from cache import LRUBackend, response_cache_from_config
+from search import SEARCH_TARGETS, Searcher, search_args
+from pool import pool_stats
+from metrics import init_metrics, prometheus_text
+from log import init_logging, log
+from ratelimit import init_rate_limits
+from idempotency import idempotency_from_config
+from writebehind import init_write_behind
+from replicas import init_replicas
+
+
+def create_asgi_app(flask_app):
+    # imported on use: starlette, httpx and the async drivers are optional
+    # and only slow down the start of WSGI workers
+    from asgi import create_asgi_app
+    return create_asgi_app(flask_app)
 
 
 def create_app(test_config=None):
     # create and configure the app
   app = Flask(__name__)
+  # set PAGINATE_LISTS=false to get the unpaginated full list responses
+  app.config['PAGINATE_LISTS'] = os.environ.get('PAGINATE_LISTS', 'true').lower() != 'false'
+  # 'lru' (per worker), 'off', or a cache.SharedBackend set through test_config
+  app.config['RESPONSE_CACHE'] = os.environ.get('RESPONSE_CACHE', 'lru')
+  app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 5))
+  # comma separated read replicas for GET requests, see replicas.py
+  app.config['DATABASE_REPLICA_URLS'] = [
+    url.strip().replace('postgres://', 'postgresql://')
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+  # seconds a client keeps reading from the primary after a write
+  app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+  # 'wsgi' returns the flask app, 'asgi' an ASGI app serving the read
+  # endpoints async and the rest through flask (see asgi.py)
+  app.config['SERVING_MODE'] = os.environ.get('SERVING_MODE', 'wsgi')
+  # latency budget of a whole /search request, in milliseconds
+  app.config['SEARCH_BUDGET_MS'] = int(os.environ.get('SEARCH_BUDGET_MS', 250))
+  # per request phase timings and SQL counts, exported on /metrics and
+  # returned in a Server-Timing header (see metrics.py)
+  app.config['REQUEST_METRICS'] = os.environ.get('REQUEST_METRICS', 'true').lower() != 'false'
+  app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', 'true').lower() != 'false'
+  # structured logs through a background thread, see log.py. repeated
+  # records past LOG_SAMPLE_BURST per LOG_SAMPLE_WINDOW seconds are dropped
+  app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+  app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'json')
+  app.config['LOG_QUEUE_SIZE'] = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+  app.config['LOG_SAMPLE_WINDOW'] = int(os.environ.get('LOG_SAMPLE_WINDOW', 60))
+  app.config['LOG_SAMPLE_BURST'] = int(os.environ.get('LOG_SAMPLE_BURST', 10))
+  # token buckets per token sub and endpoint permission, '<n>/<s|m|h>' or
+  # 'off', RATE_LIMITS overrides the default per permission (see ratelimit.py).
+  # off unless the operator sets a limit, a shared service token or a bulk
+  # client would otherwise start getting 429s
+  app.config['RATE_LIMIT_DEFAULT'] = os.environ.get('RATE_LIMIT_DEFAULT', 'off')
+  app.config['RATE_LIMITS'] = os.environ.get('RATE_LIMITS', '')
+  # requests one worker serves at once before shedding with 503, 0 for no limit
+  app.config['MAX_IN_FLIGHT'] = int(os.environ.get('MAX_IN_FLIGHT', 0))
+  # responses of POSTs sent with an Idempotency-Key, replayed on retries:
+  # 'lru' (per worker), 'off', or a cache.SharedBackend (see idempotency.py)
+  app.config['IDEMPOTENCY_STORE'] = os.environ.get('IDEMPOTENCY_STORE', 'lru')
+  app.config['IDEMPOTENCY_TTL'] = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+  app.config['IDEMPOTENCY_WAIT_SECONDS'] = int(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 10))
+  # seconds a claimed key stays pending, so it must outlast the slowest
+  # create: by default gunicorn's worker timeout, past which the worker
+  # running the request is killed (gunicorn.conf.py)
+  app.config['IDEMPOTENCY_PENDING_SECONDS'] = int(os.environ.get(
+    'IDEMPOTENCY_PENDING_SECONDS', os.environ.get('WORKER_TIMEOUT', 30)))
+  # set WRITE_BEHIND=true to answer POST /movies and /actors with 202 and
+  # insert the rows in batches from a background writer (see writebehind.py)
+  app.config['WRITE_BEHIND'] = os.environ.get('WRITE_BEHIND', 'false').lower() == 'true'
+  app.config['WRITE_BEHIND_SPOOL_DIR'] = os.environ.get('WRITE_BEHIND_SPOOL_DIR', 'spool')
+  app.config['WRITE_BEHIND_BATCH_SIZE'] = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500))
+  app.config['WRITE_BEHIND_MAX_LATENCY_MS'] = int(os.environ.get('WRITE_BEHIND_MAX_LATENCY_MS', 50))
+  app.config['WRITE_BEHIND_MAX_QUEUE'] = int(os.environ.get('WRITE_BEHIND_MAX_QUEUE', 10000))
+  app.config['WRITE_BEHIND_ID_BLOCK'] = int(os.environ.get('WRITE_BEHIND_ID_BLOCK', 100))
   setup_db(app)
-  migrate.init_app(app, db)
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+  init_replicas(db, app, app.config.get('REPLICA_STICKY_BACKEND') or LRUBackend(4096))
+  serializer = Serializer.from_config(app.config)
+  response_cache = app.extensions['response_cache'] = response_cache_from_config(app.config)
+  searcher = Searcher(app.config['SEARCH_BUDGET_MS'])
+  log_pipeline = init_logging(app)
+  request_metrics = init_metrics(app)
+  rate_limiter, load_shedder = init_rate_limits(app)
+  idempotency = app.extensions['idempotency'] = idempotency_from_config(app.config)
+  write_behind = init_write_behind(app)
   CORS(app)
+
+  def queued(table, key):
+    # with WRITE_BEHIND off the view inserts the row itself
+    if write_behind is None:
+      return lambda view: view
+    return write_behind.queued(table, key)
+
   @app.after_request
   def after_request(response):
       response.headers.add(
@@ -29,25 +118,86 @@ def create_app(test_config=None):
       )
       return response
 
+  def embed_arg(allowed):
+    embed = request.args.get('embed')
+    if embed is not None and embed != allowed:
+      abort(400)
+    return embed is not None
+
+  def embed_related(items, name, owner_column, table):
+    related = related_rows(owner_column, table, [item['id'] for item in items])
+    for item in items:
+      item[name] = serializer.rows(table, related[item['id']])
+    return items
+
+  def batch_error(errors):
+    return jsonify({
+      'success': False,
+      'error': 422,
+      'message': 'Unprocessable',
+      'errors': errors
+    }), 422
+
+  def batch_results(ids, found, status):
+    return [
+      {'id': item_id, 'status': status if item_id in found else 'not_found'}
+      for item_id in ids
+    ]
+
+  def movies_items(rows, embed):
+    items = serializer.rows(Movie.__table__, rows)
+    if embed:
+      embed_related(items, 'actors', movie_actors.c.movie_id, Actor.__table__)
+    return items
+
   @app.route('/movies', methods=['GET'])
   @requires_auth(permission='get:movies')
+  @response_cache.cached('movies', embed='actors')
   def get_movies(payload):
-    try:
-      movies = Movie.query.all()
+    cursor, limit = page_args(request.args) if app.config['PAGINATE_LISTS'] else (None, None)
+    predicates, order = MOVIE_LIST.parse(request.args, cursor)
+    embed = embed_arg('actors')
+
+    # read before the rows, so a concurrent write can only leave the
+    # validators behind the body, never ahead of it
+    etag, last_modified = collection_validators('movies', *(['actors'] if embed else []))
+    if is_not_modified(request, etag, last_modified):
+      return set_validators(Response(status=304), etag, last_modified)
+
+    statement = select(Movie.__table__).where(*predicates)
+
+    if not app.config['PAGINATE_LISTS']:
+      movies = db.session.execute(statement.order_by(*MOVIE_LIST.order_by(order))).all()
 
       if len(movies) == 0:
         abort(404)
 
-      return jsonify({'success': True, 'movies': [movie.format() for movie in movies]})
-    
-    except Exception as e:
-      print(e)
-      abort(422)
+      return set_validators(
+        serializer.response({'success': True, 'movies': movies_items(movies, embed)}),
+        etag, last_modified)
+
+    movies, next_cursor = keyset_page(db.session, statement, Movie.id, cursor, limit, order)
+
+    if len(movies) == 0 and cursor is None:
+      abort(404)
+
+    return set_validators(serializer.response({
+      'success': True,
+      'movies': movies_items(movies, embed),
+      'next_cursor': next_cursor
+    }), etag, last_modified)
     
 
 
+  @app.route('/movies/export', methods=['GET'])
+  @requires_auth(permission='get:movies')
+  def export_movies(payload):
+    return Response(ndjson_export(db.engine, Movie.__table__), mimetype='application/x-ndjson')
+
   @app.route('/movies', methods=['POST'])
   @requires_auth(permission='post:movies')
+  @idempotency.idempotent
+  @queued('movies', 'movie')
   def create_movie(payload):
     body = request.get_json()
 
@@ -57,31 +207,54 @@ def create_app(test_config=None):
     if (new_title is None) or (new_release_date is None):
       abort(422)
 
-    try:
-      movie = Movie(title=new_title, release_date=new_release_date)
-      movie.insert()
+    movie = Movie(title=new_title, release_date=new_release_date)
+    movie.insert()
 
-      return jsonify({'success': True, 'movie': movie.format()})
-    
-    except Exception as e:
-      print(e)
-      abort(422)
+    return jsonify({'success': True, 'movie': movie.format()})
+
+  @app.route('/movies/bulk', methods=['POST'])
+  @requires_auth(permission='post:movies')
+  def bulk_create_movies(payload):
+    rows, errors = validate_batch(request.get_json(), MOVIE_FIELDS)
+    if errors:
+      return batch_error(errors)
+
+    ids = Movie.bulk_insert(rows)
+    return jsonify({
+      'success': True,
+      'results': [{'id': movie_id, 'status': 'created'} for movie_id in ids]
+    })
+
+  @app.route('/movies/bulk', methods=['PATCH'])
+  @requires_auth(permission='patch:movies')
+  def bulk_update_movies(payload):
+    rows, errors = validate_batch(request.get_json(), MOVIE_FIELDS, partial=True)
+    if errors:
+      return batch_error(errors)
+
+    found = Movie.bulk_update(rows)
+    ids = [row['id'] for row in rows]
+    return jsonify({'success': True, 'results': batch_results(ids, found, 'updated')})
+
+  @app.route('/movies/bulk', methods=['DELETE'])
+  @requires_auth(permission='delete:movies')
+  def bulk_delete_movies(payload):
+    ids, errors = validate_ids(request.get_json())
+    if errors:
+      return batch_error(errors)
+
+    found = Movie.bulk_delete(ids)
+    return jsonify({'success': True, 'results': batch_results(ids, found, 'deleted')})
 
   @app.route('/movies/<int:movie_id>', methods=['DELETE'])
   @requires_auth(permission='delete:movies')
   def delete_movie(payload, movie_id):
-    try:
-      movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-      
-      if movie is None:
-        abort(404)
-      
-      movie.delete()
-      return jsonify({'success': True, 'deleted': movie.id})
+    deleted = Movie.delete_returning(movie_id)
 
-    except Exception as e:
-      print(e)
-      abort(422)
+    if deleted is None:
+      abort(404)
+
+    return jsonify({'success': True, 'deleted': deleted})
 
   @app.route('/movies/<int:movie_id>', methods=['PATCH'])
   @requires_auth(permission='patch:movies')
@@ -91,47 +264,106 @@ def create_app(test_config=None):
     new_title = body.get('title', None)
     new_release_date = body.get('release_date', None)
 
-    try:
-      if (new_title is None) and (new_release_date is None):
-        abort(422)
+    if (new_title is None) and (new_release_date is None):
+      abort(422)
 
-      movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+    values = {}
+    if new_title is not None:
+      values['title'] = new_title
+    if new_release_date is not None:
+      values['release_date'] = new_release_date
 
-      if not movie:
-        abort(404)
-    
-      if new_title is not None:
-        movie.title = new_title
-      if new_release_date is not None:
-        movie.release_date = new_release_date
+    movie = Movie.update_returning(movie_id, values)
 
-      movie.update()
+    if not movie:
+      abort(404)
 
-      return jsonify({'success': True, 'movie': movie.format()})
+    return jsonify({'success': True, 'movie': movie})
 
-    except Exception as e:
-      print(e)
-      abort(422)
+
+  @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+  @requires_auth(permission='get:actors')
+  def get_movie_actors(payload, movie_id):
+    if not Movie.existing_ids([movie_id]):
+      abort(404)
+
+    actors = related_rows(movie_actors.c.movie_id, Actor.__table__, [movie_id])[movie_id]
+    return serializer.response({'success': True, 'actors': serializer.rows(Actor.__table__, actors)})
+
+  @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+  @requires_auth(permission='patch:movies')
+  def add_movie_actors(payload, movie_id):
+    body = request.get_json()
+
+    actor_ids, errors = validate_ids(body.get('actor_ids', None))
+    if errors:
+      return batch_error(errors)
+
+    if not Movie.add_cast(movie_id, actor_ids):
+      abort(404)
+
+    actors = related_rows(movie_actors.c.movie_id, Actor.__table__, [movie_id])[movie_id]
+    return serializer.response({'success': True, 'actors': serializer.rows(Actor.__table__, actors)})
+
+  @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+  @requires_auth(permission='patch:movies')
+  def remove_movie_actor(payload, movie_id, actor_id):
+    if not Movie.remove_cast(movie_id, actor_id):
+      abort(404)
+
+    return jsonify({'success': True, 'deleted': actor_id})
 
 
+  def actors_items(rows, embed):
+    items = serializer.rows(Actor.__table__, rows)
+    if embed:
+      embed_related(items, 'movies', movie_actors.c.actor_id, Movie.__table__)
+    return items
+
   @app.route('/actors', methods=['GET'])
   @requires_auth(permission='get:actors')
+  @response_cache.cached('actors', embed='movies')
   def get_actors(payload):
-    try:
-      actors = Actor.query.all()
-      
+    cursor, limit = page_args(request.args) if app.config['PAGINATE_LISTS'] else (None, None)
+    predicates, order = ACTOR_LIST.parse(request.args, cursor)
+    embed = embed_arg('movies')
+
+    etag, last_modified = collection_validators('actors', *(['movies'] if embed else []))
+    if is_not_modified(request, etag, last_modified):
+      return set_validators(Response(status=304), etag, last_modified)
+
+    statement = select(Actor.__table__).where(*predicates)
+
+    if not app.config['PAGINATE_LISTS']:
+      actors = db.session.execute(statement.order_by(*ACTOR_LIST.order_by(order))).all()
+
       if not actors:
-        print(f'actors: {actors}')
         abort(404)
 
-      return jsonify({'success': True, 'actors': [actor.format() for actor in actors]})
+      return set_validators(
+        serializer.response({'success': True, 'actors': actors_items(actors, embed)}),
+        etag, last_modified)
+
+    actors, next_cursor = keyset_page(db.session, statement, Actor.id, cursor, limit, order)
 
-    except Exception as e:
-      print(e)
+    if not actors and cursor is None:
       abort(404)
 
+    return set_validators(serializer.response({
+      'success': True,
+      'actors': actors_items(actors, embed),
+      'next_cursor': next_cursor
+    }), etag, last_modified)
+
+  @app.route('/actors/export', methods=['GET'])
+  @requires_auth(permission='get:actors')
+  def export_actors(payload):
+    return Response(ndjson_export(db.engine, Actor.__table__), mimetype='application/x-ndjson')
+
   @app.route('/actors', methods=['POST'])
   @requires_auth(permission='post:actors')
+  @idempotency.idempotent
+  @queued('actors', 'actor')
   def create_actor(payload):
     body = request.get_json()
 
@@ -142,33 +374,56 @@ def create_app(test_config=None):
     if (new_name is None) or (new_age is None) or (new_gender is None):
       abort(422)
 
-    try:
-      actor = Actor(name=new_name, age=new_age, gender=new_gender)
-      actor.insert()
+    actor = Actor(name=new_name, age=new_age, gender=new_gender)
+    actor.insert()
+
+    return jsonify({'success': True, 'actor': actor.format()})
 
-      return jsonify({'success': True, 'actor': actor.format()})
-    
-    except Exception as e:
-      print(e)
-      abort(422)
 
 
+  @app.route('/actors/bulk', methods=['POST'])
+  @requires_auth(permission='post:actors')
+  def bulk_create_actors(payload):
+    rows, errors = validate_batch(request.get_json(), ACTOR_FIELDS)
+    if errors:
+      return batch_error(errors)
+
+    ids = Actor.bulk_insert(rows)
+    return jsonify({
+      'success': True,
+      'results': [{'id': actor_id, 'status': 'created'} for actor_id in ids]
+    })
+
+  @app.route('/actors/bulk', methods=['PATCH'])
+  @requires_auth(permission='patch:actors')
+  def bulk_update_actors(payload):
+    rows, errors = validate_batch(request.get_json(), ACTOR_FIELDS, partial=True)
+    if errors:
+      return batch_error(errors)
+
+    found = Actor.bulk_update(rows)
+    ids = [row['id'] for row in rows]
+    return jsonify({'success': True, 'results': batch_results(ids, found, 'updated')})
+
+  @app.route('/actors/bulk', methods=['DELETE'])
+  @requires_auth(permission='delete:actors')
+  def bulk_delete_actors(payload):
+    ids, errors = validate_ids(request.get_json())
+    if errors:
+      return batch_error(errors)
+
+    found = Actor.bulk_delete(ids)
+    return jsonify({'success': True, 'results': batch_results(ids, found, 'deleted')})
 
   @app.route('/actors/<int:actor_id>', methods=['DELETE'])
   @requires_auth(permission='delete:actors')
   def delete_actor(payload, actor_id):
-    try:
-      actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-      
-      if actor is None:
-        abort(404)
-      
-      actor.delete()
-      return jsonify({'success': True, 'deleted': actor.id})
+    deleted = Actor.delete_returning(actor_id)
 
-    except Exception as e:
-      print(e)
-      abort(422)
+    if deleted is None:
+      abort(404)
+
+    return jsonify({'success': True, 'deleted': deleted})
 
   @app.route('/actors/<int:actor_id>', methods=['PATCH'])
   @requires_auth(permission='patch:actors')
@@ -181,29 +436,92 @@ def create_app(test_config=None):
 
     
 
-    try:
-      if (new_name is None) or (new_age is None) or (new_gender is None):
-        abort(422)
+    if (new_name is None) or (new_age is None) or (new_gender is None):
+      abort(422)
 
-      actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+    values = {}
+    if new_name is not None:
+      values['name'] = new_name
+    if new_age is not None:
+      values['age'] = new_age
+    if new_gender is not None:
+      values['gender'] = new_gender
 
-      if not actor:
-        abort(404)
-    
-      if new_name is not None:
-        actor.name = new_name
-      if new_age is not None:
-        actor.age = new_age
-      if new_gender is not None:
-        actor.gender = new_gender
+    actor = Actor.update_returning(actor_id, values)
 
-      actor.update()
+    if not actor:
+      abort(404)
 
-      return jsonify({'success': True, 'actor': actor.format()})
+    return jsonify({'success': True, 'actor': actor})
 
-    except Exception as e:
-      print(e)
-      abort(422)
+
+  @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+  @requires_auth(permission='get:movies')
+  def get_actor_movies(payload, actor_id):
+    if not Actor.existing_ids([actor_id]):
+      abort(404)
+
+    movies = related_rows(movie_actors.c.actor_id, Movie.__table__, [actor_id])[actor_id]
+    return serializer.response({'success': True, 'movies': serializer.rows(Movie.__table__, movies)})
+
+
+  # typeahead search over movie titles and actor names, each collection is
+  # only searched when the token may read it
+  @app.route('/search', methods=['GET'])
+  @requires_auth(any_of=['get:movies', 'get:actors'])
+  def search(payload):
+    q, limit = search_args(request.args)
+    granted = payload.get('permissions', ())
+    targets = [target for target in SEARCH_TARGETS if target.permission in granted]
+
+    results, timed_out = searcher.search(db.session, targets, q, limit)
+    body = {'success': True, 'query': q, 'timed_out': timed_out}
+    for target in targets:
+      rows = results[target.name]
+      items = serializer.rows(target.table, rows)
+      for item, row in zip(items, rows):
+        item['score'] = round(row[-1], 3)
+      body[target.name] = items
+    return serializer.response(body)
+
+
+  # operational metrics of this worker: request latency per route and
+  # phase, database pool (checkout time and saturation, to size
+  # DB_POOL_SIZE against the request concurrency) and the caches. in the
+  # prometheus text format, ?format=json for a summary. requires the
+  # read:metrics permission, give it to the scraper's token only
+  @app.route('/metrics', methods=['GET'])
+  @requires_auth(permission='read:metrics')
+  def metrics(payload):
+    sections = {
+      'pool': pool_stats(db.engine),
+      'response_cache': response_cache.stats(),
+      'jwks': jwks_cache.stats(),
+      'tokens': token_cache.stats(),
+      'logs': log_pipeline.stats(),
+    }
+    if rate_limiter is not None:
+      sections['rate_limits'] = rate_limiter.stats()
+    if load_shedder is not None:
+      sections['load_shedder'] = load_shedder.stats()
+    if idempotency.enabled:
+      sections['idempotency'] = idempotency.stats()
+    if write_behind is not None:
+      sections['write_behind'] = write_behind.stats()
+    if request.args.get('format') == 'json':
+      if request_metrics is not None:
+        sections['requests'] = request_metrics.stats()
+      return serializer.response(sections)
+    return Response(prometheus_text(sections, request_metrics),
+                    mimetype='text/plain; version=0.0.4')
+
+  # queue depth and flush latency of the write-behind queue
+  @app.route('/writes/status', methods=['GET'])
+  @requires_auth(permission='read:metrics')
+  def write_status(payload):
+    if write_behind is None:
+      return serializer.response({'success': True, 'enabled': False})
+    return serializer.response({'success': True, 'enabled': True, **write_behind.stats()})
 
 
   # Error Handling
@@ -220,13 +538,31 @@ def create_app(test_config=None):
 
   @app.errorhandler(401)
   def unauthorized(error):
-      print(error)
+      log.info('unauthorized: missing or malformed Authorization header')
       return jsonify({"success": False, "error": 401, "message": "Unathorized"}), 401
 
 
+  @app.errorhandler(429)
+  def too_many_requests(error):
+      return (
+          jsonify({"success": False, "error": 429, "message": "Too Many Requests"}),
+          429,
+          {"Retry-After": str(error.retry_after)},
+      )
+
+
+  @app.errorhandler(409)
+  def conflict(error):
+      return (
+          jsonify({"success": False, "error": 409, "message": "Conflict"}),
+          409,
+          {"Retry-After": "1"},
+      )
+
+
   @app.errorhandler(405)
   def method_not_allowed(error):
-      print(error)
+      log.info('method not allowed: %s %s', request.method, request.path)
       return (
           jsonify({"success": False, "error": 405, "message": "Method Not Allowed"}),
           405,
@@ -235,13 +571,24 @@ def create_app(test_config=None):
 
   @app.errorhandler(500)
   def internal_server_error(error):
-      print(error)
+      # unhandled exceptions are already logged by flask, with traceback
+      if getattr(error, 'original_exception', None) is None:
+          log.error('internal server error: %s', error.description)
       return (
           jsonify({"success": False, "error": 500, "message": "Internal Server Error"}),
           500,
       )
 
 
+  @app.errorhandler(503)
+  def service_unavailable(error):
+      return (
+          jsonify({"success": False, "error": 503, "message": "Service Unavailable"}),
+          503,
+          {"Retry-After": "1"},
+      )
+
+
   @app.errorhandler(404)
   def not_found(error):
       return (
@@ -250,9 +597,27 @@ def create_app(test_config=None):
       )
 
 
+  @app.errorhandler(SQLAlchemyError)
+  def database_error(error):
+      # the session cannot be used again before a rollback
+      db.session.rollback()
+      status = error_status(error)
+      log.log(logging.WARNING if status == 422 else logging.ERROR,
+              'database error: %s', type(error).__name__, exc_info=error,
+              extra={'status': status})
+      if status == 422:
+          return unprocessable(error)
+      if status == 503:
+          return service_unavailable(error)
+      return (
+          jsonify({"success": False, "error": 500, "message": "Internal Server Error"}),
+          500,
+      )
+
+
   @app.errorhandler(AuthError)
   def auth_error(error):
-      print(error)
+      log.info('auth error: %s', error.error['code'], extra={'status': error.status_code})
       return (
           jsonify(
               {
@@ -265,6 +630,12 @@ def create_app(test_config=None):
       )
 
 
+  if app.config['SERVING_MODE'] == 'asgi':
+    try:
+      return create_asgi_app(app)
+    except ImportError as error:
+      raise RuntimeError('SERVING_MODE=asgi needs starlette, httpx and an async '
+                         'database driver (asyncpg or aiosqlite) installed') from error
   return app
 
 
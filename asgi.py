@@ -0,0 +1,387 @@
+'''
+ASGI serving mode (SERVING_MODE=asgi, see create_app)
+
+the read endpoints, which take most of the traffic, are served natively
+async: GET /movies, GET /actors, GET /movies/<id>/actors and
+GET /actors/<id>/movies. their queries run on an asyncio engine (asyncpg on
+postgres, aiosqlite on sqlite) and signing keys are fetched with httpx,
+so a worker keeps serving other requests while it waits on the database
+or on Auth0. the query building, validators and serialization are the
+same functions the flask handlers use, run through AsyncSession.run_sync.
+
+the native endpoints go through the same hooks as flask views: the load
+shedder's in-flight count, request ids in X-Request-ID and the logs,
+request metrics and Server-Timing, and the response cache for the lists.
+tokens missing from the token cache are verified in the thread pool, so
+RS256 signature checks never block the event loop.
+
+every other route (writes, bulk, export, search, metrics, CORS preflight)
+is forwarded to the flask app, which runs in a thread pool.
+
+    SERVING_MODE=asgi gunicorn app:app -k uvicorn.workers.UvicornWorker
+'''
+import asyncio
+import logging
+import time
+
+import httpx
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import http_date, parse_date, parse_etags, unquote_etag
+
+from auth.auth import (AuthError, JWKS_FETCH_TIMEOUT, PermissionRule, check_permissions,
+                       jwks_cache, token_cache, token_from_header, unverified_kid, verify_token)
+from conditional import collection_validators, not_modified
+from filters import ACTOR_LIST, MOVIE_LIST
+from log import asgi_request, log, request_id_from
+from metrics import RequestTimer, asgi_timer, phase
+from models import Actor, Movie, error_status, movie_actors, related_rows
+from pagination import keyset_page, page_args
+from ratelimit import LoadShedder
+from serializers import Serializer
+
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+# same bodies as the flask error handlers
+ERROR_MESSAGES = {
+    400: 'Bad Request',
+    401: 'Unathorized',
+    404: 'Resource Not Found',
+    405: 'Method Not Allowed',
+    422: 'Unprocessable',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+# what flask-cors and the after_request hook add to flask responses
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type,Authorization,true',
+    'Access-Control-Allow-Methods': 'GET,PUT,POST,DELETE,OPTIONS',
+}
+
+
+def async_engine_from_config(config):
+    '''asyncio engine for SQLALCHEMY_DATABASE_URI with the DB_* pool settings'''
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    if backend != 'sqlite':
+        options.update(pool_size=config['DB_POOL_SIZE'],
+                       max_overflow=config['DB_MAX_OVERFLOW'],
+                       pool_timeout=config['DB_POOL_TIMEOUT'],
+                       pool_recycle=config['DB_POOL_RECYCLE'])
+        if config['DB_STATEMENT_TIMEOUT_MS']:
+            options['connect_args'] = {'server_settings': {
+                'statement_timeout': str(config['DB_STATEMENT_TIMEOUT_MS'])}}
+    return create_async_engine(url, **options)
+
+
+'''
+AsyncJWKSRefresher(cache, client)
+    fetches the JWKS of `cache` with an httpx.AsyncClient before a token is
+    verified, so the synchronous verification never has to fetch. refreshes
+    are single-flight per event loop and follow the cache's rate limiting
+    (JWKSCache.needs_refresh). providers without a url (local keys, see
+    auth.key_provider) do not block and are refreshed in place
+'''
+
+
+class AsyncJWKSRefresher:
+    def __init__(self, cache, client):
+        self.cache = cache
+        self.client = client
+        self._lock = asyncio.Lock()
+
+    async def ensure(self, kid):
+        if not self.cache.needs_refresh(kid):
+            return
+        async with self._lock:
+            if not self.cache.needs_refresh(kid):
+                return
+            if self.cache.url is None:
+                self.cache.refresh(kid)
+                return
+            try:
+                response = await self.client.get(self.cache.url, timeout=JWKS_FETCH_TIMEOUT)
+                response.raise_for_status()
+                jwks = response.json()
+            except Exception:
+                jwks = None
+            self.cache.load(jwks)
+
+
+def json_response(serializer, body, status=200, headers=None):
+    return Response(serializer.dumps(body), status_code=status,
+                    headers={**CORS_HEADERS, **(headers or {})},
+                    media_type='application/json')
+
+
+def validator_headers(etag, last_modified):
+    '''the headers conditional.set_validators sets on flask responses'''
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+def not_modified_response(request, headers):
+    '''304 when the request's If-None-Match / If-Modified-Since match the
+    ETag and Last-Modified in `headers`, else None'''
+    etag, _ = unquote_etag(headers.get('ETag'))
+    if not_modified(parse_etags(request.headers.get('If-None-Match')),
+                    parse_date(request.headers.get('If-Modified-Since')),
+                    etag, parse_date(headers.get('Last-Modified'))):
+        return Response(status_code=304, headers={**CORS_HEADERS, **headers})
+    return None
+
+
+def cached_response(request, entry):
+    '''a ResponseCache entry as a response, conditional like flask's'''
+    body, mimetype, headers = entry
+    headers = dict(headers)
+    return (not_modified_response(request, headers)
+            or Response(body, headers={**CORS_HEADERS, **headers}, media_type=mimetype))
+
+
+def create_asgi_app(flask_app):
+    config = flask_app.config
+    serializer = Serializer.from_config(config)
+    response_cache = flask_app.extensions['response_cache']
+    request_metrics = flask_app.extensions.get('request_metrics')
+    load_shedder = flask_app.extensions.get('load_shedder')
+    server_timing = config['SERVER_TIMING']
+    state = {}
+
+    async def startup():
+        state['engine'] = async_engine_from_config(config)
+        state['sessions'] = sessionmaker(state['engine'], class_=AsyncSession,
+                                         expire_on_commit=False)
+        state['jwks'] = AsyncJWKSRefresher(jwks_cache, httpx.AsyncClient())
+
+    async def shutdown():
+        await state['jwks'].client.aclose()
+        await state['engine'].dispose()
+
+    async def authenticate(request, rule):
+        '''requires_auth for async endpoints'''
+        with phase('auth'):
+            token = token_from_header(request.headers.get('Authorization'))
+            entry = token_cache.get(token)
+            if entry is None:
+                kid = unverified_kid(token)
+                await state['jwks'].ensure(kid)
+                # the key is cached now. the RS256 check is CPU bound and
+                # would stall every request on this worker's event loop
+                entry = await run_in_threadpool(verify_token, token, kid)
+            payload, permissions = entry
+            check_permissions(rule, payload, permissions)
+        limiter = flask_app.extensions.get('rate_limiter')
+        if limiter is not None:
+            limiter.check(payload.get('sub', 'anonymous'), rule)
+        return payload
+
+    def query_args(request):
+        return MultiDict(request.query_params.multi_items())
+
+    def embed_arg(args, allowed):
+        embed = args.get('embed')
+        if embed is not None and embed != allowed:
+            abort(400)
+        return embed is not None
+
+    def list_endpoint(name, table, spec, permission, embed_name, owner_column, embed_table):
+        rule = PermissionRule.compile(permission)
+
+        def read_page(session, predicates, order, cursor, limit, embed):
+            statement = select(table).where(*predicates)
+            if not config['PAGINATE_LISTS']:
+                rows = session.execute(statement.order_by(*spec.order_by(order))).all()
+                next_cursor = None
+            else:
+                rows, next_cursor = keyset_page(session, statement, spec.id_column,
+                                                cursor, limit, order)
+            if len(rows) == 0 and cursor is None:
+                abort(404)
+
+            items = serializer.rows(table, rows)
+            if embed:
+                related = related_rows(owner_column, embed_table,
+                                       [item['id'] for item in items], session)
+                for item in items:
+                    item[embed_name] = serializer.rows(embed_table, related[item['id']])
+            return items, next_cursor
+
+        async def endpoint(request):
+            payload = await authenticate(request, rule)
+            args = query_args(request)
+
+            # ResponseCache.cached of the flask view
+            key = None
+            if response_cache.enabled:
+                collections = [name] + ([embed_name] if args.get('embed') == embed_name else [])
+                key = response_cache.key(collections, request.url.path, args,
+                                         payload.get('permissions', ()))
+                entry = response_cache.get(key)
+                if entry is not None:
+                    return cached_response(request, entry)
+
+            cursor, limit = page_args(args) if config['PAGINATE_LISTS'] else (None, None)
+            predicates, order = spec.parse(args, cursor)
+            embed = embed_arg(args, embed_name)
+            names = [name] + ([embed_name] if embed else [])
+
+            async with state['sessions']() as session:
+                etag, last_modified = await session.run_sync(
+                    lambda sync_session: collection_validators(*names, session=sync_session))
+                headers = validator_headers(etag, last_modified)
+                response = not_modified_response(request, headers)
+                if response is not None:
+                    return response
+
+                items, next_cursor = await session.run_sync(
+                    read_page, predicates, order, cursor, limit, embed)
+
+            body = {'success': True, name: items}
+            if config['PAGINATE_LISTS']:
+                body['next_cursor'] = next_cursor
+            response = json_response(serializer, body, headers=headers)
+            if key is not None:
+                response_cache.store(key, response.body, 'application/json', response.headers)
+            return response
+
+        return endpoint
+
+    def related_endpoint(owner, owner_column, table, name, permission):
+        rule = PermissionRule.compile(permission)
+
+        def read_related(session, owner_id):
+            if not owner.existing_ids([owner_id], session):
+                abort(404)
+            rows = related_rows(owner_column, table, [owner_id], session)[owner_id]
+            return serializer.rows(table, rows)
+
+        async def endpoint(request):
+            await authenticate(request, rule)
+            owner_id = request.path_params['owner_id']
+            async with state['sessions']() as session:
+                items = await session.run_sync(read_related, owner_id)
+            return json_response(serializer, {'success': True, name: items})
+
+        return endpoint
+
+    def http_error(request, error):
+        status = error.code or 500
+        headers = {}
+        if getattr(error, 'retry_after', None):
+            headers['Retry-After'] = str(error.retry_after)
+        return json_response(serializer, {
+            'success': False,
+            'error': status,
+            'message': ERROR_MESSAGES.get(status, error.name),
+        }, status=status, headers=headers)
+
+    def database_error(request, error):
+        status = error_status(error)
+        log.log(logging.WARNING if status == 422 else logging.ERROR,
+                'database error: %s', type(error).__name__, exc_info=error,
+                extra={'status': status})
+        return json_response(serializer, {
+            'success': False, 'error': status, 'message': ERROR_MESSAGES[status]}, status=status)
+
+    def server_error(request, error):
+        log.error('unhandled exception', exc_info=error)
+        return json_response(serializer, {
+            'success': False, 'error': 500, 'message': ERROR_MESSAGES[500]}, status=500)
+
+    def auth_error(request, error):
+        return json_response(serializer, {
+            'success': False,
+            'error': error.status_code,
+            'message': error.error['description'],
+        }, status=error.status_code)
+
+    def error_response(request, error):
+        '''the flask error handlers'''
+        if isinstance(error, HTTPException):
+            return http_error(request, error)
+        if isinstance(error, AuthError):
+            return auth_error(request, error)
+        if isinstance(error, SQLAlchemyError):
+            return database_error(request, error)
+        return server_error(request, error)
+
+    def served(route, endpoint):
+        '''`endpoint` with what flask does around a view: the load shedder,
+        the request id, the error handlers, request metrics and Server-Timing.
+        `route` is the flask url rule, so both modes report the same series'''
+        shed_headers = {'Access-Control-Allow-Origin': '*'}
+        if load_shedder is not None:
+            shed_headers['Retry-After'] = str(load_shedder.retry_after)
+
+        async def wrapper(request):
+            if load_shedder is not None and not load_shedder.admit():
+                return Response(LoadShedder.body, status_code=503, headers=shed_headers,
+                                media_type='application/json')
+            request_id = request_id_from(request.headers.get('X-Request-ID'))
+            timer = RequestTimer() if request_metrics is not None else None
+            request_token = asgi_request.set((request_id, request.method, request.url.path))
+            timer_token = asgi_timer.set(timer)
+            try:
+                try:
+                    response = await endpoint(request)
+                except Exception as error:
+                    response = error_response(request, error)
+                if timer is not None:
+                    total = time.perf_counter() - timer.start
+                    request_metrics.observe(route, request.method, response.status_code,
+                                            timer, total)
+                    if server_timing:
+                        response.headers['Server-Timing'] = timer.server_timing(total)
+                response.headers['X-Request-ID'] = request_id
+                return response
+            finally:
+                asgi_timer.reset(timer_token)
+                asgi_request.reset(request_token)
+                if load_shedder is not None:
+                    load_shedder.release()
+
+        return wrapper
+
+    routes = [
+        Route('/movies', served('/movies', list_endpoint(
+            'movies', Movie.__table__, MOVIE_LIST, 'get:movies',
+            'actors', movie_actors.c.movie_id, Actor.__table__)), methods=['GET']),
+        Route('/actors', served('/actors', list_endpoint(
+            'actors', Actor.__table__, ACTOR_LIST, 'get:actors',
+            'movies', movie_actors.c.actor_id, Movie.__table__)), methods=['GET']),
+        Route('/movies/{owner_id:int}/actors', served(
+            '/movies/<int:movie_id>/actors', related_endpoint(
+                Movie, movie_actors.c.movie_id, Actor.__table__, 'actors', 'get:actors')),
+            methods=['GET']),
+        Route('/actors/{owner_id:int}/movies', served(
+            '/actors/<int:actor_id>/movies', related_endpoint(
+                Actor, movie_actors.c.actor_id, Movie.__table__, 'movies', 'get:movies')),
+            methods=['GET']),
+        # everything else, including other methods on the paths above
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ]
+    asgi_app = Starlette(
+        routes=routes,
+        on_startup=[startup],
+        on_shutdown=[shutdown])
+    asgi_app.state.flask_app = flask_app
+    return asgi_app
@@ -1,15 +1,35 @@
+import base64
+import hashlib
 import json
-from flask import request, _request_ctx_stack, abort
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 import os
+import rsa
+
+from metrics import phase
 
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
 
+# where the signing keys come from: unset for the Auth0 jwks url of
+# AUTH0_DOMAIN, else another jwks url or the path of a local JWKS file
+JWKS_SOURCE = os.environ.get('JWKS_SOURCE')
+# seconds a fetched JWKS is trusted before it is refetched
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+# minimum seconds between two refetches triggered by unknown kids or failures
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+# number of verified tokens kept, 0 disables the verified token cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -23,6 +43,344 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# Key Providers
+
+'''
+key providers
+    where JWKSCache gets the signing keys from. a provider has a fetch()
+    method returning a JWKS dict, and a `url` attribute that is set when
+    fetching goes over the network (the async server fetches those itself,
+    see asgi.py) and None otherwise
+
+    RemoteJWKS(url)
+        the keys published at a jwks url, Auth0 by default
+    LocalJWKS(jwks=None, path=None)
+        a JWKS dict, or a JWKS json file that is re-read on every refresh
+        so keys can be rotated by replacing the file
+    TestIssuer(kid='test', private_pem=None)
+        an in-process RS256 key pair that mints tokens with any
+        permissions, for tests and benchmarks that run without Auth0
+'''
+
+
+class RemoteJWKS:
+    def __init__(self, url):
+        self.url = url
+
+    def fetch(self):
+        jsonurl = urlopen(self.url, timeout=JWKS_FETCH_TIMEOUT)
+        return json.loads(jsonurl.read())
+
+    def __repr__(self):
+        return f'RemoteJWKS({self.url!r})'
+
+
+class LocalJWKS:
+    url = None
+
+    def __init__(self, jwks=None, path=None):
+        if (jwks is None) == (path is None):
+            raise ValueError('LocalJWKS needs exactly one of jwks or path')
+        self.jwks = jwks
+        self.path = path
+
+    def fetch(self):
+        if self.path is None:
+            return self.jwks
+        with open(self.path) as jwks_file:
+            return json.load(jwks_file)
+
+    def __repr__(self):
+        return f'LocalJWKS(path={self.path!r})' if self.path else 'LocalJWKS(jwks=...)'
+
+
+def _b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+class TestIssuer:
+    url = None
+    # not a test case, despite the name
+    __test__ = False
+
+    def __init__(self, kid='test', private_pem=None, key_size=2048):
+        if private_pem is None:
+            public_key, private_key = rsa.newkeys(key_size)
+        else:
+            private_key = rsa.PrivateKey.load_pkcs1(private_pem.encode())
+            public_key = rsa.PublicKey(private_key.n, private_key.e)
+        self.kid = kid
+        self.private_pem = private_key.save_pkcs1().decode()
+        self.jwk = {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+                    'n': _b64_uint(public_key.n), 'e': _b64_uint(public_key.e)}
+
+    def fetch(self):
+        return {'keys': [self.jwk]}
+
+    def mint(self, *permissions, sub='auth0|test', ttl=3600, **claims):
+        '''a signed token granting permissions, with the issuer and
+        audience verify_decode_jwt expects. claims override the defaults'''
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'sub': sub,
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': list(permissions),
+        }
+        if API_AUDIENCE:
+            payload['aud'] = API_AUDIENCE
+        payload.update(claims)
+        return jwt.encode(payload, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def auth_header(self, *permissions, **kwargs):
+        return {'Authorization': f'Bearer {self.mint(*permissions, **kwargs)}'}
+
+    def __repr__(self):
+        return f'TestIssuer(kid={self.kid!r})'
+
+
+def key_provider(source):
+    '''the provider for JWKS_SOURCE: a provider is returned as is, http(s)
+    urls are fetched remotely and anything else is a local JWKS file'''
+    if hasattr(source, 'fetch'):
+        return source
+    if source.startswith(('https://', 'http://')):
+        return RemoteJWKS(source)
+    return LocalJWKS(path=source)
+
+
+# JWKS Cache
+
+'''
+JWKSCache
+    process wide cache of the signing keys of a key provider, by default
+    the ones published at the Auth0 jwks url
+
+    keys are kept for `ttl` seconds. a lookup for an unknown kid triggers a
+    refetch, but refetches are single-flight (one thread fetches, the others
+    wait for its result) and at most one every `min_refresh_interval` seconds,
+    so a burst of unknown kids costs a single round trip to Auth0.
+    if a refetch fails the last known good keys keep being served.
+'''
+
+
+class JWKSCache:
+    def __init__(self, source, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 fetch=None):
+        self.provider = key_provider(source)
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._fetch = fetch or self.provider.fetch
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0,
+                       'refresh_failures': 0}
+        self._removed_listeners = []
+
+    def on_keys_removed(self, listener):
+        '''registers listener(kids), called with the kids dropped by a refresh'''
+        self._removed_listeners.append(listener)
+
+    @property
+    def url(self):
+        '''the jwks url, None when the provider is not remote'''
+        return self.provider.url
+
+    def use_provider(self, source):
+        '''switches to another key provider (see key_provider). the keys of
+        the previous one are dropped, and so are tokens they verified'''
+        provider = key_provider(source)
+        with self._refresh_lock:
+            removed = set(self._keys)
+            self.provider = provider
+            self._fetch = provider.fetch
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+        self._notify_removed(removed)
+        return provider
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _is_fresh(self, now):
+        return (self._fetched_at is not None
+                and now - self._fetched_at < self.ttl)
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+        if key is not None and self._is_fresh(time.monotonic()):
+            self._count('hits')
+            return key
+
+        self._count('misses')
+        self.refresh(kid)
+        return self._keys.get(kid)
+
+    def needs_refresh(self, kid=None):
+        '''True when looking up kid would refetch the keys: kid is unknown
+        or the keys are stale (without a kid: the keys are stale), and no
+        refetch was attempted in the last min_refresh_interval seconds
+        (unless no keys are held at all)'''
+        now = time.monotonic()
+        if (kid is None or kid in self._keys) and self._is_fresh(now):
+            return False
+        return not (self._last_attempt is not None
+                    and now - self._last_attempt < self.min_refresh_interval
+                    and self._keys)
+
+    def refresh(self, kid=None):
+        with self._refresh_lock:
+            # another thread may have fetched while we waited for the lock
+            if not self.needs_refresh(kid):
+                return
+            self._last_attempt = time.monotonic()
+            try:
+                jwks = self._fetch()
+            except Exception:
+                jwks = None
+            removed = self._install(jwks)
+        self._notify_removed(removed)
+
+    def load(self, jwks):
+        '''installs a JWKS fetched by the caller, None for a failed fetch.
+        for callers that cannot block on the fetch (see asgi.py), they
+        check needs_refresh first'''
+        with self._refresh_lock:
+            self._last_attempt = time.monotonic()
+            removed = self._install(jwks)
+        self._notify_removed(removed)
+
+    def _install(self, jwks):
+        # called with _refresh_lock held, returns the kids that went away
+        try:
+            keys = {key['kid']: key for key in jwks['keys']}
+        except Exception:
+            self._count('refresh_failures')
+            if self._keys:
+                return set()
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch signing keys.'
+            }, 503)
+
+        removed = set(self._keys) - set(keys)
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        self._count('refreshes')
+        return removed
+
+    def _notify_removed(self, removed):
+        if removed:
+            for listener in self._removed_listeners:
+                listener(removed)
+
+    def clear(self):
+        with self._refresh_lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['keys'] = len(self._keys)
+        return stats
+
+
+jwks_cache = JWKSCache(JWKS_SOURCE or f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+
+# Verified Token Cache
+
+'''
+TokenCache
+    bounded LRU of already verified token payloads, stored together with
+    the payload permissions compiled to a frozenset
+
+    entries are keyed by the sha256 digest of the raw token, never by the
+    token itself, and expire at the token's `exp` claim. tokens without an
+    `exp` are not cached. entries signed with a kid that disappears from the
+    JWKS on rotation are evicted.
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.enabled = maxsize > 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        if not self.enabled:
+            return None
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            expires_at, kid, payload, permissions = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(digest)
+            self._stats['hits'] += 1
+            return payload, permissions
+
+    def put(self, token, kid, payload, permissions=None):
+        if not self.enabled or 'exp' not in payload:
+            return
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (payload['exp'], kid, payload, permissions)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def evict_kids(self, kids):
+        with self._lock:
+            stale = [digest for digest, entry in self._entries.items()
+                     if entry[1] in kids]
+            for digest in stale:
+                del self._entries[digest]
+            self._stats['evictions'] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+token_cache = TokenCache()
+jwks_cache.on_keys_removed(token_cache.evict_kids)
+
+
 # Auth Header
 
 '''implement get_token_auth_header() method
@@ -35,10 +393,14 @@ class AuthError(Exception):
 
 
 def get_token_auth_header():
-    if 'Authorization' not in request.headers:
+    return token_from_header(request.headers.get('Authorization'))
+
+
+def token_from_header(auth_header):
+    '''the token of an Authorization header value, shared with asgi.py'''
+    if auth_header is None:
         abort(401)
 
-    auth_header = request.headers['Authorization']
     header_parts = auth_header.split(' ')
 
     if len(header_parts) != 2:
@@ -49,10 +411,50 @@ def get_token_auth_header():
     return header_parts[1]
 
 
+'''
+PermissionRule
+    a permission requirement compiled once, when an endpoint is decorated
+
+    a payload satisfies the rule if it grants every permission in all_of
+    and, when any_of is not empty, at least one permission in any_of.
+    both are frozensets so checking a rule is a few O(1) set lookups.
+'''
+
+
+class PermissionRule:
+    __slots__ = ('all_of', 'any_of')
+
+    def __init__(self, all_of=(), any_of=()):
+        self.all_of = frozenset(all_of)
+        self.any_of = frozenset(any_of)
+
+    @classmethod
+    def compile(cls, permission='', any_of=None, all_of=None):
+        if isinstance(permission, PermissionRule):
+            return permission
+        required = set(all_of or ())
+        # a bare requires_auth() keeps the original check that the token
+        # grants the permission '', which denies every real token
+        if permission or not (any_of or all_of):
+            required.add(permission)
+        return cls(required, any_of or ())
+
+    def allows(self, granted):
+        if not self.all_of <= granted:
+            return False
+        return not self.any_of or not self.any_of.isdisjoint(granted)
+
+    def __repr__(self):
+        return (f'PermissionRule(all_of={sorted(self.all_of)}, '
+                f'any_of={sorted(self.any_of)})')
+
+
 '''implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink') or a PermissionRule
         payload: decoded jwt payload
+        granted: optional frozenset of the payload permissions, when the
+            caller already has it (see get_verified_token)
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
@@ -61,14 +463,18 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, granted=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    rule = PermissionRule.compile(permission)
+    if granted is None:
+        granted = frozenset(payload['permissions'])
+
+    if not rule.allows(granted):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -76,12 +482,27 @@ def check_permissions(permission, payload):
     return True
 
 
+def unverified_kid(token):
+    '''the key id in the header of token, parsed without verifying it'''
+    unverified_header = jwt.get_unverified_header(token)
+    if 'kid' not in unverified_header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
+    return unverified_header['kid']
+
+
 '''implement verify_decode_jwt(token) method
     @INPUTS
         token: a json web token (string)
+        kid: optional key id of the token header, when the caller already
+            parsed it (see get_verified_token)
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        (served from jwks_cache, not fetched per request, and from another
+        key provider when JWKS_SOURCE is set)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -90,31 +511,24 @@ def check_permissions(permission, payload):
 '''
 
 
-def verify_decode_jwt(token):
-    # Get the public key from Auth0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
-    # Get the data in the header
-    unverified_header = jwt.get_unverified_header(token)
+def verify_decode_jwt(token, kid=None):
+    # the kid of the header, unless the caller already parsed it
+    if kid is None:
+        kid = unverified_kid(token)
 
     # Choose our key
     rsa_key = {}
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # Get the public key from Auth0 (cached)
+    key = jwks_cache.get_key(kid)
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
 
     # Finally Verify
     if rsa_key:
@@ -151,13 +565,59 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-def requires_auth(permission=''):
+'''
+get_verified_token(token, kid=None) / verify_token(token, kid=None)
+    returns (payload, permissions) of a previously verified token from
+    token_cache, or verifies it with verify_token: verify_decode_jwt, then
+    the result is cached. on a miss the header is parsed once, for the key
+    lookup and the cache entry, or not at all when the caller passes its kid.
+    permissions is the payload permissions as a frozenset, None if the
+    claim is missing
+'''
+
+
+def get_verified_token(token, kid=None):
+    entry = token_cache.get(token)
+    if entry is None:
+        entry = verify_token(token, kid)
+    return entry
+
+
+def verify_token(token, kid=None):
+    if kid is None:
+        kid = unverified_kid(token)
+    payload = verify_decode_jwt(token, kid)
+    permissions = None
+    if 'permissions' in payload:
+        permissions = frozenset(payload['permissions'])
+    token_cache.put(token, kid, payload, permissions)
+    return payload, permissions
+
+
+'''
+requires_auth(permission='', any_of=None, all_of=None)
+    the requirement is compiled to a PermissionRule at decoration time:
+    `permission` and every entry of `all_of` are required, and at least one
+    entry of `any_of` when it is given. once the token is accepted the
+    app's rate limiter, if any, is charged for its sub and the rule
+'''
+
+
+def requires_auth(permission='', any_of=None, all_of=None):
+    rule = PermissionRule.compile(permission, any_of=any_of, all_of=all_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with phase('auth'):
+                token = get_token_auth_header()
+                payload, permissions = get_verified_token(token)
+                check_permissions(rule, payload, permissions)
+            # per subject rate limits, see ratelimit.py
+            limiter = current_app.extensions.get('rate_limiter')
+            if limiter is not None:
+                limiter.check(payload.get('sub', 'anonymous'), rule)
+            _request_ctx_stack.top.current_user = payload
             return f(payload, *args, **kwargs)
 
         return wrapper
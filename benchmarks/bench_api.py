@@ -0,0 +1,288 @@
+'''
+Latency, throughput and query count of every route of create_app, in
+process through the flask test client. auth is real but offline (tokens
+signed with a throwaway key, see common.py). the database is a scratch
+sqlite file or BENCH_DATABASE_URL, seeded with --rows movies and actors
+and three actors cast per movie.
+
+    python benchmarks/bench_api.py --rows 10000 --requests 200 --output run.json
+    python benchmarks/bench_api.py --baseline run.json --threshold 0.2
+
+every scenario reports p50/p95/p99 latency, requests per second (one
+client, so it is the inverse of the mean latency), the SQL statements per
+request and the status codes. --output writes the results as JSON; with
+--baseline the run is compared against an earlier one and the script
+exits with status 1 when a scenario's p95 got slower by more than
+--threshold or it runs more queries per request.
+
+routes of the app no scenario covers are listed, so new routes get a
+scenario. the response cache is off unless --cache is given, so GETs
+measure the database path; --verify-every-request also turns the
+verified token cache off to include the full cost of auth. POST /movies
+stores the release date as sent, which only postgres accepts: on sqlite
+it answers 422.
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+
+from common import auth, auth_header, create_bench_app
+
+from sqlalchemy import event, insert, select
+
+from models import Actor, Movie, db, movie_actors
+
+
+'''
+Scenario
+    one route under test. request(i) returns (path, json body or None) of
+    the i-th request and may write setup rows first, outside the timing
+'''
+
+Scenario = namedtuple('Scenario', 'name method rule permissions status request')
+
+
+def seed(rows):
+    start = datetime(1950, 1, 1)
+    db.session.bulk_insert_mappings(Movie, [
+        {'title': f'Movie {i:07d}', 'release_date': start + timedelta(days=i % 25000)}
+        for i in range(rows)])
+    db.session.bulk_insert_mappings(Actor, [
+        {'name': f'Actor {i:07d}', 'age': 18 + i % 70, 'gender': 'MF'[i % 2]}
+        for i in range(rows)])
+    db.session.commit()
+    movie_ids = list(db.session.execute(select(Movie.id).order_by(Movie.id)).scalars())
+    actor_ids = list(db.session.execute(select(Actor.id).order_by(Actor.id)).scalars())
+    db.session.execute(insert(movie_actors), [
+        {'movie_id': movie_id, 'actor_id': actor_ids[(i + k) % len(actor_ids)]}
+        for i, movie_id in enumerate(movie_ids) for k in range(3)])
+    db.session.commit()
+    return movie_ids, actor_ids
+
+
+def new_movie():
+    return Movie.bulk_insert([{'title': 'Scratch', 'release_date': datetime(2000, 1, 1)}])[0]
+
+
+def new_actor():
+    return Actor.bulk_insert([{'name': 'Scratch', 'age': 30, 'gender': 'F'}])[0]
+
+
+def scenarios(movie_ids, actor_ids):
+    def movie(i):
+        return movie_ids[i % len(movie_ids)]
+
+    def actor(i):
+        return actor_ids[i % len(actor_ids)]
+
+    def cast(i):
+        # a pair that is not cast yet: actors 3.. after the movie's position
+        return movie(i), actor_ids[(i % len(movie_ids) + 3 + i // len(movie_ids)) % len(actor_ids)]
+
+    def uncast(i):
+        movie_id, actor_id = new_movie(), actor(i)
+        Movie.add_cast(movie_id, [actor_id])
+        return movie_id, actor_id
+
+    return [
+        Scenario('list movies', 'GET', '/movies', ('get:movies',), 200,
+                 lambda i: ('/movies?limit=50', None)),
+        Scenario('list movies, embed actors', 'GET', '/movies', ('get:movies',), 200,
+                 lambda i: ('/movies?limit=50&embed=actors', None)),
+        Scenario('list movies, filtered and sorted', 'GET', '/movies', ('get:movies',), 200,
+                 lambda i: ('/movies?title=Movie%2000&sort=-release_date&limit=50', None)),
+        Scenario('export movies', 'GET', '/movies/export', ('get:movies',), 200,
+                 lambda i: ('/movies/export', None)),
+        Scenario('create movie', 'POST', '/movies', ('post:movies',), 200,
+                 lambda i: ('/movies', {'title': f'New {i}', 'release_date': '2021-01-01'})),
+        Scenario('update movie', 'PATCH', '/movies/<int:movie_id>', ('patch:movies',), 200,
+                 lambda i: (f'/movies/{movie(i)}', {'title': f'Renamed {i}'})),
+        Scenario('delete movie', 'DELETE', '/movies/<int:movie_id>', ('delete:movies',), 200,
+                 lambda i: (f'/movies/{new_movie()}', None)),
+        Scenario('bulk create movies', 'POST', '/movies/bulk', ('post:movies',), 200,
+                 lambda i: ('/movies/bulk', [{'title': f'Bulk {i}.{k}', 'release_date': '2021-01-01'}
+                                             for k in range(100)])),
+        Scenario('bulk update movies', 'PATCH', '/movies/bulk', ('patch:movies',), 200,
+                 lambda i: ('/movies/bulk', [{'id': movie(i * 100 + k), 'title': f'Bulk {i}'}
+                                             for k in range(100)])),
+        Scenario('bulk delete movies', 'DELETE', '/movies/bulk', ('delete:movies',), 200,
+                 lambda i: ('/movies/bulk', [new_movie() for _ in range(10)])),
+        Scenario('actors of a movie', 'GET', '/movies/<int:movie_id>/actors', ('get:actors',), 200,
+                 lambda i: (f'/movies/{movie(i)}/actors', None)),
+        Scenario('cast actors', 'POST', '/movies/<int:movie_id>/actors', ('patch:movies',), 200,
+                 lambda i: ('/movies/{}/actors'.format(cast(i)[0]), {'actor_ids': [cast(i)[1]]})),
+        Scenario('uncast actor', 'DELETE', '/movies/<int:movie_id>/actors/<int:actor_id>',
+                 ('patch:movies',), 200,
+                 lambda i: ('/movies/{}/actors/{}'.format(*uncast(i)), None)),
+        Scenario('list actors', 'GET', '/actors', ('get:actors',), 200,
+                 lambda i: ('/actors?limit=50', None)),
+        Scenario('list actors, filtered', 'GET', '/actors', ('get:actors',), 200,
+                 lambda i: ('/actors?age_min=30&age_max=40&gender=F&limit=50', None)),
+        Scenario('export actors', 'GET', '/actors/export', ('get:actors',), 200,
+                 lambda i: ('/actors/export', None)),
+        Scenario('create actor', 'POST', '/actors', ('post:actors',), 200,
+                 lambda i: ('/actors', {'name': f'New {i}', 'age': 30, 'gender': 'F'})),
+        Scenario('update actor', 'PATCH', '/actors/<int:actor_id>', ('patch:actors',), 200,
+                 lambda i: (f'/actors/{actor(i)}', {'name': f'Renamed {i}', 'age': 20 + i % 50,
+                                                    'gender': 'F'})),
+        Scenario('delete actor', 'DELETE', '/actors/<int:actor_id>', ('delete:actors',), 200,
+                 lambda i: (f'/actors/{new_actor()}', None)),
+        Scenario('bulk create actors', 'POST', '/actors/bulk', ('post:actors',), 200,
+                 lambda i: ('/actors/bulk', [{'name': f'Bulk {i}.{k}', 'age': 30, 'gender': 'M'}
+                                             for k in range(100)])),
+        Scenario('bulk update actors', 'PATCH', '/actors/bulk', ('patch:actors',), 200,
+                 lambda i: ('/actors/bulk', [{'id': actor(i * 100 + k), 'age': 40}
+                                             for k in range(100)])),
+        Scenario('bulk delete actors', 'DELETE', '/actors/bulk', ('delete:actors',), 200,
+                 lambda i: ('/actors/bulk', [new_actor() for _ in range(10)])),
+        Scenario('movies of an actor', 'GET', '/actors/<int:actor_id>/movies', ('get:movies',), 200,
+                 lambda i: (f'/actors/{actor(i)}/movies', None)),
+        Scenario('search', 'GET', '/search', ('get:movies', 'get:actors'), 200,
+                 lambda i: ('/search?q=movie%2000001', None)),
+        Scenario('metrics', 'GET', '/metrics', ('read:metrics',), 200,
+                 lambda i: ('/metrics', None)),
+        Scenario('write-behind status', 'GET', '/writes/status', ('read:metrics',), 200,
+                 lambda i: ('/writes/status', None)),
+    ]
+
+
+def uncovered_routes(app, scenarios):
+    covered = {(scenario.method, scenario.rule) for scenario in scenarios}
+    routes = {(method, rule.rule) for rule in app.url_map.iter_rules()
+              if rule.endpoint != 'static'
+              for method in rule.methods - {'HEAD', 'OPTIONS'}}
+    return sorted(routes - covered)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(app, scenario, requests, warmup):
+    client = app.test_client()
+    headers = auth_header(*scenario.permissions)
+    counter = {'n': 0}
+
+    def count(*args):
+        counter['n'] += 1
+
+    latencies, statuses, per_request = [], Counter(), []
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for i in range(warmup + requests):
+            path, body = scenario.request(i)
+            counter['n'] = 0
+            start = time.perf_counter()
+            response = client.open(path, method=scenario.method, json=body, headers=headers)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            if i < warmup:
+                continue
+            latencies.append(elapsed)
+            statuses[response.status_code] += 1
+            per_request.append(counter['n'])
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    latencies.sort()
+    return {
+        'method': scenario.method,
+        'rule': scenario.rule,
+        'requests': requests,
+        'rps': requests / sum(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries_mean': sum(per_request) / len(per_request),
+        'queries_max': max(per_request),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'unexpected': requests - statuses[scenario.status],
+    }
+
+
+def compare(results, baseline, threshold):
+    '''[(scenario, message)] for the regressions against baseline'''
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            regressions.append((name, f"p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms"))
+        if result['queries_mean'] > before['queries_mean'] + 0.01:
+            regressions.append((name, f"queries {before['queries_mean']:.2f} -> "
+                                      f"{result['queries_mean']:.2f} per request"))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--only', nargs='*', help='scenario names to run')
+    parser.add_argument('--cache', action='store_true', help='keep the response cache on')
+    parser.add_argument('--verify-every-request', action='store_true',
+                        help='turn the verified token cache off, so every request checks the RS256 signature')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed relative p95 slowdown against the baseline')
+    args = parser.parse_args()
+
+    app = create_bench_app(RESPONSE_CACHE='lru' if args.cache else 'off')
+    auth.token_cache.enabled = not args.verify_every_request
+    with app.app_context():
+        movie_ids, actor_ids = seed(args.rows)
+        selected = [scenario for scenario in scenarios(movie_ids, actor_ids)
+                    if not args.only or scenario.name in args.only]
+
+        print(f'{"scenario":<34}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+              f'{"queries":>9}  statuses')
+        results = {}
+        for scenario in selected:
+            result = results[scenario.name] = run(app, scenario, args.requests, args.warmup)
+            statuses = ' '.join(f'{status}x{count}' for status, count in result['statuses'].items())
+            print(f'{scenario.name:<34}{result["rps"]:>9.0f}{result["p50_ms"]:>9.2f}'
+                  f'{result["p95_ms"]:>9.2f}{result["p99_ms"]:>9.2f}'
+                  f'{result["queries_mean"]:>9.1f}  {statuses}')
+
+        uncovered = uncovered_routes(app, scenarios(movie_ids, actor_ids))
+        for method, rule in uncovered:
+            print(f'no scenario for {method} {rule}')
+        dialect = db.engine.dialect.name
+
+    report = {
+        'meta': {
+            'rows': args.rows,
+            'requests': args.requests,
+            'response_cache': args.cache,
+            'token_cache': not args.verify_every_request,
+            'database': dialect,
+            'python': platform.python_version(),
+            'created_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        },
+        'results': results,
+        'uncovered': [f'{method} {rule}' for method, rule in uncovered],
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline['results'], args.threshold)
+        for name, message in regressions:
+            print(f'REGRESSION {name}: {message}')
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''
+Rows per second of the single row write path (POST /actors per row)
+against POST /actors/bulk, on a scratch sqlite file or BENCH_DATABASE_URL.
+
+    python benchmarks/bench_bulk.py [rows] [batch size]
+'''
+import sys
+import time
+
+from common import auth_header, create_bench_app
+
+
+def main(rows, batch_size):
+    app = create_bench_app()
+    client = app.test_client()
+    headers = auth_header('post:actors')
+    actors = [{'name': f'actor_{i}', 'age': 20 + i % 50, 'gender': 'F'}
+              for i in range(rows)]
+
+    start = time.perf_counter()
+    for actor in actors:
+        res = client.post('/actors', headers=headers, json=actor)
+        assert res.status_code == 200, res.data
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(0, rows, batch_size):
+        res = client.post('/actors/bulk', headers=headers,
+                          json=actors[i:i + batch_size])
+        assert res.status_code == 200, res.data
+    bulk = time.perf_counter() - start
+
+    print(f'single row: {rows / single:10.0f} rows/s ({single:.2f}s)')
+    print(f'bulk x{batch_size}: {rows / bulk:10.0f} rows/s ({bulk:.2f}s)')
+    print(f'speedup: {single / bulk:.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 500)
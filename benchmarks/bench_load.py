@@ -0,0 +1,149 @@
+'''
+Load test comparing the WSGI and ASGI serving modes: each mode is started
+with gunicorn on the same seeded database and hammered with N concurrent
+keep-alive connections for a fixed time. prints throughput, latency
+percentiles and errors per mode.
+
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/bench_load.py \
+        --connections 500 --duration 30 --workers 4
+
+needs gunicorn, uvicorn and httpx, and the ASGI dependencies (starlette,
+asyncpg or aiosqlite). without BENCH_DATABASE_URL a scratch sqlite file is
+used, which mostly measures sqlite's locking rather than the server.
+'''
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from common import create_bench_app, install_signing_key, mint_token, scratch_database_url
+
+import httpx
+
+from models import Movie, db
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def seed(database_url, rows):
+    app = create_bench_app(SQLALCHEMY_DATABASE_URI=database_url)
+    with app.app_context():
+        start = datetime(1950, 1, 1)
+        db.session.bulk_insert_mappings(Movie, [
+            {'title': f'Movie {i:07d}', 'release_date': start + timedelta(days=i % 25000)}
+            for i in range(rows)])
+        db.session.commit()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, args, env, headers):
+    command = ['gunicorn', '--chdir', BENCH_DIR, '-b', f'127.0.0.1:{port}',
+               '-w', str(args.workers), '--log-level', 'warning']
+    if mode == 'asgi':
+        command += ['-k', 'uvicorn.workers.UvicornWorker']
+    elif args.threads > 1:
+        command += ['--threads', str(args.threads)]
+    command.append(f'serve:{mode}()')
+    server = subprocess.Popen(command, env=env)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            response = httpx.get(f'http://127.0.0.1:{port}{args.path}', headers=headers)
+            if response.status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f'{mode} server did not start')
+
+
+async def run_load(url, headers, connections, duration):
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        deadline = time.monotonic() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url, headers=headers)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(connections)))
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1, help='gthread threads per WSGI worker')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--path', default='/movies?limit=50')
+    parser.add_argument('--modes', nargs='+', default=['wsgi', 'asgi'], choices=['wsgi', 'asgi'])
+    args = parser.parse_args()
+
+    database_url = scratch_database_url()
+    seed(database_url, args.rows)
+    key_file = tempfile.NamedTemporaryFile('w', suffix='.pem', delete=False)
+    with key_file:
+        key_file.write(install_signing_key())
+    headers = {'Authorization': f'Bearer {mint_token("get:movies", "get:actors")}'}
+    env = dict(os.environ, BENCH_DATABASE_URL=database_url, BENCH_SIGNING_KEY=key_file.name,
+               # measure the database path, not the response cache
+               RESPONSE_CACHE='off')
+
+    print(f'{args.connections} connections, {args.duration:g}s, {args.workers} workers, '
+          f'GET {args.path}, {args.rows} rows')
+    print(f'{"mode":<6}{"requests":>10}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}'
+          f'{"p99 ms":>10}{"errors":>8}')
+    try:
+        for mode in args.modes:
+            port = free_port()
+            server = start_server(mode, port, args, env, headers)
+            try:
+                latencies, errors = asyncio.run(run_load(
+                    f'http://127.0.0.1:{port}{args.path}', headers,
+                    args.connections, args.duration))
+            finally:
+                server.terminate()
+                server.wait()
+            latencies.sort()
+            if not latencies:
+                print(f'{mode:<6}{0:>10}{0:>10}{"-":>10}{"-":>10}{"-":>10}{errors:>8}')
+                continue
+            print(f'{mode:<6}{len(latencies):>10}{len(latencies) / args.duration:>10.0f}'
+                  f'{percentile(latencies, 0.50) * 1000:>10.1f}'
+                  f'{percentile(latencies, 0.95) * 1000:>10.1f}'
+                  f'{percentile(latencies, 0.99) * 1000:>10.1f}{errors:>8}')
+    finally:
+        os.unlink(key_file.name)
+
+
+if __name__ == '__main__':
+    main()
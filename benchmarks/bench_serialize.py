@@ -0,0 +1,64 @@
+'''
+Cost of building a full list response: Movie.query.all() + format() +
+jsonify against the lean path (column tuples + Serializer), at 1k, 10k and
+100k rows, for each available JSON backend.
+
+    python benchmarks/bench_serialize.py [sizes...]
+'''
+import sys
+import time
+from datetime import datetime, timedelta
+
+from common import create_bench_app
+
+from flask import jsonify
+from sqlalchemy import select
+
+from models import Movie, db
+from serializers import JSON_BACKENDS, Serializer
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(sizes):
+    for size in sizes:
+        app = create_bench_app()
+        with app.app_context():
+            start = datetime(1990, 1, 1)
+            db.session.bulk_insert_mappings(Movie, [
+                {'title': f'movie_{i}', 'release_date': start + timedelta(days=i % 40000)}
+                for i in range(size)
+            ])
+            db.session.commit()
+
+            def format_path():
+                movies = Movie.query.all()
+                db.session.expunge_all()
+                return jsonify({'success': True, 'movies': [movie.format() for movie in movies]}).get_data()
+
+            results = {'format() + jsonify': timed(format_path)}
+            for backend in JSON_BACKENDS:
+                serializer = Serializer.from_config({'JSON_BACKEND': backend})
+
+                def lean_path():
+                    rows = db.session.execute(select(Movie.__table__)).all()
+                    return serializer.response({'success': True, 'movies': serializer.rows(Movie.__table__, rows)}).get_data()
+
+                results[f'lean ({backend})'] = timed(lean_path)
+
+        baseline = results['format() + jsonify']
+        print(f'{size} rows')
+        for name, seconds in results.items():
+            print(f'  {name:20} {seconds * 1000:9.1f} ms  {baseline / seconds:5.1f}x')
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,126 @@
+'''
+Where a worker's start goes: the import time of `app` broken down by
+package (python -X importtime, median of --runs fresh interpreters), the
+time create_app takes, and the first requests of a worker with and
+without warmup.warm_up.
+
+    python benchmarks/bench_startup.py [--runs 5] [--top 15]
+
+the first request numbers use the offline issuer (see common.py), whose
+JWKS fetch costs nothing; against Auth0 the cold first request also waits
+for that round trip. BENCH_DATABASE_URL measures connecting to a real
+server instead of a sqlite file.
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from common import auth, auth_header, create_bench_app
+
+from models import Movie, db
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def first_party():
+    names = {name[:-3] for name in os.listdir(ROOT) if name.endswith('.py')}
+    return names | {name for name in os.listdir(ROOT)
+                    if os.path.isfile(os.path.join(ROOT, name, '__init__.py'))}
+
+
+def import_profile(module='app'):
+    '''({package: self microseconds}, wall seconds) of one interpreter
+    importing module'''
+    env = dict(os.environ, TEST_DATABASE_URL=os.environ.get('TEST_DATABASE_URL', 'sqlite://'))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    packages = defaultdict(int)
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(self_us)
+    return packages, wall
+
+
+def interpreter_wall():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - start
+
+
+def print_imports(runs, top):
+    profiles = [import_profile() for _ in range(runs)]
+    walls = [wall for _, wall in profiles]
+    baseline = statistics.median(interpreter_wall() for _ in range(runs))
+    names = set().union(*(packages for packages, _ in profiles))
+    medians = {name: statistics.median(packages.get(name, 0) for packages, _ in profiles) / 1000
+               for name in names}
+    ours = first_party()
+
+    total = sum(medians.values())
+    print(f'import app: {statistics.median(walls) * 1000:.1f} ms wall '
+          f'({baseline * 1000:.1f} ms of it an empty interpreter), '
+          f'{total:.1f} ms importing')
+    for name, ms in sorted(medians.items(), key=lambda item: -item[1])[:top]:
+        label = f'{name} (this repo)' if name in ours else name
+        print(f'  {label:<28}{ms:>8.1f} ms {ms / total:>6.1%}')
+    repo = sum(ms for name, ms in medians.items() if name in ours)
+    print(f'  {"all modules of this repo":<28}{repo:>8.1f} ms {repo / total:>6.1%}')
+
+
+def timed_request(client, headers):
+    start = time.perf_counter()
+    res = client.get('/movies?limit=50', headers=headers)
+    return (time.perf_counter() - start) * 1000, res.status_code
+
+
+def print_first_requests(warm):
+    app = create_bench_app()
+    headers = auth_header('get:movies')
+    # a fresh worker: no keys fetched, no token verified, no connection open
+    auth.jwks_cache.use_provider(auth.jwks_cache.provider)
+    auth.token_cache.clear()
+    with app.app_context():
+        # GET /movies answers 404 for an empty table
+        Movie.bulk_insert([{'title': 'Startup', 'release_date': datetime(2000, 1, 1)}])
+        db.engine.dispose()
+
+    label = 'warm' if warm else 'cold'
+    if warm:
+        from warmup import warm_up
+        timings = warm_up(app)
+        print(f'{label}: warm_up took {sum(timings.values()):.1f} ms {timings}')
+    client = app.test_client()
+    for i in range(3):
+        ms, status = timed_request(client, headers)
+        print(f'{label}: request {i + 1} {ms:8.2f} ms ({status})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    print_imports(args.runs, args.top)
+
+    from app import create_app
+    start = time.perf_counter()
+    create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'LOG_LEVEL': 'ERROR'})
+    print(f'create_app: {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    print_first_requests(warm=False)
+    print_first_requests(warm=True)
+
+
+if __name__ == '__main__':
+    main()
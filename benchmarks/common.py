@@ -0,0 +1,64 @@
+'''
+Shared setup for the benchmarks: offline auth and an app on a scratch
+database.
+
+Importing this module sets placeholder Auth0 settings, so it must be
+imported before app / auth.
+'''
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('API_AUDIENCE', 'capstone')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import auth
+
+
+_issuer = None
+
+
+def install_signing_key(private_pem=None):
+    '''makes jwks_cache trust a throwaway RSA key, or the PEM private_pem,
+    through an auth.TestIssuer. returns the private key PEM'''
+    global _issuer
+    _issuer = auth.TestIssuer(kid='bench', private_pem=private_pem)
+    auth.jwks_cache.use_provider(_issuer)
+    auth.jwks_cache.refresh()
+    return _issuer.private_pem
+
+
+def mint_token(*permissions, ttl=3600):
+    if _issuer is None:
+        install_signing_key()
+    return _issuer.mint(*permissions, sub='auth0|bench', ttl=ttl)
+
+
+def auth_header(*permissions):
+    return {'Authorization': f'Bearer {mint_token(*permissions)}'}
+
+
+def scratch_database_url():
+    '''BENCH_DATABASE_URL if set, else a new sqlite file in a temp dir'''
+    if os.environ.get('BENCH_DATABASE_URL'):
+        return os.environ['BENCH_DATABASE_URL']
+    path = os.path.join(tempfile.mkdtemp(prefix='capstone-bench-'), 'bench.db')
+    return f'sqlite:///{path}'
+
+
+def create_bench_app(**config):
+    from app import create_app
+    from models import db
+
+    config.setdefault('SQLALCHEMY_DATABASE_URI', scratch_database_url())
+    # the expected 4xx of some scenarios would otherwise be logged per request
+    config.setdefault('LOG_LEVEL', 'ERROR')
+    # one subject sends every request, measure the API rather than the limiter
+    config.setdefault('RATE_LIMIT_DEFAULT', 'off')
+    app = create_app(config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
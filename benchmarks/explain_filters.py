@@ -0,0 +1,78 @@
+'''
+Prints the query plan of every list filter and sort order, as the
+endpoints actually issue them: the SQL sent by GET /movies and GET /actors
+is captured from the engine and re-run under EXPLAIN (postgres) or
+EXPLAIN QUERY PLAN (sqlite).
+
+    BENCH_DATABASE_URL=postgresql://... python benchmarks/explain_filters.py [rows]
+'''
+import sys
+from datetime import datetime, timedelta
+
+from common import auth_header, create_bench_app
+
+from sqlalchemy import event, text
+
+from models import Actor, Movie, db
+
+
+URLS = [
+    '/movies?limit=50',
+    '/movies?title=Mov&limit=50',
+    '/movies?release_date_from=2000-01-01&release_date_to=2000-12-31&limit=50',
+    '/movies?sort=title&limit=50',
+    '/movies?sort=-release_date&limit=50',
+    '/actors?name=act&limit=50',
+    '/actors?age_min=30&age_max=40&limit=50',
+    '/actors?gender=F&limit=50',
+    '/actors?sort=age&limit=50',
+]
+
+
+def seed(rows):
+    start = datetime(1950, 1, 1)
+    db.session.bulk_insert_mappings(Movie, [
+        {'title': f'Movie {i:07d}', 'release_date': start + timedelta(days=i % 25000)}
+        for i in range(rows)])
+    db.session.bulk_insert_mappings(Actor, [
+        {'name': f'actor {i:07d}', 'age': 18 + i % 70, 'gender': 'MF'[i % 2]}
+        for i in range(rows)])
+    db.session.commit()
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+def main(rows):
+    app = create_bench_app(RESPONSE_CACHE='off')
+    client = app.test_client()
+    headers = auth_header('get:movies', 'get:actors')
+
+    with app.app_context():
+        seed(rows)
+        engine = db.engine
+        postgres = engine.dialect.name == 'postgresql'
+
+        for url in URLS:
+            statements = []
+
+            def capture(conn, cursor, statement, parameters, context, executemany):
+                if 'collection_versions' not in statement:
+                    statements.append((statement, parameters))
+
+            event.listen(engine, 'before_cursor_execute', capture)
+            res = client.get(url, headers=headers)
+            event.remove(engine, 'before_cursor_execute', capture)
+            assert res.status_code == 200, res.data
+
+            print(f'== GET {url}')
+            for statement, parameters in statements:
+                prefix = 'EXPLAIN ' if postgres else 'EXPLAIN QUERY PLAN '
+                with engine.connect() as connection:
+                    plan = connection.exec_driver_sql(prefix + statement, parameters).all()
+                for line in plan:
+                    print('   ', line[0] if postgres else line[-1])
+            print()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,32 @@
+'''
+App entry points for load tests: the app on BENCH_DATABASE_URL, accepting
+tokens signed with the PEM private key in the file BENCH_SIGNING_KEY
+instead of Auth0 ones (see bench_load.py, which starts these).
+
+    gunicorn --chdir benchmarks 'serve:wsgi()'
+    gunicorn --chdir benchmarks -k uvicorn.workers.UvicornWorker 'serve:asgi()'
+'''
+import os
+
+from common import install_signing_key
+
+
+with open(os.environ['BENCH_SIGNING_KEY']) as key_file:
+    install_signing_key(key_file.read())
+
+
+def _create(mode):
+    from app import create_app
+
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': os.environ['BENCH_DATABASE_URL'],
+        'SERVING_MODE': mode,
+    })
+
+
+def wsgi():
+    return _create('wsgi')
+
+
+def asgi():
+    return _create('asgi')
@@ -0,0 +1,128 @@
+from datetime import datetime
+
+from werkzeug.http import parse_date
+
+
+MAX_BATCH_SIZE = 1000
+
+
+'''
+parse_release_date(value)
+    accepts the formats clients already send to POST /movies
+    ('1/22/1990', ISO 8601) and the http date format the API returns
+'''
+
+
+def parse_release_date(value):
+    if not isinstance(value, str):
+        raise ValueError('release_date must be a string')
+    for fmt in ('%m/%d/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(f'invalid release_date {value!r}')
+    return parsed.replace(tzinfo=None)
+
+
+def _string(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError('must be a non empty string')
+    return value
+
+
+def _integer(value):
+    if isinstance(value, bool):
+        raise ValueError('must be an integer')
+    return int(value)
+
+
+MOVIE_FIELDS = {'title': _string, 'release_date': parse_release_date}
+ACTOR_FIELDS = {'name': _string, 'age': _integer, 'gender': _string}
+
+
+'''
+validate_batch(items, fields, partial=False)
+    validates and converts a whole batch before anything is written
+
+    items is the decoded request body, a list of objects. with partial=False
+    (creates) every field is required, with partial=True (updates) items need
+    an integer `id` and at least one field.
+    returns (rows, errors), errors is a list of {'index', 'error'} dicts and
+    rows is only usable when errors is empty
+'''
+
+
+def validate_batch(items, fields, partial=False):
+    if not isinstance(items, list) or not items:
+        return [], [{'index': None, 'error': 'expected a non empty array'}]
+    if len(items) > MAX_BATCH_SIZE:
+        return [], [{'index': None,
+                     'error': f'at most {MAX_BATCH_SIZE} items per batch'}]
+
+    rows, errors, seen_ids = [], [], set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'error': 'expected an object'})
+            continue
+
+        row = {}
+        if partial:
+            item_id = item.get('id')
+            if not isinstance(item_id, int) or isinstance(item_id, bool):
+                errors.append({'index': index, 'error': 'missing id'})
+                continue
+            if item_id in seen_ids:
+                errors.append({'index': index, 'error': 'duplicate id'})
+                continue
+            seen_ids.add(item_id)
+            row['id'] = item_id
+
+        for name, convert in fields.items():
+            if item.get(name) is None:
+                if not partial:
+                    errors.append({'index': index, 'error': f'missing {name}'})
+                    break
+                continue
+            try:
+                row[name] = convert(item[name])
+            except (TypeError, ValueError):
+                errors.append({'index': index, 'error': f'invalid {name}'})
+                break
+        else:
+            if partial and len(row) == 1:
+                errors.append({'index': index, 'error': 'nothing to update'})
+            else:
+                rows.append(row)
+
+    return rows, errors
+
+
+'''
+validate_ids(items)
+    validates the body of a bulk delete, a list of unique integer ids
+'''
+
+
+def validate_ids(items):
+    if not isinstance(items, list) or not items:
+        return [], [{'index': None, 'error': 'expected a non empty array'}]
+    if len(items) > MAX_BATCH_SIZE:
+        return [], [{'index': None,
+                     'error': f'at most {MAX_BATCH_SIZE} items per batch'}]
+
+    errors, seen_ids = [], set()
+    for index, item in enumerate(items):
+        if not isinstance(item, int) or isinstance(item, bool):
+            errors.append({'index': index, 'error': 'invalid id'})
+        elif item in seen_ids:
+            errors.append({'index': index, 'error': 'duplicate id'})
+        else:
+            seen_ids.add(item)
+    return items, errors
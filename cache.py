@@ -0,0 +1,314 @@
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, has_app_context, request
+
+from models import on_collections_changed
+
+
+'''
+LRUBackend
+    in-process backend: a bounded, thread safe LRU with per entry ttl.
+    counters (incr) live outside the LRU so a generation is never evicted.
+    each worker has its own copy, so a write served by another worker is
+    only seen once the entry expires; use a SharedBackend when several
+    workers serve the same data and the ttl is not acceptable staleness.
+    values for which keep(value) is true are not evicted while they live,
+    the LRU then grows past maxsize until they are replaced or expire
+'''
+
+
+class LRUBackend:
+    def __init__(self, maxsize=1024, keep=None):
+        self.maxsize = maxsize
+        self.keep = keep
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def add(self, key, value, ttl=None):
+        '''set only if key holds no live entry, returns whether it did'''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                return False
+            self._entries[key] = (now + ttl if ttl else None, value)
+            self._entries.move_to_end(key)
+            self._evict()
+            return True
+
+    def _evict(self):
+        # with the lock held
+        excess = len(self._entries) - self.maxsize
+        if excess <= 0:
+            return
+        if self.keep is None:
+            for _ in range(excess):
+                self._entries.popitem(last=False)
+        else:
+            now = time.monotonic()
+            victims = []
+            for key, (expires_at, value) in self._entries.items():
+                if (expires_at is not None and expires_at <= now) or not self.keep(value):
+                    victims.append(key)
+                    if len(victims) == excess:
+                        break
+            for key in victims:
+                del self._entries[key]
+            excess = len(victims)
+        self.evictions += excess
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters[key] = self._counters.get(key, 0) + 1
+            return value
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'evictions': self.evictions}
+
+
+'''
+SharedBackend
+    adapter for a cache shared by all workers. `client` needs the redis-py
+    subset get(key), set(key, value, ex=seconds, nx=False), delete(key) and
+    incr(key); values are pickled. eviction is up to the server, so
+    evictions are not counted here.
+    generations are stored without a ttl, run the server with a volatile-*
+    eviction policy so they are never evicted
+'''
+
+
+class SharedBackend:
+    def __init__(self, client, prefix='capstone:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def counter(self, key):
+        value = self.client.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    def stats(self):
+        return {}
+
+
+'''
+FakeSharedClient
+    in-memory stand in for the shared cache server, for tests and local runs.
+    stores bytes only, like the real thing
+'''
+
+
+class FakeSharedClient:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            now = time.monotonic()
+            if nx:
+                entry = self._data.get(key)
+                if entry is not None and (entry[1] is None or entry[1] > now):
+                    return None
+            expires_at = now + ex if ex else None
+            self._data[key] = (bytes(value), expires_at)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            return int(self._data.pop(key, None) is not None)
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (b'0', None))
+            value = int(value) + 1
+            self._data[key] = (str(value).encode(), expires_at)
+            return value
+
+
+'''
+ResponseCache
+    read through cache of successful list responses, keyed by collection,
+    path, query string and the caller's permission set.
+
+    every collection has a generation number stored in the backend and
+    part of every key. writes bump it after their commit (see
+    on_collections_changed in models.py), which makes exactly that
+    collection's entries unreachable, for all workers when the backend is
+    shared. conditional requests are answered from the cached validators.
+    with backend None the cache is disabled and cached() is a pass through
+'''
+
+
+CACHED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control')
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl=5):
+        self.backend = backend
+        self.enabled = backend is not None
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _generation(self, collection):
+        return self.backend.counter(f'gen:{collection}')
+
+    def key(self, collections, path, args, permissions):
+        query = '&'.join(f'{name}={value}'
+                         for name, value in sorted(args.items(multi=True)))
+        scope = hashlib.sha1(
+            ' '.join(sorted(permissions)).encode()).hexdigest()[:16]
+        generations = ':'.join(f'{collection}{self._generation(collection)}'
+                               for collection in collections)
+        return f'resp:{generations}:{path}?{query}:{scope}'
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        self._count('hits' if entry is not None else 'misses')
+        return entry
+
+    def set(self, key, response):
+        self.store(key, response.get_data(), response.mimetype, response.headers)
+
+    def store(self, key, body, mimetype, headers):
+        '''set() for responses that are not flask's (the asgi endpoints)'''
+        headers = [(name, headers[name]) for name in CACHED_HEADERS if name in headers]
+        self.backend.set(key, (body, mimetype, headers), self.ttl)
+
+    def invalidate(self, collections):
+        if not self.enabled:
+            return
+        for collection in collections:
+            self.backend.incr(f'gen:{collection}')
+        self._count('invalidations', len(collections))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        if self.enabled:
+            stats.update(self.backend.stats())
+        return stats
+
+    def cached(self, collection, embed=None):
+        '''decorator for list views, goes below @requires_auth. `embed` names
+        the collection a response includes with ?embed=<embed>, whose writes
+        must invalidate it as well'''
+        def decorator(f):
+            @wraps(f)
+            def wrapper(payload, *args, **kwargs):
+                if not self.enabled:
+                    return f(payload, *args, **kwargs)
+
+                collections = [collection]
+                if embed is not None and request.args.get('embed') == embed:
+                    collections.append(embed)
+                key = self.key(collections, request.path, request.args,
+                               payload.get('permissions', ()))
+                entry = self.get(key)
+                if entry is not None:
+                    body, mimetype, headers = entry
+                    response = Response(body, mimetype=mimetype,
+                                        headers=headers)
+                    return response.make_conditional(request)
+
+                response = f(payload, *args, **kwargs)
+                if response.status_code == 200:
+                    self.set(key, response)
+                return response
+
+            return wrapper
+        return decorator
+
+
+'''
+response_cache_from_config(config)
+    RESPONSE_CACHE is 'lru' (default), 'off', or a backend instance
+    (e.g. SharedBackend(redis_client)), RESPONSE_CACHE_TTL the seconds an
+    entry lives and RESPONSE_CACHE_SIZE the LRU capacity
+'''
+
+
+def response_cache_from_config(config):
+    backend = config.get('RESPONSE_CACHE', 'lru')
+    if backend == 'off':
+        backend = None
+    elif backend == 'lru':
+        backend = LRUBackend(config.get('RESPONSE_CACHE_SIZE', 1024))
+    return ResponseCache(backend, ttl=config.get('RESPONSE_CACHE_TTL', 5))
+
+
+def _invalidate_current_app(collections):
+    if has_app_context():
+        cache = current_app.extensions.get('response_cache')
+        if cache is not None:
+            cache.invalidate(collections)
+
+
+on_collections_changed(_invalidate_current_app)
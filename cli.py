@@ -0,0 +1,315 @@
+import csv
+import io
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, insert, select, text
+
+from bulk import ACTOR_FIELDS, MOVIE_FIELDS
+from models import Actor, Movie, db, movie_actors
+
+
+LOAD_BATCH_SIZE = 50000
+
+# the tables `data import` loads: model and the converters of the fields
+TABLES = {'movies': (Movie, MOVIE_FIELDS), 'actors': (Actor, ACTOR_FIELDS)}
+FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.json': 'ndjson'}
+
+
+'''
+Progress(label, total=None)
+    rows loaded so far and the rate, printed to stderr at most once a
+    second, and a summary line by done()
+'''
+
+
+class Progress:
+    interval = 1.0
+
+    def __init__(self, label, total=None):
+        self.label = label
+        self.total = total
+        self.rows = 0
+        self.start = self.printed_at = time.perf_counter()
+
+    def _rate(self, now):
+        return self.rows / (now - self.start) if now > self.start else 0.0
+
+    def update(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if now - self.printed_at >= self.interval:
+            self.printed_at = now
+            total = f'/{self.total}' if self.total else ''
+            click.echo(f'{self.label}: {self.rows}{total} rows, {self._rate(now):,.0f} rows/s',
+                       err=True)
+
+    def done(self):
+        now = time.perf_counter()
+        click.echo(f'{self.label}: loaded {self.rows} rows in {now - self.start:.1f} s '
+                   f'({self._rate(now):,.0f} rows/s)', err=True)
+        return self.rows
+
+
+'''
+load(table, columns, rows, progress, batch_size)
+    writes the tuples `rows` (values of `columns`, in order) to `table`,
+    committing every batch_size rows. postgres gets one COPY ... FROM STDIN
+    per batch, other databases (sqlite) one executemany INSERT per batch.
+    when ids are loaded the table's id sequence is moved past them, so the
+    next insert through the API does not collide
+'''
+
+
+def _copy_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+def _copy_batch(connection, table, columns, batch):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in batch:
+        writer.writerow([_copy_value(value) for value in row])
+    buffer.seek(0)
+    raw = connection.connection
+    with raw.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load(table, columns, rows, progress, batch_size=LOAD_BATCH_SIZE):
+    engine = db.engine
+    copy = engine.dialect.name == 'postgresql'
+    statement = insert(table)
+    try:
+        for batch in _batches(rows, batch_size):
+            with engine.begin() as connection:
+                if copy:
+                    _copy_batch(connection, table, columns, batch)
+                else:
+                    connection.execute(statement, [dict(zip(columns, row)) for row in batch])
+            progress.update(len(batch))
+    finally:
+        # also after a failure, for the batches that were committed
+        if copy and 'id' in columns and progress.rows:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                    f"(SELECT coalesce(max(id), 0) + 1 FROM {table.name}), false)"))
+        progress.done()
+    return progress.rows
+
+
+def _collections_changed(*models):
+    # the version bump invalidates ETags, response caches and search indexes
+    for model in models:
+        model.bump_version()
+    db.session.commit()
+
+
+'''
+seed rows
+    synthetic movies and actors, reproducible for a given --random-seed.
+    titles and names are built from word lists, so search and the prefix
+    filters have realistic matches to find
+'''
+
+TITLE_WORDS = ('Silent', 'Red', 'Last', 'Midnight', 'Golden', 'Broken', 'River', 'City',
+               'Winter', 'Shadow', 'Garden', 'Empire', 'Storm', 'Echo', 'Harbor', 'Letter',
+               'Summer', 'Night', 'Road', 'Star', 'Paper', 'Glass', 'Wild', 'Lost')
+FIRST_NAMES = ('Ana', 'Ben', 'Carla', 'David', 'Elena', 'Farid', 'Grace', 'Hugo', 'Ines',
+               'Jonas', 'Kira', 'Luis', 'Maya', 'Noah', 'Olga', 'Pedro', 'Rosa', 'Sami')
+LAST_NAMES = ('Alvarez', 'Brown', 'Chen', 'Dubois', 'Evans', 'Fischer', 'Garcia', 'Haddad',
+              'Ito', 'Jensen', 'Kowalski', 'Lopez', 'Moreau', 'Nakamura', 'Okafor', 'Silva')
+
+
+def movie_rows(count, rng, start=datetime(1920, 1, 1), days=38000):
+    for i in range(count):
+        words = rng.sample(TITLE_WORDS, rng.randint(1, 3))
+        yield (f'{" ".join(words)} {i}', start + timedelta(days=rng.randrange(days)))
+
+
+def actor_rows(count, rng):
+    for i in range(count):
+        yield (f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}',
+               rng.randint(18, 90), rng.choice('FM'))
+
+
+def cast_rows(movie_ids, actor_ids, per_movie, rng):
+    per_movie = min(per_movie, len(actor_ids))
+    for movie_id in movie_ids:
+        for actor_id in rng.sample(actor_ids, per_movie):
+            yield (movie_id, actor_id)
+
+
+def _ids_after(model, last_id):
+    return list(db.session.execute(
+        select(model.id).where(model.id > last_id).order_by(model.id)).scalars())
+
+
+'''
+import rows
+    CSV files need a header row naming the columns, NDJSON files hold one
+    object per line (what GET /movies/export and /actors/export return).
+    values go through the same converters as the bulk endpoints (bulk.py),
+    so release dates may be '1/22/1990', ISO 8601 or http dates. an `id`
+    column is kept, other unknown columns are an error
+'''
+
+
+def _records(file, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_number, line in enumerate(file, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError:
+                    yield line_number, None
+
+
+def _converted(records, fields, columns, skip_invalid, skipped):
+    for line_number, record in records:
+        try:
+            if record is None:
+                raise ValueError('invalid JSON')
+            if not isinstance(record, dict):
+                raise ValueError('expected an object')
+            unknown = set(record) - set(columns)
+            if unknown:
+                raise ValueError(f'unknown columns {", ".join(sorted(unknown))}')
+            row = []
+            for name in columns:
+                value = record.get(name)
+                if value is None or value == '':
+                    raise ValueError(f'missing {name}')
+                try:
+                    row.append(int(value) if name == 'id' else fields[name](value))
+                except (TypeError, ValueError):
+                    raise ValueError(f'invalid {name}')
+        except ValueError as error:
+            if not skip_invalid:
+                raise click.ClickException(f'line {line_number}: {error}')
+            skipped.append(line_number)
+            continue
+        yield tuple(row)
+
+
+def _columns(path, fmt, fields):
+    '''the columns a file holds, from the CSV header or the first NDJSON object'''
+    with open(path, newline='') as file:
+        if fmt == 'csv':
+            header = next(csv.reader(file), [])
+        else:
+            first = next((line for line in file if line.strip()), '{}')
+            try:
+                header = list(json.loads(first))
+            except (ValueError, TypeError):
+                header = []
+    unknown = set(header) - {'id', *fields}
+    if unknown:
+        raise click.ClickException(f'{path}: unknown columns {", ".join(sorted(unknown))}')
+    columns = [name for name in ('id', *fields) if name in header]
+    if not set(fields) <= set(columns):
+        missing = ', '.join(name for name in fields if name not in columns)
+        raise click.ClickException(f'{path}: missing columns {missing}')
+    return columns
+
+
+def _table_and_format(path, table, fmt):
+    stem, extension = os.path.splitext(os.path.basename(path))
+    table = table or stem.split('.')[0]
+    if table not in TABLES:
+        raise click.ClickException(f'{path}: pass --table, movies or actors')
+    fmt = fmt or FORMATS.get(extension.lower())
+    if fmt is None:
+        raise click.ClickException(f'{path}: pass --format, csv or ndjson')
+    return table, fmt
+
+
+data = AppGroup('data', help='Load movies and actors in bulk.')
+
+
+@data.command('seed')
+@click.option('--movies', type=click.IntRange(min=0), default=0, help='movies to create')
+@click.option('--actors', type=click.IntRange(min=0), default=0, help='actors to create')
+@click.option('--cast', type=click.IntRange(min=0), default=0,
+              help='actors cast in each new movie, picked among the new actors')
+@click.option('--batch-size', type=click.IntRange(min=1), default=LOAD_BATCH_SIZE)
+@click.option('--random-seed', type=int, default=None, help='for reproducible data')
+def seed(movies, actors, cast, batch_size, random_seed):
+    '''Create synthetic movies and actors.'''
+    rng = random.Random(random_seed)
+    last_movie = db.session.execute(select(func.max(Movie.id))).scalar() or 0
+    last_actor = db.session.execute(select(func.max(Actor.id))).scalar() or 0
+    db.session.commit()
+
+    if movies:
+        load(Movie.__table__, ('title', 'release_date'), movie_rows(movies, rng),
+             Progress('movies', movies), batch_size)
+    if actors:
+        load(Actor.__table__, ('name', 'age', 'gender'), actor_rows(actors, rng),
+             Progress('actors', actors), batch_size)
+    if cast and movies and actors:
+        movie_ids, actor_ids = _ids_after(Movie, last_movie), _ids_after(Actor, last_actor)
+        load(movie_actors, ('movie_id', 'actor_id'),
+             cast_rows(movie_ids, actor_ids, cast, rng),
+             Progress('casting', len(movie_ids) * min(cast, len(actor_ids))), batch_size)
+    _collections_changed(*[model for model, count in ((Movie, movies), (Actor, actors))
+                           if count])
+
+
+@data.command('import')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--table', type=click.Choice(sorted(TABLES)),
+              help='target table, by default the file name up to the first dot')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+              help='by default from the file extension')
+@click.option('--batch-size', type=click.IntRange(min=1), default=LOAD_BATCH_SIZE)
+@click.option('--skip-invalid', is_flag=True, help='skip rows that fail validation')
+def import_(paths, table, fmt, batch_size, skip_invalid):
+    '''Load CSV or NDJSON files into the movies or actors table.
+
+    Batches already loaded stay when a later row is invalid, unless
+    --skip-invalid is given the import stops at that row.'''
+    changed = set()
+    try:
+        for path in paths:
+            path_table, path_fmt = _table_and_format(path, table, fmt)
+            model, fields = TABLES[path_table]
+            columns = _columns(path, path_fmt, fields)
+            skipped = []
+            # batches committed before a failure count as a change too
+            changed.add(model)
+            with open(path, newline='') as file:
+                rows = _converted(_records(file, path_fmt), fields, columns, skip_invalid, skipped)
+                load(model.__table__, columns, rows,
+                     Progress(f'{os.path.basename(path)} -> {path_table}'), batch_size)
+            if skipped:
+                lines = ', '.join(map(str, skipped[:10])) + (' ...' if len(skipped) > 10 else '')
+                click.echo(f'{path}: skipped {len(skipped)} invalid rows (lines {lines})',
+                           err=True)
+    finally:
+        if changed:
+            _collections_changed(*changed)
@@ -0,0 +1,54 @@
+from datetime import timezone
+
+from models import CollectionVersion
+
+
+'''
+collection_validators(*names, session=None)
+    (etag, last_modified) for one or more collections, read from their
+    CollectionVersion rows. several names are used when a response embeds
+    another collection. last_modified is None if none was ever written
+'''
+
+
+def collection_validators(*names, session=None):
+    tags, last_modified = [], None
+    for name in names:
+        version, updated_at = CollectionVersion.current(name, session)
+        tags.append(f'{name}-{version}')
+        if updated_at is not None:
+            updated_at = updated_at.replace(microsecond=0, tzinfo=timezone.utc)
+            if last_modified is None or updated_at > last_modified:
+                last_modified = updated_at
+    return '.'.join(tags), last_modified
+
+
+'''
+is_not_modified(request, etag, last_modified)
+    If-None-Match takes precedence over If-Modified-Since (RFC 7232 3.3).
+    If-Modified-Since only has second resolution, clients polling a
+    collection that changes several times a second should send the ETag
+'''
+
+
+def is_not_modified(request, etag, last_modified):
+    return not_modified(request.if_none_match, request.if_modified_since,
+                        etag, last_modified)
+
+
+def not_modified(if_none_match, if_modified_since, etag, last_modified):
+    '''is_not_modified on parsed header values (werkzeug ETags and datetime)'''
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+    if if_modified_since and last_modified is not None:
+        return last_modified <= if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,40 @@
+import json
+from datetime import date, datetime
+
+from sqlalchemy import select
+from werkzeug.http import http_date
+
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def _default(value):
+    # same representation jsonify gives release_date in the list endpoints
+    if isinstance(value, (datetime, date)):
+        return http_date(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+'''
+ndjson_export(engine, table, batch_size=EXPORT_BATCH_SIZE)
+    generator of newline delimited json, one line per row of `table`
+
+    rows are read through a server side cursor (stream_results) in batches
+    of batch_size and no ORM objects are built, so memory stays constant
+    whatever the size of the table and the first batch is sent before the
+    query has finished. the connection is held by the generator and is
+    released when the response is closed.
+'''
+
+
+def ndjson_export(engine, table, batch_size=EXPORT_BATCH_SIZE):
+    with engine.connect() as connection:
+        result = connection.execution_options(
+            stream_results=True, max_row_buffer=batch_size
+        ).execute(select(table).order_by(table.c.id))
+
+        for rows in result.partitions(batch_size):
+            yield ''.join(
+                json.dumps(dict(row._mapping), default=_default) + '\n'
+                for row in rows
+            )
@@ -0,0 +1,96 @@
+from flask import abort
+
+from bulk import parse_release_date
+from models import Movie, Actor
+from pagination import SortOrder, cursor_sort, order_by_clauses
+
+
+PAGING_ARGS = ('cursor', 'limit', 'embed')
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def prefix(column):
+    # a literal 'abc%' pattern (not `column || '%'`), so postgres can use the
+    # text_pattern_ops index whatever the database collation
+    return lambda value: column.like(_escape_like(value) + '%', escape='\\')
+
+
+def at_least(column, convert):
+    return lambda value: column >= convert(value)
+
+
+def at_most(column, convert):
+    return lambda value: column <= convert(value)
+
+
+def equals(column, convert=str):
+    return lambda value: column == convert(value)
+
+
+'''
+ListSpec
+    the whitelist of filters and sort orders of a list endpoint.
+    `filters` maps a query parameter to a function building the SQL
+    predicate from its value, `sorts` maps sort names to columns; `sort=name`
+    sorts ascending and `sort=-name` descending
+'''
+
+
+class ListSpec:
+    def __init__(self, id_column, filters, sorts):
+        self.id_column = id_column
+        self.filters = filters
+        self.sorts = sorts
+
+    def parse(self, args, cursor=None):
+        '''(predicates, SortOrder) for the query string, aborts with 400 on
+        unknown parameters, invalid values or a cursor issued for another
+        sort order'''
+        predicates = []
+        for name, value in args.items(multi=True):
+            if name in PAGING_ARGS or name == 'sort':
+                continue
+            if name not in self.filters or not value:
+                abort(400)
+            try:
+                predicates.append(self.filters[name](value))
+            except (TypeError, ValueError):
+                abort(400)
+
+        sort = args.get('sort', 'id')
+        descending = sort.startswith('-')
+        name = sort.lstrip('-')
+        if name not in self.sorts:
+            abort(400)
+        order = SortOrder(sort, self.sorts[name], descending)
+        if cursor is not None and cursor.sort != cursor_sort(self.id_column, order):
+            abort(400)
+        return predicates, order
+
+    def order_by(self, order):
+        return order_by_clauses(self.id_column, order)
+
+
+MOVIE_LIST = ListSpec(
+    Movie.id,
+    filters={
+        'title': prefix(Movie.title),
+        'release_date_from': at_least(Movie.release_date, parse_release_date),
+        'release_date_to': at_most(Movie.release_date, parse_release_date),
+    },
+    sorts={'id': Movie.id, 'title': Movie.title, 'release_date': Movie.release_date},
+)
+
+ACTOR_LIST = ListSpec(
+    Actor.id,
+    filters={
+        'name': prefix(Actor.name),
+        'age_min': at_least(Actor.age, int),
+        'age_max': at_most(Actor.age, int),
+        'gender': equals(Actor.gender),
+    },
+    sorts={'id': Actor.id, 'name': Actor.name, 'age': Actor.age},
+)
@@ -0,0 +1,31 @@
+'''
+gunicorn settings, read by `gunicorn app:app` from the working directory.
+
+the app is imported once in the master (preload_app) and the workers are
+forked from it, so they start without importing anything. the master also
+configures the ORM and fetches the JWKS (warmup.prepare); each worker then
+opens its database connections before it accepts requests
+(warmup.warm_up). set PRELOAD_APP=false to import the app in every worker
+instead, e.g. to reload code with a HUP
+'''
+import os
+
+
+preload_app = os.environ.get('PRELOAD_APP', 'true').lower() != 'false'
+# seconds a request may take before its worker is killed, also how long a
+# claimed Idempotency-Key stays pending (see app.py)
+timeout = int(os.environ.get('WORKER_TIMEOUT', 30))
+
+
+def when_ready(server):
+    if preload_app:
+        from warmup import prepare
+        prepare(server.app.wsgi())
+
+
+def post_worker_init(worker):
+    # called once the worker has loaded the app, before its first request.
+    # WARMUP_CONNECTIONS defaults to the pool size, 0 skips the database
+    from warmup import warm_up
+    connections = os.environ.get('WARMUP_CONNECTIONS')
+    warm_up(worker.wsgi, int(connections) if connections else None)
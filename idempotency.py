@@ -0,0 +1,186 @@
+import hashlib
+import re
+import threading
+import time
+from functools import wraps
+
+from flask import Response, abort, current_app, request
+from werkzeug.exceptions import Conflict
+
+from cache import LRUBackend
+
+
+# keys clients may send, e.g. a uuid
+_KEY = re.compile(r'^[\x21-\x7e]{1,255}$')
+
+# response headers a replay repeats, the hooks add the rest again
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+
+'''
+IdempotencyStore(backend, ttl, pending_ttl, wait_timeout)
+    makes a view safe to retry: requests with an Idempotency-Key header are
+    run once per token sub, method, path and key, and a retry gets the
+    stored response back (with Idempotent-Replayed: true) without running
+    validation, the insert or any other query.
+
+    the first request claims the key with backend.add, an atomic set if
+    absent, so of concurrent duplicates exactly one runs the view. the
+    others wait for its result: on an event in this worker, by polling the
+    backend across workers, for up to wait_timeout seconds, then answer
+    409 with Retry-After. responses below 500 are kept `ttl` seconds; 5xx
+    and exceptions release the claim so a retry runs again. a claim whose
+    worker died expires after pending_ttl, which has to be longer than the
+    view can run or a duplicate would run it a second time. reusing a key
+    for a different body is a 422.
+
+    the backend is a cache.LRUBackend (per worker: retries landing on
+    another worker are not deduplicated) that must not evict pending
+    claims (see pending_kept), or a cache.SharedBackend
+'''
+
+
+def pending_kept(value):
+    '''LRUBackend keep predicate: claims of running requests stay'''
+    return value[0] == 'pending'
+
+
+class IdempotencyStore:
+    poll_interval = 0.05
+
+    def __init__(self, backend, ttl=86400, pending_ttl=30, wait_timeout=10):
+        self.backend = backend
+        self.enabled = backend is not None
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.wait_timeout = wait_timeout
+        self._events = {}
+        self._lock = threading.Lock()
+        self._stats = {'executed': 0, 'replayed': 0, 'waited': 0, 'conflicts': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _claim(self, key, fingerprint):
+        if not self.backend.add(key, ('pending', fingerprint), self.pending_ttl):
+            return None
+        event = threading.Event()
+        with self._lock:
+            self._events[key] = event
+        return event
+
+    def _release(self, key, event, entry=None):
+        if entry is None:
+            self.backend.delete(key)
+        else:
+            self.backend.set(key, entry, self.ttl)
+        with self._lock:
+            self._events.pop(key, None)
+        event.set()
+
+    def _wait(self, key, deadline):
+        '''the entry of key once it is no longer pending, None if released'''
+        waited = False
+        while True:
+            entry = self.backend.get(key)
+            if entry is None or entry[0] != 'pending':
+                if waited:
+                    self._count('waited')
+                return entry
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count('conflicts')
+                raise Conflict(
+                    'A request with this Idempotency-Key is still being processed.')
+            waited = True
+            with self._lock:
+                event = self._events.get(key)
+            if event is not None:
+                event.wait(remaining)
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+
+    def _execute(self, key, event, fingerprint, f, args, kwargs):
+        try:
+            try:
+                rv = f(*args, **kwargs)
+            except Exception as e:
+                # render aborts and handled errors (validation, refused
+                # data) here, so they are stored and replayed as well
+                rv = current_app.handle_user_exception(e)
+            response = current_app.make_response(rv)
+        except BaseException:
+            self._release(key, event)
+            raise
+
+        if response.status_code >= 500:
+            self._release(key, event)
+            return response
+        headers = [(name, response.headers[name])
+                   for name in REPLAYED_HEADERS if name in response.headers]
+        self._release(key, event, ('done', fingerprint, response.status_code,
+                                   headers, response.get_data()))
+        self._count('executed')
+        return response
+
+    def run(self, scope, f, args, kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not self.enabled or idempotency_key is None:
+            return f(*args, **kwargs)
+        if not _KEY.match(idempotency_key):
+            abort(400)
+
+        key = f'idem:{scope}:{request.method}:{request.path}:{idempotency_key}'
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            event = self._claim(key, fingerprint)
+            if event is not None:
+                return self._execute(key, event, fingerprint, f, args, kwargs)
+            entry = self._wait(key, deadline)
+            if entry is None:
+                # the first attempt failed and released the key, run it now
+                continue
+            _, stored_fingerprint, status, headers, body = entry
+            if stored_fingerprint != fingerprint:
+                abort(422)
+            self._count('replayed')
+            response = Response(body, status=status, headers=headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+    def idempotent(self, f):
+        '''decorator for create views, goes below @requires_auth'''
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            return self.run(payload.get('sub', 'anonymous'), f, (payload,) + args, kwargs)
+
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_progress'] = len(self._events)
+        return stats
+
+
+'''
+idempotency_from_config(config)
+    IDEMPOTENCY_STORE is 'lru' (default), 'off', or a backend instance
+    (e.g. SharedBackend(redis_client)), IDEMPOTENCY_TTL the seconds a
+    response is kept for replays, IDEMPOTENCY_WAIT_SECONDS how long a
+    duplicate waits for the first request, IDEMPOTENCY_PENDING_SECONDS how
+    long a claim lasts and IDEMPOTENCY_STORE_SIZE the LRU capacity
+'''
+
+
+def idempotency_from_config(config):
+    backend = config.get('IDEMPOTENCY_STORE', 'lru')
+    if backend == 'off':
+        backend = None
+    elif backend == 'lru':
+        backend = LRUBackend(config.get('IDEMPOTENCY_STORE_SIZE', 10000), keep=pending_kept)
+    return IdempotencyStore(backend, ttl=config.get('IDEMPOTENCY_TTL', 86400),
+                            pending_ttl=config.get('IDEMPOTENCY_PENDING_SECONDS', 30),
+                            wait_timeout=config.get('IDEMPOTENCY_WAIT_SECONDS', 10))
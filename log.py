@@ -0,0 +1,296 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import _request_ctx_stack, request
+from flask.logging import default_handler
+
+
+# the app's logger, handlers log through it instead of print()
+log = logging.getLogger('capstone')
+
+# attributes every LogRecord has, anything else was passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+# X-Request-ID values accepted from clients or proxies, others are replaced
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+
+# (request id, method, path) of the request a native asgi endpoint is
+# serving, where flask views have their request context (see asgi.py)
+asgi_request = contextvars.ContextVar('asgi_request', default=None)
+
+
+def request_id_from(header):
+    '''the X-Request-ID header when it looks like one, else a new uuid'''
+    if header is None or not _REQUEST_ID.match(header):
+        return uuid.uuid4().hex
+    return header
+
+
+def current_request():
+    '''(request id, method, path) of the request being served, None outside
+    requests'''
+    top = _request_ctx_stack.top
+    if top is None:
+        return asgi_request.get()
+    request_id = getattr(top, 'request_id', None)
+    if request_id is None:
+        return None
+    return request_id, request.method, request.path
+
+
+def current_request_id():
+    '''the correlation id of the request being served, None outside requests'''
+    served = current_request()
+    return served[0] if served is not None else None
+
+
+'''
+JSONFormatter
+    one JSON object per line: time, level, logger, message, the request's
+    id, method and path when there is one, the formatted traceback under
+    `exception` and any extra= fields
+'''
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    '''plain lines for local runs, the request id appended when there is one'''
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        request_id = getattr(record, 'request_id', None)
+        return f'{line} [{request_id}]' if request_id else line
+
+
+'''
+RequestContextFilter
+    adds request_id, method and path to records logged while a request is
+    served. runs in the thread that logs, before the record is queued
+'''
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        served = current_request()
+        if served is not None:
+            record.request_id, record.method, record.path = served
+        return True
+
+
+'''
+RepeatFilter(window, burst)
+    samples repeated records: at most `burst` records with the same logger,
+    level, message template, exception type and call site pass per
+    `window` seconds. the first record to pass in a new window carries the
+    number dropped in the previous one as `suppressed`, so an error storm
+    costs a handful of lines per window and is still visible
+'''
+
+
+class RepeatFilter(logging.Filter):
+    max_keys = 1024
+
+    def __init__(self, window=60, burst=10):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _key(self, record):
+        exc_type = record.exc_info[0].__name__ if record.exc_info else None
+        return (record.name, record.levelno, str(record.msg), exc_type,
+                record.pathname, record.lineno)
+
+    def filter(self, record):
+        if self.burst <= 0:
+            return True
+        key = self._key(record)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                suppressed = entry[2] if entry is not None else 0
+                if entry is None and len(self._seen) >= self.max_keys:
+                    self._seen.clear()
+                self._seen[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if entry[1] < self.burst:
+                entry[1] += 1
+                return True
+            entry[2] += 1
+            return False
+
+
+'''
+NonBlockingQueueHandler
+    hands records to the listener thread without ever waiting: when the
+    queue is full the record is dropped and counted. the message and
+    traceback are rendered here, in the logging thread, so the queued
+    record holds no references to frames or request objects
+'''
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+'''
+LogPipeline
+    the process wide handler chain of `log`: filters and a bounded queue in
+    the logging thread, formatting and the write to stdout in a listener
+    thread, so a slow or blocked stdout never stalls a request. the
+    listener is restarted in forked workers (gunicorn --preload) and
+    drained at exit
+'''
+
+
+class LogPipeline:
+    def __init__(self):
+        self.queue = None
+        self.handler = None
+        self.listener = None
+        self.output = logging.StreamHandler(sys.stdout)
+        self.context_filter = RequestContextFilter()
+        self.repeat_filter = RepeatFilter()
+        self.loggers = {log}
+
+    def configure(self, level='INFO', fmt='json', queue_size=10000,
+                  sample_window=60, sample_burst=10):
+        self.stop()
+        self.output.setFormatter(JSONFormatter() if fmt == 'json' else TextFormatter())
+        self.repeat_filter.window = sample_window
+        self.repeat_filter.burst = sample_burst
+        previous = self.handler
+        self.queue = queue.Queue(queue_size)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.handler.addFilter(self.context_filter)
+        self.handler.addFilter(self.repeat_filter)
+        for logger in self.loggers:
+            self._attach(logger, previous)
+        log.setLevel(level)
+        self.start()
+
+    def attach(self, logger):
+        '''routes another logger (flask's app.logger) through the pipeline'''
+        self.loggers.add(logger)
+        self._attach(logger)
+
+    def _attach(self, logger, previous=None):
+        for handler in (previous, default_handler):
+            if handler is not None:
+                logger.removeHandler(handler)
+        logger.addHandler(self.handler)
+        logger.propagate = False
+
+    def start(self):
+        self.listener = QueueListener(self.queue, self.output)
+        self.listener.start()
+
+    def stop(self):
+        '''writes out what is queued and ends the listener thread'''
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+
+    def restart_after_fork(self):
+        # the listener thread does not survive a fork, and the child must
+        # not share the parent's queue or filter locks
+        if self.handler is not None:
+            self.queue = self.handler.queue = queue.Queue(self.queue.maxsize)
+            self.repeat_filter._lock = threading.Lock()
+            self.start()
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'dropped': self.handler.dropped if self.handler is not None else 0,
+        }
+
+
+pipeline = LogPipeline()
+atexit.register(pipeline.stop)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pipeline.restart_after_fork)
+
+
+'''
+init_logging(app)
+    configures the pipeline from LOG_LEVEL, LOG_FORMAT ('json' or 'text'),
+    LOG_QUEUE_SIZE, LOG_SAMPLE_WINDOW and LOG_SAMPLE_BURST (0 keeps every
+    record), and gives each request a correlation id: the X-Request-ID
+    header when it looks like one, else a new uuid. the id is sent back in
+    X-Request-ID and added to every record logged by the request
+'''
+
+
+def init_logging(app):
+    config = app.config
+    pipeline.configure(level=config['LOG_LEVEL'], fmt=config['LOG_FORMAT'],
+                       queue_size=config['LOG_QUEUE_SIZE'],
+                       sample_window=config['LOG_SAMPLE_WINDOW'],
+                       sample_burst=config['LOG_SAMPLE_BURST'])
+    # flask logs unhandled exceptions (with their traceback) to app.logger
+    pipeline.attach(app.logger)
+
+    @app.before_request
+    def assign_request_id():
+        _request_ctx_stack.top.request_id = request_id_from(request.headers.get('X-Request-ID'))
+
+    @app.after_request
+    def send_request_id(response):
+        request_id = current_request_id()
+        if request_id is not None:
+            response.headers['X-Request-ID'] = request_id
+        return response
+
+    return pipeline
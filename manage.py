@@ -1,14 +1,28 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+'''
+management commands, kept out of the serving path so workers do not
+import alembic or the loaders:
 
-from app import app
+    FLASK_APP=manage.py flask db upgrade
+    FLASK_APP=manage.py flask data seed --movies 100000 --actors 50000 --cast 3
+    FLASK_APP=manage.py flask data import movies.csv actors.ndjson
+
+`python manage.py ...` runs the same commands
+'''
+from flask.cli import FlaskGroup
+from flask_migrate import Migrate
+
+from app import app as application
+from cli import data
 from models import db
+from warmup import flask_app_of
 
+# the flask app also when SERVING_MODE=asgi made app.app an ASGI wrapper
+app = flask_app_of(application)
 migrate = Migrate(app, db)
-manager = Manager(app)
+app.cli.add_command(data)
 
-manager.add_command('db', MigrateCommand)
+cli = FlaskGroup(create_app=lambda: app)
 
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    cli()
@@ -0,0 +1,296 @@
+import contextvars
+import threading
+import time
+
+from flask import _request_ctx_stack, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from pool import Histogram
+
+
+# phases a request's time is split into, the rest is the view itself
+PHASES = ('auth', 'db', 'serialize')
+
+REQUEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+
+
+'''
+RequestTimer
+    the time one request spent in each of PHASES and the number of SQL
+    statements it ran, kept on the request context while it is served
+'''
+
+
+class RequestTimer:
+    __slots__ = ('start', 'phases', 'queries')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+
+    def server_timing(self, total):
+        '''Server-Timing header value, durations in milliseconds'''
+        parts = []
+        for name, seconds in self.phases.items():
+            part = f'{name};dur={seconds * 1000:.3f}'
+            if name == 'db':
+                part += f';desc="{self.queries} queries"'
+            parts.append(part)
+        parts.append(f'total;dur={total * 1000:.3f}')
+        return ', '.join(parts)
+
+
+# the RequestTimer of the request a native asgi endpoint is serving
+asgi_timer = contextvars.ContextVar('asgi_timer', default=None)
+
+
+def current_timer():
+    '''the RequestTimer of the request being served, None outside requests
+    or with REQUEST_METRICS off'''
+    top = _request_ctx_stack.top
+    if top is None:
+        return asgi_timer.get()
+    return getattr(top, 'timer', None)
+
+
+class phase:
+    '''context manager adding the time spent in its block to `name` of the
+    current request. a no-op outside requests (CLI, workers)'''
+    __slots__ = ('name', 'timer', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timer = current_timer()
+        if self.timer is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.phases[self.name] += time.perf_counter() - self.start
+
+
+'''
+SQL timing
+    listeners on every Engine (primary and replicas alike) time each cursor
+    execution and count it towards the request that issued it. statements
+    run outside a request are not looked at beyond the context check
+'''
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timer() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _stop_query(conn):
+    timer = current_timer()
+    starts = conn.info.get('query_start')
+    if timer is not None and starts:
+        timer.phases['db'] += time.perf_counter() - starts.pop()
+        timer.queries += 1
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _stop_query(conn)
+
+
+def _handle_error(exception_context):
+    # failed statements count too, after_cursor_execute is not called for them
+    if exception_context.connection is not None:
+        _stop_query(exception_context.connection)
+
+
+_listening = False
+_listen_lock = threading.Lock()
+
+
+def _listen_to_engines():
+    global _listening
+    with _listen_lock:
+        if _listening:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening = True
+
+
+'''
+RequestMetrics
+    per worker histograms of the requests served: total duration per
+    (route, method), time per (route, phase), SQL statements per route,
+    and a count of responses per (route, method, status). routes are url
+    rules ('/movies/<int:movie_id>'), so the number of series is bounded
+'''
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.phases = {}
+        self.queries = {}
+        self.responses = {}
+
+    def _histogram(self, series, key, buckets):
+        histogram = series.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = series.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def observe(self, route, method, status, timer, total):
+        self._histogram(self.durations, (route, method), REQUEST_BUCKETS).observe(total)
+        for name, seconds in timer.phases.items():
+            self._histogram(self.phases, (route, name), REQUEST_BUCKETS).observe(seconds)
+        self._histogram(self.queries, route, QUERY_BUCKETS).observe(timer.queries)
+        key = (route, method, status)
+        with self._lock:
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+    def stats(self):
+        '''json friendly summary: per route and method the count, mean and
+        max duration and mean statements per request'''
+        with self._lock:
+            durations = list(self.durations.items())
+            queries = dict(self.queries)
+        stats = {}
+        for (route, method), histogram in durations:
+            snapshot = histogram.snapshot()
+            query_snapshot = queries[route].snapshot()
+            stats[f'{method} {route}'] = {
+                'count': snapshot['count'],
+                'mean_seconds': snapshot['sum'] / snapshot['count'] if snapshot['count'] else 0.0,
+                'max_seconds': snapshot['max'],
+                'queries_mean': (query_snapshot['sum'] / query_snapshot['count']
+                                 if query_snapshot['count'] else 0.0),
+            }
+        return stats
+
+    def prometheus(self, prefix='capstone'):
+        with self._lock:
+            durations = sorted(self.durations.items())
+            phases = sorted(self.phases.items())
+            queries = sorted(self.queries.items())
+            responses = sorted(self.responses.items())
+        lines = []
+        lines += histogram_lines(
+            f'{prefix}_request_duration_seconds', 'Time to serve a request.',
+            [({'route': route, 'method': method}, histogram.snapshot())
+             for (route, method), histogram in durations])
+        lines += histogram_lines(
+            f'{prefix}_request_phase_seconds', 'Time a request spent in auth, db or serialize.',
+            [({'route': route, 'phase': name}, histogram.snapshot())
+             for (route, name), histogram in phases])
+        lines += histogram_lines(
+            f'{prefix}_request_queries', 'SQL statements run by a request.',
+            [({'route': route}, histogram.snapshot()) for route, histogram in queries])
+        lines += [f'# HELP {prefix}_responses_total Responses sent.',
+                  f'# TYPE {prefix}_responses_total counter']
+        for (route, method, status), count in responses:
+            labels = _labels({'route': route, 'method': method, 'status': status})
+            lines.append(f'{prefix}_responses_total{labels} {count}')
+        return lines
+
+
+'''
+Prometheus text format
+    histogram_lines renders Histogram snapshots, gauge_lines the numeric
+    values of a stats() dict (nested dicts are flattened, Histogram
+    snapshots become histograms, anything else is skipped)
+'''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def histogram_lines(name, help_text, series):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for labels, snapshot in series:
+        for bound, count in snapshot['buckets']:
+            lines.append(f'{name}_bucket{_labels({**labels, "le": _number(bound)})} {count}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(snapshot["sum"])}')
+        lines.append(f'{name}_count{_labels(labels)} {snapshot["count"]}')
+    return lines
+
+
+def _is_snapshot(value):
+    return isinstance(value, dict) and 'buckets' in value and 'count' in value
+
+
+def gauge_lines(prefix, stats):
+    lines = []
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if _is_snapshot(value):
+            lines += histogram_lines(name, key.replace('_', ' ') + '.', [({}, value)])
+        elif isinstance(value, dict):
+            lines += gauge_lines(name, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines += [f'# TYPE {name} gauge', f'{name} {_number(value)}']
+    return lines
+
+
+def prometheus_text(sections, request_metrics=None, prefix='capstone'):
+    '''the exposition text for {section: stats()} and the request metrics'''
+    lines = []
+    if request_metrics is not None:
+        lines += request_metrics.prometheus(prefix)
+    for section, stats in sections.items():
+        lines += gauge_lines(f'{prefix}_{section}', stats)
+    return '\n'.join(lines) + '\n'
+
+
+'''
+init_metrics(app)
+    times every request of the app when REQUEST_METRICS is on: the phases
+    go to the Server-Timing header (unless SERVER_TIMING is off) and to the
+    RequestMetrics in app.extensions['request_metrics']. the time of a
+    streamed body (the export endpoints) is not included
+'''
+
+
+def init_metrics(app):
+    if not app.config['REQUEST_METRICS']:
+        app.extensions['request_metrics'] = None
+        return None
+    request_metrics = app.extensions['request_metrics'] = RequestMetrics()
+    server_timing = app.config['SERVER_TIMING']
+    _listen_to_engines()
+
+    @app.before_request
+    def start_timer():
+        _request_ctx_stack.top.timer = RequestTimer()
+
+    @app.after_request
+    def record_timer(response):
+        timer = current_timer()
+        if timer is None:
+            return response
+        total = time.perf_counter() - timer.start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_metrics.observe(route, request.method, response.status_code, timer, total)
+        if server_timing:
+            response.headers['Server-Timing'] = timer.server_timing(total)
+        return response
+
+    return request_metrics
@@ -0,0 +1,36 @@
+"""Collection versions for conditional GET
+
+Revision ID: 4c1d2e7f9a10
+Revises: 82a03c6faa9b
+Create Date: 2026-10-18 10:12:41.204118
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1d2e7f9a10'
+down_revision = '82a03c6faa9b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    collection_versions = op.create_table('collection_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(collection_versions, [
+        {'name': 'movies', 'version': 1, 'updated_at': now},
+        {'name': 'actors', 'version': 1, 'updated_at': now},
+    ])
+
+
+def downgrade():
+    op.drop_table('collection_versions')
@@ -0,0 +1,32 @@
+"""Movie actors casting association
+
+Revision ID: 9e3b5a7c2d41
+Revises: 4c1d2e7f9a10
+Create Date: 2026-10-18 11:02:17.661394
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e3b5a7c2d41'
+down_revision = '4c1d2e7f9a10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movie_actors',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_movie_actors_actor_id_movie_id', 'movie_actors', ['actor_id', 'movie_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_movie_actors_actor_id_movie_id', table_name='movie_actors')
+    op.drop_table('movie_actors')
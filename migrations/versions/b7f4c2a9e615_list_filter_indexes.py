@@ -0,0 +1,38 @@
+"""Indexes for list filters and sort orders
+
+Revision ID: b7f4c2a9e615
+Revises: 9e3b5a7c2d41
+Create Date: 2026-10-18 12:26:53.118027
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7f4c2a9e615'
+down_revision = '9e3b5a7c2d41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # (column, id) btrees serve both the range filters and the keyset pages
+    # of ?sort=column. text_pattern_ops serves `LIKE 'prefix%'` regardless
+    # of the database collation, but cannot serve ORDER BY title, hence both
+    op.create_index('ix_movies_title_id', 'movies', ['title', 'id'], unique=False)
+    op.create_index('ix_movies_title_pattern', 'movies', ['title'], unique=False, postgresql_ops={'title': 'text_pattern_ops'})
+    op.create_index('ix_movies_release_date_id', 'movies', ['release_date', 'id'], unique=False)
+    op.create_index('ix_actors_name_id', 'actors', ['name', 'id'], unique=False)
+    op.create_index('ix_actors_name_pattern', 'actors', ['name'], unique=False, postgresql_ops={'name': 'text_pattern_ops'})
+    op.create_index('ix_actors_age_id', 'actors', ['age', 'id'], unique=False)
+    op.create_index('ix_actors_gender_id', 'actors', ['gender', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_id', table_name='actors')
+    op.drop_index('ix_actors_age_id', table_name='actors')
+    op.drop_index('ix_actors_name_pattern', table_name='actors')
+    op.drop_index('ix_actors_name_id', table_name='actors')
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    op.drop_index('ix_movies_title_pattern', table_name='movies')
+    op.drop_index('ix_movies_title_id', table_name='movies')
@@ -0,0 +1,34 @@
+"""Trigram indexes for search
+
+Revision ID: d2a8e6f1c374
+Revises: b7f4c2a9e615
+Create Date: 2026-10-18 14:05:31.402611
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a8e6f1c374'
+down_revision = 'b7f4c2a9e615'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pg_trgm GIN indexes serve both `ILIKE '%q%'` and the `q <% column`
+    # fuzzy match of /search. other dialects search in process (search.py)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_movies_title_trgm', 'movies', ['title'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+    op.create_index('ix_actors_name_trgm', 'actors', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
@@ -0,0 +1,49 @@
+"""Stripe collection versions over slots
+
+Revision ID: e5c9a3f7b218
+Revises: d2a8e6f1c374
+Create Date: 2026-10-18 16:42:07.519334
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5c9a3f7b218'
+down_revision = 'd2a8e6f1c374'
+branch_labels = None
+depends_on = None
+
+
+def _replace_primary_key(batch_op, columns):
+    # sqlite's primary key has no name, the table copy of batch mode
+    # replaces it with the new one
+    if op.get_bind().dialect.name != 'sqlite':
+        batch_op.drop_constraint('collection_versions_pkey', type_='primary')
+    batch_op.create_primary_key('collection_versions_pkey', columns)
+
+
+def upgrade():
+    # the existing row of each collection becomes slot 0, the other slots
+    # are created by the first write that picks them (CollectionVersion.bump)
+    with op.batch_alter_table('collection_versions', recreate='auto') as batch_op:
+        batch_op.add_column(sa.Column('slot', sa.Integer(), nullable=False, server_default='0'))
+        _replace_primary_key(batch_op, ['name', 'slot'])
+
+
+def downgrade():
+    # fold the slots back into one row per collection, keeping the version
+    # (their sum) and the time of the last write
+    op.execute('UPDATE collection_versions SET '
+               'version = (SELECT sum(version) FROM collection_versions AS slots '
+               'WHERE slots.name = collection_versions.name), '
+               'updated_at = (SELECT max(updated_at) FROM collection_versions AS slots '
+               'WHERE slots.name = collection_versions.name) '
+               'WHERE slot = (SELECT min(slot) FROM collection_versions AS slots '
+               'WHERE slots.name = collection_versions.name)')
+    op.execute('DELETE FROM collection_versions WHERE slot <> (SELECT min(slot) '
+               'FROM collection_versions AS slots WHERE slots.name = collection_versions.name)')
+    with op.batch_alter_table('collection_versions', recreate='auto') as batch_op:
+        _replace_primary_key(batch_op, ['name'])
+        batch_op.drop_column('slot')
@@ -1,41 +1,350 @@
 import os
-from sqlalchemy import Column, String, Integer
+import random
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, BigInteger, DDL, ForeignKey, Index, Table, select, insert, update, delete, event, exc, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, relationship, sessionmaker
 from sqlalchemy.sql.sqltypes import DateTime
-from flask_sqlalchemy import SQLAlchemy
 import json
 
+from pool import PooledSQLAlchemy, pool_config_from_env
+from replicas import RoutingSession
 
-if "DATABASE_URL" in os.environ:
-    DATABASE_URL = os.environ.get('DATABASE_URL').replace('postgres://', 'postgresql://')
-else:
-    DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
 
+def database_url():
+    '''DATABASE_URL (as set by heroku, postgres:// fixed up) or
+    TEST_DATABASE_URL, read when the app is set up rather than at import'''
+    if "DATABASE_URL" in os.environ:
+        return os.environ.get('DATABASE_URL').replace('postgres://', 'postgresql://')
+    return os.environ.get('TEST_DATABASE_URL')
 
-database_path = DATABASE_URL
 
-db = SQLAlchemy()
+class CapstoneSQLAlchemy(PooledSQLAlchemy):
+    def create_session(self, options):
+        # reads of GET requests may go to a replica, see replicas.py
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = CapstoneSQLAlchemy()
 
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    the pool settings (DB_POOL_SIZE, ...) come from the environment, see
+    pool.py; values already in the app config are kept
 '''
 
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_path or database_url()
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    for name, value in pool_config_from_env().items():
+        app.config.setdefault(name, value)
     db.app = app
     db.init_app(app)
     # db.create_all()
     return db
 
-class Movie(db.Model):
+'''
+error_status(error)
+    the HTTP status for a SQLAlchemyError escaping a view: 422 when the
+    database refused the data (constraint violations, values it cannot
+    store), 503 when it is unreachable, timed out or the pool is
+    exhausted, 500 for anything else
+'''
+
+def error_status(error):
+    if isinstance(error, (exc.IntegrityError, exc.DataError)):
+        return 422
+    if isinstance(error, (exc.OperationalError, exc.TimeoutError, exc.DisconnectionError)):
+        return 503
+    if isinstance(error, exc.StatementError) and not isinstance(error, exc.DBAPIError):
+        # raised before reaching the database, e.g. a value of the wrong type
+        return 422
+    return 500
+
+
+'''
+on_collections_changed(listener)
+    registers listener(names), called after a commit with the names of the
+    collections (tables) that transaction wrote. used to invalidate caches
+    only once the new rows are visible to other sessions
+'''
+
+_change_listeners = []
+
+
+def on_collections_changed(listener):
+    _change_listeners.append(listener)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_collections_changed(session):
+    names = session.info.pop('changed_collections', None)
+    if names:
+        for listener in _change_listeners:
+            listener(names)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_collections_changed(session):
+    session.info.pop('changed_collections', None)
+
+
+'''
+CollectionVersion
+    version counter and time of the last write of a table, striped over
+    VERSION_SLOTS rows so concurrent writers rarely wait on the same row
+    lock. every write path of Movie and Actor bumps one slot, picked at
+    random, in the same transaction. the version is the sum of the slots,
+    so it grows by one with every committed write, and reading it is a
+    single primary key range scan (see conditional.py)
+
+    bumps are INSERT ... ON CONFLICT DO UPDATE on postgres and sqlite, the
+    first write to a slot creates its row without racing other writers
+'''
+
+VERSION_SLOTS = 8
+
+UPSERT_DIALECTS = {'postgresql': postgresql_insert, 'sqlite': sqlite_insert}
+
+
+class CollectionVersion(db.Model):
+    __tablename__ = 'collection_versions'
+
+    name = Column(String, primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    @classmethod
+    def bump(cls, name):
+        # part of the caller's transaction, the caller commits
+        table = cls.__table__
+        slot = random.randrange(VERSION_SLOTS)
+        now = datetime.utcnow()
+        upsert = UPSERT_DIALECTS.get(db.engine.dialect.name)
+        if upsert is not None:
+            statement = upsert(table).values(name=name, slot=slot, version=1, updated_at=now)
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.name, table.c.slot],
+                set_={'version': table.c.version + 1, 'updated_at': now}))
+        else:
+            result = db.session.execute(
+                update(table).where(table.c.name == name, table.c.slot == slot)
+                .values(version=table.c.version + 1, updated_at=now))
+            if result.rowcount == 0:
+                db.session.execute(
+                    insert(table).values(name=name, slot=slot, version=1, updated_at=now))
+        db.session.info.setdefault('changed_collections', set()).add(name)
+
+    @classmethod
+    def current(cls, name, session=None):
+        '''(version, updated_at) of a collection, (0, None) if never written'''
+        table = cls.__table__
+        session = session if session is not None else db.session
+        version, updated_at = session.execute(
+            select(func.sum(table.c.version), func.max(table.c.updated_at))
+            .where(table.c.name == name)).one()
+        return (int(version), updated_at) if version is not None else (0, None)
+
+
+'''
+WriteMixin
+    statement level writes that skip loading ORM objects.
+
+    update_returning / delete_returning change a single row with one
+    UPDATE/DELETE ... RETURNING and hand back the affected row, or None when
+    no row has that id. dialects without RETURNING (sqlite on SQLAlchemy 1.4)
+    fall back to checking the rowcount.
+
+    the bulk_* methods write a batch in a single transaction, rows are
+    plain column dicts that have already been validated (see bulk.py)
+
+    every write bumps the table's CollectionVersion before committing.
+    deletes also bump the collections listed in related_collections, whose
+    embedded data changes when casting rows cascade away
+'''
+
+class WriteMixin:
+    related_collections = ()
+
+    @classmethod
+    def bump_version(cls, related=False):
+        names = {cls.__tablename__, *(cls.related_collections if related else ())}
+        # one lock order for every writer, movies and actors writes touching
+        # both collections cannot deadlock on each other's slots
+        for name in sorted(names):
+            CollectionVersion.bump(name)
+
+    @classmethod
+    def _supports_returning(cls):
+        return db.engine.dialect.full_returning
+
+    @classmethod
+    def update_returning(cls, id, values):
+        table = cls.__table__
+        statement = update(table).where(table.c.id == id).values(**values)
+        try:
+            if cls._supports_returning():
+                row = db.session.execute(statement.returning(*table.c)).first()
+            else:
+                row = None
+                if db.session.execute(statement).rowcount:
+                    row = db.session.execute(
+                        select(table).where(table.c.id == id)).first()
+            if row is not None:
+                cls.bump_version()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return dict(row._mapping) if row is not None else None
+
+    @classmethod
+    def delete_returning(cls, id):
+        table = cls.__table__
+        statement = delete(table).where(table.c.id == id)
+        try:
+            if cls._supports_returning():
+                deleted = db.session.execute(
+                    statement.returning(table.c.id)).scalar()
+            else:
+                deleted = id if db.session.execute(statement).rowcount else None
+            if deleted is not None:
+                cls.bump_version(related=True)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return deleted
+
+    @classmethod
+    def existing_ids(cls, ids, session=None):
+        session = session if session is not None else db.session
+        rows = session.execute(select(cls.id).where(cls.id.in_(ids)))
+        return set(rows.scalars())
+
+    @classmethod
+    def _insert_rows(cls, rows):
+        table = cls.__table__
+        dialect = db.engine.dialect
+        if dialect.insert_executemany_returning:
+            # psycopg2 with executemany_mode='values_plus_batch' (see
+            # pool.py): multi-row INSERT ... VALUES ... RETURNING id pages
+            return db.session.execute(insert(table).returning(table.c.id), rows).scalars().all()
+        if dialect.name == 'sqlite':
+            # one executemany. sqlite gives each new row of a rowid table
+            # max(id) + 1 and holds the write lock until commit, so the rows
+            # got the last len(rows) ids
+            db.session.execute(insert(table), rows)
+            last = db.session.execute(select(func.max(table.c.id))).scalar()
+            return list(range(last - len(rows) + 1, last + 1))
+        # no batched way to learn the ids: one INSERT per row
+        db.session.bulk_insert_mappings(cls, rows, return_defaults=True)
+        return [row['id'] for row in rows]
+
+    @classmethod
+    def bulk_insert(cls, rows):
+        try:
+            ids = cls._insert_rows(rows)
+            cls.bump_version()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @classmethod
+    def bulk_update(cls, rows):
+        try:
+            found = cls.existing_ids([row['id'] for row in rows])
+            db.session.bulk_update_mappings(
+                cls, [row for row in rows if row['id'] in found])
+            if found:
+                cls.bump_version()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return found
+
+    @classmethod
+    def bulk_delete(cls, ids):
+        try:
+            found = cls.existing_ids(ids)
+            db.session.execute(delete(cls).where(cls.id.in_(found)))
+            if found:
+                cls.bump_version(related=True)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return found
+
+
+'''
+movie_actors
+    casting association between movies and actors. the primary key
+    (movie_id, actor_id) serves movie -> actors lookups and
+    ix_movie_actors_actor_id_movie_id serves actor -> movies, both as
+    index only scans. rows go away with their movie or actor (on delete cascade)
+'''
+
+movie_actors = Table(
+    'movie_actors', db.metadata,
+    Column('movie_id', Integer, ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer, ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_movie_actors_actor_id_movie_id', 'actor_id', 'movie_id'),
+)
+
+
+'''
+related_rows(owner_column, table, ids, session=None)
+    batched loading of casting data, the column level equivalent of
+    selectinload: one IN query for a whole page of owners.
+    owner_column is movie_actors.c.movie_id to load the actors of movies
+    `ids`, or movie_actors.c.actor_id to load the movies of actors `ids`.
+    returns {owner id: [rows of table ordered by id]}.
+    session defaults to db.session
+'''
+
+def related_rows(owner_column, table, ids, session=None):
+    other_column = (movie_actors.c.actor_id if owner_column is movie_actors.c.movie_id
+                    else movie_actors.c.movie_id)
+    related = {owner_id: [] for owner_id in ids}
+    if not ids:
+        return related
+
+    session = session if session is not None else db.session
+    rows = session.execute(
+        select(owner_column, *table.c)
+        .join(table, table.c.id == other_column)
+        .where(owner_column.in_(ids))
+        .order_by(owner_column, table.c.id))
+    for row in rows:
+        related[row[0]].append(row[1:])
+    return related
+
+
+class Movie(WriteMixin, db.Model):
     __tablename__ = 'movies'
+    # (column, id) indexes back the sorted keyset pages and range filters,
+    # the text_pattern_ops one the title prefix filter (see filters.py)
+    __table_args__ = (
+        Index('ix_movies_title_id', 'title', 'id'),
+        Index('ix_movies_title_pattern', 'title', postgresql_ops={'title': 'text_pattern_ops'}),
+        Index('ix_movies_release_date_id', 'release_date', 'id'),
+    )
+    related_collections = ('actors',)
 
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(DateTime)
+    actors = relationship('Actor', secondary=movie_actors, back_populates='movies',
+                          order_by='Actor.id', passive_deletes=True)
 
     def __init__(self, title, release_date):
         self.title = title
@@ -43,15 +352,56 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        self.bump_version()
         db.session.commit()
 
     def update(self):
+        self.bump_version()
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        self.bump_version(related=True)
         db.session.commit()
 
+    @classmethod
+    def add_cast(cls, movie_id, actor_ids):
+        '''casts actors `actor_ids` in movie `movie_id`, existing pairs are
+        kept. returns False when the movie or any of the actors does not exist'''
+        try:
+            if not cls.existing_ids([movie_id]):
+                return False
+            if len(Actor.existing_ids(actor_ids)) != len(set(actor_ids)):
+                return False
+            cast = set(db.session.execute(
+                select(movie_actors.c.actor_id)
+                .where(movie_actors.c.movie_id == movie_id)).scalars())
+            new = [{'movie_id': movie_id, 'actor_id': actor_id}
+                   for actor_id in set(actor_ids) - cast]
+            if new:
+                db.session.execute(insert(movie_actors), new)
+                cls.bump_version(related=True)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+
+    @classmethod
+    def remove_cast(cls, movie_id, actor_id):
+        '''returns False when the actor was not cast in the movie'''
+        try:
+            result = db.session.execute(
+                delete(movie_actors).where(movie_actors.c.movie_id == movie_id,
+                                           movie_actors.c.actor_id == actor_id))
+            if result.rowcount:
+                cls.bump_version(related=True)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return bool(result.rowcount)
+
     def format(self):
         return {
             'id': self.id,
@@ -59,13 +409,22 @@ class Movie(db.Model):
             'release_date': self.release_date
         }
 
-class Actor(db.Model):
+class Actor(WriteMixin, db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        Index('ix_actors_name_id', 'name', 'id'),
+        Index('ix_actors_name_pattern', 'name', postgresql_ops={'name': 'text_pattern_ops'}),
+        Index('ix_actors_age_id', 'age', 'id'),
+        Index('ix_actors_gender_id', 'gender', 'id'),
+    )
+    related_collections = ('movies',)
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
+    movies = relationship('Movie', secondary=movie_actors, back_populates='actors',
+                          order_by='Movie.id', passive_deletes=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -74,13 +433,16 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        self.bump_version()
         db.session.commit()
 
     def update(self):
+        self.bump_version()
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        self.bump_version(related=True)
         db.session.commit()
 
     def format(self):
@@ -91,5 +453,18 @@ class Actor(db.Model):
             'gender': self.gender
         }
 
-    
 
+'''
+trigram GIN indexes behind /search (see search.py), postgres only: other
+dialects search through an in-process index. the migration
+search_trigram_indexes creates the same objects on existing databases
+'''
+
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+event.listen(Movie.__table__, 'after_create',
+             DDL('CREATE INDEX ix_movies_title_trgm ON movies USING gin (title gin_trgm_ops)')
+             .execute_if(dialect='postgresql'))
+event.listen(Actor.__table__, 'after_create',
+             DDL('CREATE INDEX ix_actors_name_trgm ON actors USING gin (name gin_trgm_ops)')
+             .execute_if(dialect='postgresql'))
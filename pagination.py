@@ -0,0 +1,167 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy.sql.sqltypes import DateTime
+
+
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+
+
+'''
+Cursor
+    position after the last row of the previous page: its id and, when the
+    list is sorted on another column, the sort name and that row's value
+'''
+
+Cursor = namedtuple('Cursor', 'id sort value')
+
+
+'''
+SortOrder
+    the order of a list: `column` ascending or descending, ties broken by id
+    in the same direction. nulls sort last ascending and first descending
+'''
+
+SortOrder = namedtuple('SortOrder', 'name column descending')
+
+
+'''
+encode_cursor(last_id, sort=None, value=None) / decode_cursor(cursor)
+    cursors are opaque to clients: url safe base64 of a small json document
+    holding the id (and sort value) of the last row of the previous page
+'''
+
+
+def encode_cursor(last_id, sort=None, value=None):
+    document = {'id': last_id}
+    if sort is not None:
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        document.update(s=sort, v=value)
+    raw = json.dumps(document, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        document = json.loads(base64.urlsafe_b64decode(padded))
+        last_id, sort, value = document['id'], document.get('s'), document.get('v')
+    except (binascii.Error, ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError(f'invalid cursor {cursor!r}')
+    # json booleans are ints to python, and values are scalars only
+    if (not isinstance(last_id, int) or isinstance(last_id, bool)
+            or not isinstance(sort, (str, type(None)))
+            or not isinstance(value, (str, int, float, type(None))) or isinstance(value, bool)):
+        raise ValueError(f'invalid cursor {cursor!r}')
+    return Cursor(last_id, sort, value)
+
+
+'''
+page_args(args)
+    reads `cursor` and `limit` from the query string, aborts with 400 when
+    either is malformed. limit defaults to DEFAULT_PAGE_LIMIT and is capped
+    at MAX_PAGE_LIMIT
+'''
+
+
+def page_args(args):
+    cursor = args.get('cursor')
+    limit = args.get('limit', DEFAULT_PAGE_LIMIT)
+
+    try:
+        cursor = decode_cursor(cursor) if cursor else None
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+
+    if limit < 1:
+        abort(400)
+
+    return cursor, min(limit, MAX_PAGE_LIMIT)
+
+
+def _cursor_value(column, value):
+    '''the cursor's sort value as the python type of `column`, aborts with
+    400 when the value could not have been encoded from that column'''
+    if value is None:
+        return None
+    try:
+        if isinstance(column.type, DateTime):
+            return datetime.fromisoformat(value)
+        if isinstance(value, column.type.python_type):
+            return value
+    except (TypeError, ValueError, NotImplementedError):
+        pass
+    abort(400)
+
+
+def _after(id_column, order, cursor):
+    column, descending = order.column, order.descending
+    if column is id_column:
+        return id_column < cursor.id if descending else id_column > cursor.id
+
+    value = _cursor_value(column, cursor.value)
+
+    # row value comparison, so postgres walks the (column, id) index as a
+    # single range. nulls are outside the comparison and handled explicitly
+    if value is None:
+        id_after = id_column < cursor.id if descending else id_column > cursor.id
+        null_tail = and_(column.is_(None), id_after)
+        return or_(null_tail, column.isnot(None)) if descending else null_tail
+    if descending:
+        return tuple_(column, id_column) < tuple_(value, cursor.id)
+    return or_(tuple_(column, id_column) > tuple_(value, cursor.id),
+               column.is_(None))
+
+
+def order_by_clauses(id_column, order):
+    if order.column is id_column:
+        return [id_column.desc() if order.descending else id_column.asc()]
+    if order.descending:
+        return [order.column.desc().nullsfirst(), id_column.desc()]
+    return [order.column.asc().nullslast(), id_column.asc()]
+
+
+def cursor_sort(id_column, order):
+    '''the sort name stored in cursors for `order`, None for the default'''
+    if order.column is id_column and not order.descending:
+        return None
+    return order.name
+
+
+'''
+keyset_page(session, statement, id_column, cursor, limit, order=None)
+    returns (rows, next_cursor) for the page of the select `statement` that
+    follows `cursor`, in `order` (a SortOrder, by id ascending by default).
+
+    paging uses `(column, id) > (value, last id) ... LIMIT limit + 1` rather
+    than OFFSET, so every page is an index range scan of limit + 1 rows no
+    matter how deep it is. next_cursor is None on the last page. callers
+    check that the cursor was issued for `order` (see ListSpec.parse)
+'''
+
+
+def keyset_page(session, statement, id_column, cursor, limit, order=None):
+    if order is None:
+        order = SortOrder('id', id_column, False)
+    sort = cursor_sort(id_column, order)
+
+    if cursor is not None:
+        statement = statement.where(_after(id_column, order, cursor))
+    statement = statement.order_by(*order_by_clauses(id_column, order))
+    rows = session.execute(statement.limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        value = last._mapping[order.column.key] if sort is not None else None
+        next_cursor = encode_cursor(last.id, sort, value)
+    return rows, next_cursor
@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+'''
+engine configuration, read from the environment by setup_db and overridable
+through the app config:
+
+    DB_POOL_SIZE              connections kept open per worker process
+    DB_MAX_OVERFLOW           extra connections opened under load and closed
+                              when returned
+    DB_POOL_TIMEOUT           seconds a request waits for a connection
+                              before failing
+    DB_POOL_RECYCLE           seconds after which a connection is replaced,
+                              below the server / load balancer idle timeout
+    DB_POOL_PRE_PING          test connections on checkout, a dead one is
+                              replaced instead of failing the request
+    DB_STATEMENT_TIMEOUT_MS   postgres statement_timeout of every session,
+                              0 to disable
+
+pool sizing only applies to server databases, sqlite keeps the pool
+flask-sqlalchemy picks for it. SQLALCHEMY_ENGINE_OPTIONS still takes
+precedence over all of these
+'''
+
+POOL_DEFAULTS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    'DB_STATEMENT_TIMEOUT_MS': 0,
+}
+
+
+def pool_config_from_env(environ=os.environ):
+    config = {}
+    for name, default in POOL_DEFAULTS.items():
+        value = environ.get(name)
+        if value is None:
+            config[name] = default
+        elif isinstance(default, bool):
+            config[name] = value.lower() not in ('0', 'false', 'no')
+        else:
+            config[name] = int(value)
+    return config
+
+
+def pool_options(config, sa_url, options):
+    '''create_engine options for the DB_* settings in config'''
+    options = dict(options)
+    options.setdefault('pool_pre_ping', config['DB_POOL_PRE_PING'])
+    if sa_url.get_backend_name() == 'sqlite':
+        return options
+
+    if sa_url.get_driver_name() == 'psycopg2':
+        # inserts run as multi-row INSERT ... VALUES pages, RETURNING
+        # included (see WriteMixin.bulk_insert), and other executemany
+        # statements (bulk updates) as execute_batch pages
+        options.setdefault('executemany_mode', 'values_plus_batch')
+
+    options.setdefault('poolclass', TimedQueuePool)
+    options.setdefault('pool_size', config['DB_POOL_SIZE'])
+    options.setdefault('max_overflow', config['DB_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', config['DB_POOL_TIMEOUT'])
+    options.setdefault('pool_recycle', config['DB_POOL_RECYCLE'])
+    if config['DB_STATEMENT_TIMEOUT_MS'] and sa_url.get_backend_name() == 'postgresql':
+        connect_args = dict(options.get('connect_args', {}))
+        connect_args['options'] = ' '.join(filter(None, [
+            connect_args.get('options'),
+            f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"]))
+        options['connect_args'] = connect_args
+    return options
+
+
+'''
+Histogram(buckets)
+    thread safe counts of observations per upper bound, plus count, sum
+    and max. buckets are upper bounds in seconds
+'''
+
+CHECKOUT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=CHECKOUT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    def snapshot(self):
+        '''{'buckets': [(upper bound, cumulative count)], 'count', 'sum', 'max'}'''
+        with self._lock:
+            counts = list(self._counts)
+            snapshot = {'count': self._count, 'sum': self._sum, 'max': self._max}
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            cumulative.append((bound, total))
+        snapshot['buckets'] = cumulative
+        return snapshot
+
+
+'''
+TimedQueuePool
+    QueuePool recording how long each checkout took (waiting for a free
+    connection, opening a new one and the pre-ping included), how many
+    checkouts are waiting right now and how many timed out. the metrics
+    survive the pool being recreated on dispose or after a fork
+'''
+
+
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_seconds = Histogram()
+        self.timeouts = 0
+        self.waiting = 0
+        self._metrics_lock = threading.Lock()
+
+    def connect(self):
+        with self._metrics_lock:
+            self.waiting += 1
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            self.checkout_seconds.observe(time.perf_counter() - start)
+            with self._metrics_lock:
+                self.waiting -= 1
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.checkout_seconds = self.checkout_seconds
+        pool.timeouts = self.timeouts
+        return pool
+
+    def stats(self):
+        capacity = self.size() + max(self._max_overflow, 0)
+        checked_out = self.checkedout()
+        return {
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': checked_out,
+            'idle': self.checkedin(),
+            'waiting': self.waiting,
+            'timeouts': self.timeouts,
+            'saturation': checked_out / capacity if capacity else 0.0,
+            'checkout_seconds': self.checkout_seconds.snapshot(),
+        }
+
+
+def pool_stats(engine):
+    '''metrics of the engine's pool, only the pool class for pools that are
+    not a TimedQueuePool (sqlite)'''
+    pool = engine.pool
+    if isinstance(pool, TimedQueuePool):
+        return pool.stats()
+    return {'pool': type(pool).__name__}
+
+
+'''
+fork safety
+
+connections opened before a fork (gunicorn --preload, or a master that
+touched the database) are shared with every worker, and two processes
+talking over one socket corrupt each other's sessions. after a fork each
+engine gets a fresh pool in the child. the inherited connections are only
+dereferenced, never closed, since closing them would end the parent's
+sessions. checkout also refuses a connection opened in another process, for
+the ones checked out across the fork
+'''
+
+_engines = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for engine in list(_engines):
+        # what engine.dispose() does, minus closing the parent's connections
+        engine.pool = engine.pool.recreate()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _guard_process(engine):
+    @event.listens_for(engine, 'connect')
+    def remember_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get('pid', os.getpid()) != os.getpid():
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(
+                'connection opened in process %s checked out in process %s'
+                % (connection_record.info['pid'], os.getpid()))
+
+
+'''
+PooledSQLAlchemy
+    flask-sqlalchemy with the DB_* pool settings applied when the engine is
+    created (so they match the final SQLALCHEMY_DATABASE_URI) and with its
+    engines made fork safe
+'''
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        return sa_url, pool_options(app.config, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        _guard_process(engine)
+        _engines.add(engine)
+        return engine
@@ -0,0 +1,311 @@
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.wsgi import ClosingIterator
+
+from cache import FakeSharedClient
+
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+'''
+parse_rate(spec)
+    '<n>/<s|m|h>' to (tokens per second, capacity): a bucket of n tokens
+    refilled at n per period, so a client may burst n requests and then
+    sustain n per period. None for 'off'
+'''
+
+
+def parse_rate(spec):
+    if spec is None or isinstance(spec, tuple):
+        return spec
+    spec = spec.strip()
+    if spec == 'off':
+        return None
+    try:
+        count, period = spec.split('/')
+        count = int(count)
+        seconds = PERIODS[period.strip()]
+    except (KeyError, ValueError):
+        raise ValueError(f'invalid rate {spec!r}, expected e.g. 20/s or 100/m')
+    if count <= 0:
+        raise ValueError(f'invalid rate {spec!r}, the count must be positive')
+    return count / seconds, count
+
+
+def parse_rates(value):
+    '''RATE_LIMITS, 'post:movies=5/s,get:actors=100/m' or a dict, to
+    {permission: (tokens per second, capacity) or None}'''
+    if isinstance(value, dict):
+        items = value.items()
+    else:
+        items = []
+        for item in (value or '').split(','):
+            if not item.strip():
+                continue
+            if '=' not in item:
+                raise ValueError(f'invalid rate limit {item.strip()!r}, expected '
+                                 f'<permission>=<rate>, e.g. post:movies=5/s')
+            items.append(item.split('=', 1))
+    return {name.strip(): parse_rate(spec) for name, spec in items}
+
+
+'''
+take(state, rate, capacity, now, cost=1)
+    the token bucket: refills `state` ([tokens, updated_at], or None for a
+    full bucket) for the time since it was last updated and takes `cost`
+    tokens if there are enough. returns (new state, seconds to wait), 0
+    when the request is allowed
+'''
+
+
+def take(state, rate, capacity, now, cost=1):
+    if state is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, state[0] + (now - state[1]) * rate)
+    if tokens >= cost:
+        return [tokens - cost, now], 0
+    return [tokens, now], (cost - tokens) / rate
+
+
+'''
+MemoryBucketStore(maxsize)
+    token buckets in process memory. each worker limits on its own, so the
+    effective limit is the configured one times the number of workers.
+    buckets idle the longest are dropped past maxsize; a dropped bucket
+    was idle long enough to be full again anyway
+'''
+
+
+class MemoryBucketStore:
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            state, wait = take(self._buckets.get(key), rate, capacity, now, cost)
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {'buckets': len(self._buckets)}
+
+
+'''
+SharedBucketStore(client, prefix='capstone:rl:')
+    token buckets shared by all workers. `client` needs the redis-py
+    register_script(lua); the bucket is updated atomically on the server by
+    TOKEN_BUCKET_LUA, with the time taken from the server so worker clocks
+    do not matter. keys expire once a bucket would be full again
+'''
+
+TOKEN_BUCKET_LUA = '''
+local rate, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = capacity
+if state[1] then
+  tokens = math.min(capacity, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+end
+local wait = 0
+if tokens >= cost then
+  tokens = tokens - cost
+else
+  wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+'''
+
+
+class SharedBucketStore:
+    def __init__(self, client, prefix='capstone:rl:'):
+        self.prefix = prefix
+        self._script = client.register_script(TOKEN_BUCKET_LUA)
+
+    def take(self, key, rate, capacity, cost=1):
+        wait = self._script(keys=[self.prefix + key], args=[rate, capacity, cost])
+        return float(wait.decode() if isinstance(wait, bytes) else wait)
+
+    def stats(self):
+        return {}
+
+
+'''
+FakeRateLimitClient
+    FakeSharedClient that also runs TOKEN_BUCKET_LUA, by executing the same
+    algorithm (take) in python, for tests and local runs of the shared store
+'''
+
+
+class FakeRateLimitClient(FakeSharedClient):
+    def register_script(self, script):
+        if script != TOKEN_BUCKET_LUA:
+            raise ValueError('FakeRateLimitClient only runs TOKEN_BUCKET_LUA, not '
+                             f'{script.strip().splitlines()[0]!r}...')
+
+        def run(keys, args):
+            rate, capacity, cost = (float(arg) for arg in args)
+            now = time.monotonic()
+            with self._lock:
+                entry = self._data.get(keys[0])
+                state = json.loads(entry[0]) if entry is not None else None
+                state, wait = take(state, rate, capacity, now, cost)
+                self._data[keys[0]] = (json.dumps(state).encode(), None)
+            return str(wait).encode()
+
+        return run
+
+
+'''
+RateLimiter(default, limits, store)
+    limits each subject (the token's sub) per permission rule of the
+    endpoint it calls: `limits` maps a rule name (see rule_name) to a
+    parsed rate, any other rule gets `default`. a rate of None is
+    unlimited. check() raises TooManyRequests with Retry-After when the
+    subject's bucket is empty. called by requires_auth once the token is
+    verified, through app.extensions['rate_limiter']
+'''
+
+
+def rule_name(rule):
+    ''''post:movies' for a single permission, 'get:actors|get:movies' for
+    any_of rules, permissions that are all required are joined with +'''
+    name = '+'.join(sorted(rule.all_of))
+    if rule.any_of:
+        name = '+'.join(filter(None, [name, '|'.join(sorted(rule.any_of))]))
+    return name
+
+
+class RateLimiter:
+    def __init__(self, default, limits=None, store=None):
+        self.default = default
+        self.limits = limits or {}
+        self.store = store or MemoryBucketStore()
+        self._names = {}
+        self._lock = threading.Lock()
+        self._stats = {'allowed': 0, 'limited': 0}
+
+    def rate_for(self, name):
+        return self.limits.get(name, self.default)
+
+    def check(self, subject, rule):
+        name = self._names.get(rule)
+        if name is None:
+            name = self._names[rule] = rule_name(rule)
+        rate = self.rate_for(name)
+        if rate is None:
+            return
+        wait = self.store.take(f'{subject}:{name}', *rate)
+        with self._lock:
+            self._stats['limited' if wait else 'allowed'] += 1
+        if wait:
+            raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(self.store.stats())
+        return stats
+
+
+'''
+LoadShedder(wsgi_app, max_in_flight)
+    WSGI middleware answering 503 with Retry-After right away, before
+    routing, auth or any database work, while max_in_flight requests are
+    being served by this process. a request counts until its response body
+    is closed, so streamed exports count for their whole duration. only
+    useful with workers that serve several requests at a time (gthread,
+    or uvicorn with SERVING_MODE=asgi, whose native endpoints are counted
+    with admit() and release())
+'''
+
+
+class LoadShedder:
+    body = json.dumps({'success': False, 'error': 503, 'message': 'Service Unavailable'}).encode()
+
+    def __init__(self, wsgi_app, max_in_flight, retry_after=1):
+        self.wsgi_app = wsgi_app
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        '''counts a request in, False when it must be shed. admitted
+        requests are counted out with release()'''
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def __call__(self, environ, start_response):
+        if not self.admit():
+            start_response('503 SERVICE UNAVAILABLE', [
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(self.body))),
+                ('Retry-After', str(self.retry_after)),
+                ('Access-Control-Allow-Origin', '*'),
+            ])
+            return [self.body]
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), self.release)
+        except BaseException:
+            self.release()
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight,
+                    'shed': self.shed}
+
+
+'''
+init_rate_limits(app)
+    RATE_LIMIT_DEFAULT ('off', or e.g. '50/s') and RATE_LIMITS (overrides
+    per rule) configure app.extensions['rate_limiter'], in the store
+    RATE_LIMIT_STORE: 'memory' or a store instance (e.g.
+    SharedBucketStore(redis_client)). MAX_IN_FLIGHT > 0 wraps the app in a
+    LoadShedder, app.extensions['load_shedder']
+'''
+
+
+def init_rate_limits(app):
+    config = app.config
+    default = parse_rate(config['RATE_LIMIT_DEFAULT'])
+    limits = parse_rates(config['RATE_LIMITS'])
+    limiter = None
+    if default is not None or any(rate is not None for rate in limits.values()):
+        store = config.get('RATE_LIMIT_STORE', 'memory')
+        if store == 'memory':
+            store = MemoryBucketStore()
+        limiter = RateLimiter(default, limits, store)
+    app.extensions['rate_limiter'] = limiter
+
+    shedder = None
+    if config['MAX_IN_FLIGHT'] > 0:
+        shedder = app.wsgi_app = LoadShedder(app.wsgi_app, config['MAX_IN_FLIGHT'])
+    app.extensions['load_shedder'] = shedder
+    return limiter, shedder
@@ -0,0 +1,189 @@
+import itertools
+import threading
+import time
+
+from flask import _request_ctx_stack, current_app, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+
+READ_METHODS = ('GET', 'HEAD')
+# request.environ key of the replica a request reads from
+PINNED = 'capstone.replica'
+
+
+'''
+Replica
+    one read replica: its flask-sqlalchemy bind key, the requests currently
+    reading from it in this worker, and its health. a replica is probed with
+    SELECT 1 before its first use. it is marked down when the probe or a
+    connection to it fails, and probed again once every health_interval
+    seconds until it answers. a request already reading from a replica that
+    goes down fails, the following ones use the others
+'''
+
+
+class Replica:
+    def __init__(self, key):
+        self.key = key
+        self.in_flight = 0
+        self.healthy = None
+        self.retry_at = 0.0
+
+
+'''
+ReplicaRouter(db, app, urls, sticky_backend, sticky_seconds=5, health_interval=10)
+    picks the database of read only requests.
+
+    GET and HEAD requests read from the least loaded healthy replica (fewest
+    requests in flight in this worker, ties round robin) and stay on it
+    for the whole request. everything else, any DML and any flush, goes to
+    the primary. so does every request of a client that wrote within the
+    last sticky_seconds, so clients read their own writes despite
+    replication lag. clients are told apart by the `sub` of their token and
+    the write times live in sticky_backend, a cache.LRUBackend or, so that a
+    write on one worker pins the client on all of them, a
+    cache.SharedBackend. with no healthy replica reads fall back to the
+    primary.
+
+    the replicas are registered as flask-sqlalchemy binds replica_0..n, so
+    their engines get the same pool settings as the primary
+'''
+
+
+class ReplicaRouter:
+    def __init__(self, db, app, urls, sticky_backend, sticky_seconds=5, health_interval=10):
+        self.db = db
+        self.app = app
+        self.sticky = sticky_backend
+        self.sticky_seconds = sticky_seconds
+        self.health_interval = health_interval
+        self.replicas = [Replica(f'replica_{i}') for i in range(len(urls))]
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._hooked = set()
+
+        binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        app.config['SQLALCHEMY_BINDS'] = dict(
+            binds, **{replica.key: url for replica, url in zip(self.replicas, urls)})
+
+    def engine(self, replica):
+        engine = self.db.get_engine(self.app, bind=replica.key)
+        if engine not in self._hooked:
+            self._hooked.add(engine)
+
+            @event.listens_for(engine, 'handle_error')
+            def mark_down_on_disconnect(context):
+                if context.is_disconnect or context.connection is None:
+                    self.mark_down(replica)
+        return engine
+
+    def mark_down(self, replica):
+        replica.healthy = False
+        replica.retry_at = time.monotonic() + self.health_interval
+
+    def _probe(self, replica):
+        try:
+            with self.engine(replica).connect() as connection:
+                connection.exec_driver_sql('SELECT 1')
+        except Exception:
+            self.mark_down(replica)
+        else:
+            replica.healthy = True
+
+    def _candidates(self):
+        now = time.monotonic()
+        for replica in self.replicas:
+            if replica.healthy is None or (not replica.healthy and replica.retry_at <= now):
+                # one request probes, the others keep using the primary
+                replica.retry_at = now + self.health_interval
+                self._probe(replica)
+        return [replica for replica in self.replicas if replica.healthy]
+
+    def acquire(self):
+        '''the least loaded healthy replica, None when there is none'''
+        candidates = self._candidates()
+        if not candidates:
+            return None
+        with self._lock:
+            offset = next(self._next)
+            ordered = candidates[offset % len(candidates):] + candidates[:offset % len(candidates)]
+            replica = min(ordered, key=lambda replica: replica.in_flight)
+            replica.in_flight += 1
+        return replica
+
+    def release(self, replica):
+        with self._lock:
+            replica.in_flight -= 1
+
+    def _client(self):
+        # set by requires_auth
+        payload = getattr(_request_ctx_stack.top, 'current_user', None)
+        return payload.get('sub') if payload else None
+
+    def wrote(self):
+        '''called after a commit in a request, pins its client on the primary'''
+        client = self._client()
+        if client is not None and self.sticky_seconds > 0:
+            self.sticky.set(f'wrote:{client}', True, ttl=self.sticky_seconds)
+
+    def read_bind(self):
+        '''the replica engine the current request reads from, or None to use
+        the primary'''
+        if not has_request_context() or request.method not in READ_METHODS:
+            return None
+        if PINNED in request.environ:
+            replica = request.environ[PINNED]
+            return self.engine(replica) if replica is not None and replica.healthy else None
+        client = self._client()
+        if client is not None and self.sticky.get(f'wrote:{client}'):
+            replica = None
+        else:
+            replica = self.acquire()
+        request.environ[PINNED] = replica
+        return self.engine(replica) if replica is not None else None
+
+    def teardown(self, exception=None):
+        replica = request.environ.pop(PINNED, None)
+        if replica is not None:
+            self.release(replica)
+
+
+'''
+RoutingSession
+    flask-sqlalchemy session asking the app's ReplicaRouter (if any) where
+    read only statements go. a commit in a request that is not a read pins
+    its client on the primary for the router's sticky_seconds
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        router = self.app.extensions.get('replicas')
+        if router is not None and not self._flushing and not getattr(clause, 'is_dml', False):
+            engine = router.read_bind()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _pin_writer(session):
+    if has_request_context() and request.method not in READ_METHODS:
+        router = current_app.extensions.get('replicas')
+        if router is not None:
+            router.wrote()
+
+
+def init_replicas(db, app, sticky_backend):
+    '''sets up read replica routing for the urls in DATABASE_REPLICA_URLS,
+    a no-op without replicas'''
+    urls = app.config.get('DATABASE_REPLICA_URLS') or []
+    if not urls:
+        return None
+    router = app.extensions['replicas'] = ReplicaRouter(
+        db, app, urls, sticky_backend,
+        sticky_seconds=app.config.get('REPLICA_STICKY_SECONDS', 5),
+        health_interval=app.config.get('REPLICA_HEALTH_INTERVAL', 10))
+    app.teardown_request(router.teardown)
+    return router
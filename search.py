@@ -0,0 +1,196 @@
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+
+from flask import abort
+from sqlalchemy import func, literal, or_, select
+from sqlalchemy.exc import OperationalError
+
+from models import CollectionVersion, Movie, Actor
+
+
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+MAX_QUERY_LENGTH = 100
+# pg_trgm's default word_similarity_threshold, the `<%` operator matches above it
+SIMILARITY_THRESHOLD = 0.6
+# sqlstate of a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+_WORD = re.compile(r'\w+')
+
+
+'''
+SearchTarget
+    a searchable collection: the text column matched against q and the
+    permission a caller needs to see its results
+'''
+
+SearchTarget = namedtuple('SearchTarget', 'name table column permission')
+
+SEARCH_TARGETS = (
+    SearchTarget('movies', Movie.__table__, Movie.__table__.c.title, 'get:movies'),
+    SearchTarget('actors', Actor.__table__, Actor.__table__.c.name, 'get:actors'),
+)
+
+
+def search_args(args):
+    '''(q, limit) of a search query string, aborts with 400 when invalid'''
+    q = args.get('q', '').strip()
+    if not q or len(q) > MAX_QUERY_LENGTH:
+        abort(400)
+    try:
+        limit = int(args.get('limit', SEARCH_LIMIT))
+    except ValueError:
+        abort(400)
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        abort(400)
+    return q, limit
+
+
+def trigrams(text):
+    '''the trigrams pg_trgm extracts from text: lower cased words padded
+    with two spaces in front and one behind'''
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+'''
+TrigramIndex
+    in-process inverted index from trigram to the ids of the rows whose
+    text contains it, the local stand-in for a pg_trgm GIN index.
+    a row matches when q is a substring of its text (score 1) or when the
+    share of q's trigrams found in the text reaches SIMILARITY_THRESHOLD,
+    which approximates word_similarity(q, text)
+'''
+
+
+class TrigramIndex:
+    def __init__(self):
+        self.version = None
+        self._texts = {}
+        self._postings = {}
+
+    def build(self, rows, version):
+        texts = {}
+        postings = {}
+        for row_id, text in rows:
+            if text is None:
+                continue
+            texts[row_id] = text.lower()
+            for gram in trigrams(text):
+                postings.setdefault(gram, []).append(row_id)
+        # swapped in together, readers see either the old or the new index
+        self._texts, self._postings, self.version = texts, postings, version
+
+    def search(self, q, limit):
+        '''[(id, score)] best first, ties by id'''
+        texts, postings = self._texts, self._postings
+        grams = trigrams(q)
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            shared.update(postings.get(gram, ()))
+
+        needle = q.lower()
+        hits = []
+        for row_id, count in shared.items():
+            score = 1.0 if needle in texts[row_id] else count / len(grams)
+            if score >= SIMILARITY_THRESHOLD:
+                hits.append((-score, row_id))
+        hits.sort()
+        return [(row_id, -score) for score, row_id in hits[:limit]]
+
+
+'''
+Searcher(budget_ms)
+    ranked search over SEARCH_TARGETS within a latency budget of budget_ms
+    for the whole request.
+
+    on postgres every target is a single query served by the pg_trgm GIN
+    index of its column (see the search_trigram_indexes migration), ranked by
+    word_similarity. each query runs with statement_timeout set to what is
+    left of the budget; a target that runs out of budget returns no rows and
+    the result is flagged as timed out instead of failing the request.
+
+    other dialects (sqlite in tests) use a TrigramIndex per target, rebuilt
+    from the table whenever the target's CollectionVersion has moved on
+'''
+
+
+class Searcher:
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def search(self, session, targets, q, limit):
+        '''({target name: [row tuple + (score,)]}, timed_out)'''
+        deadline = time.monotonic() + self.budget_ms / 1000
+        postgres = session.connection().dialect.name == 'postgresql'
+        results = {}
+        timed_out = False
+        for target in targets:
+            remaining_ms = int((deadline - time.monotonic()) * 1000)
+            if remaining_ms <= 0:
+                results[target.name] = []
+                timed_out = True
+                continue
+            if postgres:
+                rows = self._search_postgres(session, target, q, limit, remaining_ms)
+            else:
+                rows = self._search_local(session, target, q, limit)
+            timed_out = timed_out or rows is None
+            results[target.name] = rows or []
+        return results, timed_out
+
+    def _search_postgres(self, session, target, q, limit, timeout_ms):
+        column = target.column
+        score = func.word_similarity(q, column)
+        statement = (
+            select(*target.table.c, score.label('score'))
+            .where(or_(column.ilike(f'%{_escape_like(q)}%', escape='\\'),
+                       literal(q).op('<%')(column)))
+            .order_by(score.desc(), target.table.c.id)
+            .limit(limit))
+        # local to the transaction, so it never outlives the request
+        session.execute(select(func.set_config('statement_timeout', str(timeout_ms), True)))
+        try:
+            return session.execute(statement).all()
+        except OperationalError as e:
+            if getattr(e.orig, 'pgcode', None) != QUERY_CANCELED:
+                raise
+            session.rollback()
+            return None
+
+    def _index(self, session, target):
+        version, _ = CollectionVersion.current(target.name)
+        index = self._indexes.get(target.name)
+        if index is not None and index.version == version:
+            return index
+        with self._lock:
+            index = self._indexes.get(target.name)
+            if index is None or index.version != version:
+                index = TrigramIndex()
+                index.build(session.execute(
+                    select(target.table.c.id, target.column)).all(), version)
+                self._indexes[target.name] = index
+        return index
+
+    def _search_local(self, session, target, q, limit):
+        hits = self._index(session, target).search(q, limit)
+        if not hits:
+            return []
+        table = target.table
+        rows = {row.id: row for row in session.execute(
+            select(table).where(table.c.id.in_([row_id for row_id, _ in hits])))}
+        return [tuple(rows[row_id]) + (score,) for row_id, score in hits if row_id in rows]
@@ -0,0 +1,110 @@
+import json
+from datetime import datetime, timezone
+
+from flask import Response
+from sqlalchemy.sql.sqltypes import Date, DateTime
+
+from metrics import phase
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+
+_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+'''
+http_date(value)
+    formats a date/datetime the way jsonify does ('Mon, 22 Jan 1990
+    00:00:00 GMT'), naive values are taken as UTC. written out by hand
+    because it runs once per row on every list response
+'''
+
+
+def http_date(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        hour, minute, second = value.hour, value.minute, value.second
+    else:
+        hour = minute = second = 0
+    return (f'{_WEEKDAYS[value.weekday()]}, {value.day:02d} '
+            f'{_MONTHS[value.month - 1]} {value.year:04d} '
+            f'{hour:02d}:{minute:02d}:{second:02d} GMT')
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj)
+
+
+JSON_BACKENDS = {'json': _stdlib_dumps}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = _orjson_dumps
+
+
+'''
+Serializer
+    builds list responses straight from column tuples (no ORM objects,
+    no Model.format()) and encodes them with a configurable JSON backend.
+
+    app.config['JSON_BACKEND'] picks the encoder: 'orjson', 'json', 'auto'
+    (orjson when installed, the default) or any callable taking the body
+    and returning str or bytes.
+    date and datetime columns are converted explicitly with http_date, so
+    the output matches what jsonify produced for Model.format()
+'''
+
+
+class Serializer:
+    def __init__(self, dumps):
+        self.dumps = dumps
+        self._converters = {}
+
+    @classmethod
+    def from_config(cls, config):
+        backend = config.get('JSON_BACKEND', 'auto')
+        if callable(backend):
+            return cls(backend)
+        if backend == 'auto':
+            backend = 'orjson' if 'orjson' in JSON_BACKENDS else 'json'
+        if backend not in JSON_BACKENDS:
+            raise ValueError(f'unknown JSON_BACKEND {backend!r}')
+        return cls(JSON_BACKENDS[backend])
+
+    def _table_converters(self, table):
+        converters = self._converters.get(table)
+        if converters is None:
+            keys = tuple(column.name for column in table.columns)
+            dates = tuple(
+                index for index, column in enumerate(table.columns)
+                if isinstance(column.type, (Date, DateTime))
+            )
+            converters = self._converters[table] = keys, dates
+        return converters
+
+    def rows(self, table, rows):
+        '''column tuples of `table`, in column order, to json ready dicts'''
+        keys, dates = self._table_converters(table)
+        items = []
+        with phase('serialize'):
+            for row in rows:
+                item = dict(zip(keys, row))
+                for index in dates:
+                    value = row[index]
+                    if value is not None:
+                        item[keys[index]] = http_date(value)
+                items.append(item)
+        return items
+
+    def response(self, body, status=200):
+        with phase('serialize'):
+            data = self.dumps(body)
+        return Response(data, status=status, mimetype='application/json')
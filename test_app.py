@@ -1,10 +1,46 @@
+import base64
+import hashlib
+import io
+import logging
 import os
+import sys
 import unittest
+from unittest import mock
 import json
+import queue
+import threading
+import time
+import tempfile
+from datetime import datetime
+from flask import jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy import exc as sqlalchemy_exc
+from sqlalchemy.engine import make_url
+from werkzeug.datastructures import MultiDict
+
+# the offline test cases sign their own tokens, so any domain will do
+os.environ.setdefault('AUTH0_DOMAIN', 'capstone.test')
+os.environ.setdefault('API_AUDIENCE', 'capstone')
 
 from app import create_app
-from models import setup_db, Movie, Actor
+from models import setup_db, CollectionVersion, Movie, Actor, db, movie_actors
+from auth import auth
+from serializers import JSON_BACKENDS, Serializer
+from cache import FakeSharedClient, LRUBackend, ResponseCache, SharedBackend
+from search import SEARCH_TARGETS, Searcher
+from replicas import ReplicaRouter
+from log import NonBlockingQueueHandler, RepeatFilter, pipeline
+from idempotency import IdempotencyStore, idempotency_from_config
+from cli import data
+from warmup import warm_up
+from writebehind import FakeIdAllocator, Spool
+from ratelimit import (FakeRateLimitClient, RateLimiter, SharedBucketStore, parse_rate,
+                       parse_rates)
+from pool import TimedQueuePool, pool_config_from_env, pool_options, pool_stats
+from auth.auth import (AuthError, JWKSCache, LocalJWKS, PermissionRule, RemoteJWKS,
+                       TestIssuer, TokenCache, check_permissions, key_provider,
+                       verify_decode_jwt)
 
 # JWT Tokens for each role
 ASSISTANT_TOKEN = os.getenv('ASSISTANT_TOKEN')
@@ -120,15 +156,15 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted'], movie_id)
 
-    def test_422_delete_movies_fail(self):
+    def test_404_delete_movies_fail(self):
         movie_id = 99999999
 
         res = self.client().delete(f'/movies/{movie_id}', headers={"Authorization": f"Bearer {self.executive_producer}"})
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable')
+        self.assertEqual(data['message'], 'Resource Not Found')
 
     # PATCH /movies
     def test_patch_movies(self):
@@ -151,7 +187,7 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['movie'])
 
     
-    def test_422_patch_movies_fail(self):
+    def test_404_patch_movies_fail(self):
         movie_id = 9999999
 
         modified_test_movie = {
@@ -162,9 +198,9 @@ class CapstoneTestCase(unittest.TestCase):
         res = self.client().patch(f'/movies/{movie_id}', headers={"Authorization": f"Bearer {self.casting_director}"}, json=modified_test_movie)
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable')
+        self.assertEqual(data['message'], 'Resource Not Found')
 
 
     # GET /actors endpoint
@@ -216,15 +252,15 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted'], actor_id)
 
-    def test_422_delete_actor(self):
+    def test_404_delete_actor(self):
         actor_id = 999999
 
         res = self.client().delete(f'/actors/{actor_id}', headers={"Authorization": f"Bearer {self.executive_producer}"})
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertEqual(data['message'], 'Unprocessable')
+        self.assertEqual(data['message'], 'Resource Not Found')
 
     # PATCH /actors
     def test_patch_actors(self):
@@ -247,7 +283,7 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['actor'])
 
-    def test_422_patch_actors_fail(self):
+    def test_404_patch_actors_fail(self):
         actor_id = 99999
 
         modified_test_actor = {
@@ -259,9 +295,1443 @@ class CapstoneTestCase(unittest.TestCase):
         res = self.client().patch(f'/actors/{actor_id}', headers={"Authorization": f"Bearer {self.executive_producer}"}, json=modified_test_actor)
         data = json.loads(res.data)
 
-        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
-        self.assertTrue(data['message'], 'Resource Not Found')
+        self.assertEqual(data['message'], 'Resource Not Found')
+
+
+class OfflineApiTestCase(unittest.TestCase):
+    """Runs the app on in-memory sqlite with locally signed tokens"""
+
+    issuer = None
+    app_config = {}
+
+    @classmethod
+    def setUpClass(cls):
+        if OfflineApiTestCase.issuer is None:
+            OfflineApiTestCase.issuer = auth.TestIssuer(kid='offline')
+
+    def setUp(self):
+        auth.jwks_cache.use_provider(self.issuer)
+        auth.token_cache.clear()
+
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', **self.app_config})
+        self.client = self.app.test_client
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def auth_header(self, *permissions, sub='auth0|offline'):
+        return self.issuer.auth_header(*permissions, sub=sub, ttl=600)
+
+
+class PaginationTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            Movie(title=f'movie_{i}', release_date=datetime(1990, 1, 22)).insert()
+            Actor(name=f'actor_{i}', age=20 + i, gender='F').insert()
+
+    def walk(self, path, key):
+        headers = self.auth_header('get:movies', 'get:actors')
+        ids, cursor = [], None
+        while True:
+            url = f'{path}?limit=2' + (f'&cursor={cursor}' if cursor else '')
+            data = json.loads(self.client().get(url, headers=headers).data)
+            ids.extend(row['id'] for row in data[key])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return ids
+
+    def test_movies_pages(self):
+        self.assertEqual(self.walk('/movies', 'movies'), [1, 2, 3, 4, 5])
+
+    def test_actors_pages(self):
+        self.assertEqual(self.walk('/actors', 'actors'), [1, 2, 3, 4, 5])
+
+    def test_400_invalid_cursor(self):
+        res = self.client().get('/movies?cursor=not-a-cursor',
+                                headers=self.auth_header('get:movies'))
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_full_list_compatibility(self):
+        self.app.config['PAGINATE_LISTS'] = False
+        res = self.client().get('/movies?limit=2',
+                                headers=self.auth_header('get:movies'))
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data['movies']), 5)
+        self.assertNotIn('next_cursor', data)
+
+
+class ExportTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            Movie(title=f'movie_{i}', release_date=datetime(1990, 1, 22)).insert()
+            Actor(name=f'actor_{i}', age=20 + i, gender='M').insert()
+
+    def export(self, path, permission):
+        res = self.client().get(path, headers=self.auth_header(permission))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in res.data.decode().splitlines()]
+
+    def test_export_movies(self):
+        movies = self.export('/movies/export', 'get:movies')
+
+        self.assertEqual([movie['id'] for movie in movies], [1, 2, 3])
+        self.assertEqual(movies[0]['release_date'], 'Mon, 22 Jan 1990 00:00:00 GMT')
+
+    def test_export_actors(self):
+        actors = self.export('/actors/export', 'get:actors')
+
+        self.assertEqual(actors[2], {'id': 3, 'name': 'actor_2', 'age': 22, 'gender': 'M'})
+
+    def test_403_export_movies(self):
+        res = self.client().get('/movies/export', headers=self.auth_header('get:actors'))
+
+        self.assertEqual(res.status_code, 403)
+
+
+class BulkTestCase(OfflineApiTestCase):
+
+    def test_bulk_create_movies(self):
+        res = self.client().post('/movies/bulk', headers=self.auth_header('post:movies'), json=[
+            {'title': 'bulk_1', 'release_date': '1/22/1990'},
+            {'title': 'bulk_2', 'release_date': '1990-02-22'},
+        ])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['id'] for r in data['results']], [1, 2])
+        self.assertEqual(Movie.query.get(2).release_date, datetime(1990, 2, 22))
+
+    def test_bulk_create_is_one_insert(self):
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        res = self.client().post('/actors/bulk', headers=self.auth_header('post:actors'), json=[
+            {'name': f'bulk_{i}', 'age': 30, 'gender': 'F'} for i in range(100)])
+        data = json.loads(res.data)
+
+        self.assertEqual([r['id'] for r in data['results']], list(range(1, 101)))
+        self.assertEqual(sum(statement.startswith('INSERT INTO actors') for statement in statements), 1)
+        self.assertEqual(Actor.query.get(100).name, 'bulk_99')
+
+    def test_422_bulk_create_rejects_whole_batch(self):
+        res = self.client().post('/actors/bulk', headers=self.auth_header('post:actors'), json=[
+            {'name': 'bulk_1', 'age': 30, 'gender': 'F'},
+            {'name': 'bulk_2', 'age': 'old', 'gender': 'F'},
+        ])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], [{'index': 1, 'error': 'invalid age'}])
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_bulk_update_and_delete_actors(self):
+        for i in range(2):
+            Actor(name=f'actor_{i}', age=20, gender='M').insert()
+        headers = self.auth_header('patch:actors', 'delete:actors')
+
+        res = self.client().patch('/actors/bulk', headers=headers, json=[
+            {'id': 1, 'age': 40}, {'id': 99, 'name': 'missing'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(data['results'], [
+            {'id': 1, 'status': 'updated'}, {'id': 99, 'status': 'not_found'}])
+        self.assertEqual(Actor.query.get(1).age, 40)
+
+        res = self.client().delete('/actors/bulk', headers=headers, json=[2, 99])
+        data = json.loads(res.data)
+
+        self.assertEqual(data['results'], [
+            {'id': 2, 'status': 'deleted'}, {'id': 99, 'status': 'not_found'}])
+        self.assertEqual(Actor.query.count(), 1)
+
+
+class SingleStatementWriteTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Movie(title='movie', release_date=datetime(1990, 1, 22)).insert()
+        Actor(name='actor', age=21, gender='M').insert()
+
+    def test_patch_movie(self):
+        res = self.client().patch('/movies/1', headers=self.auth_header('patch:movies'),
+                                  json={'title': 'movie_patched'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], {
+            'id': 1, 'title': 'movie_patched', 'release_date': 'Mon, 22 Jan 1990 00:00:00 GMT'})
+
+    def test_patch_actor(self):
+        res = self.client().patch('/actors/1', headers=self.auth_header('patch:actors'),
+                                  json={'name': 'actor_patched', 'age': 22, 'gender': 'F'})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['actor'], {'id': 1, 'name': 'actor_patched', 'age': 22, 'gender': 'F'})
+
+    def test_delete_movie_and_actor(self):
+        headers = self.auth_header('delete:movies', 'delete:actors')
+
+        self.assertEqual(json.loads(self.client().delete('/movies/1', headers=headers).data)['deleted'], 1)
+        self.assertEqual(json.loads(self.client().delete('/actors/1', headers=headers).data)['deleted'], 1)
+        self.assertEqual(Movie.query.count() + Actor.query.count(), 0)
+
+    def test_missing_rows(self):
+        headers = self.auth_header('delete:movies', 'patch:actors')
+
+        res = self.client().delete('/movies/99', headers=headers)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().patch('/actors/99', headers=headers,
+                                  json={'name': 'actor', 'age': 22, 'gender': 'F'})
+        self.assertEqual(res.status_code, 404)
+
+
+class SerializerTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Movie(title='movie', release_date=datetime(2100, 1, 21, 13, 5)).insert()
+        Movie(title='no_date', release_date=None).insert()
+
+    def test_matches_format(self):
+        for backend in JSON_BACKENDS:
+            with self.subTest(backend=backend):
+                serializer = Serializer.from_config({'JSON_BACKEND': backend})
+                rows = db.session.execute(db.select(Movie.__table__).order_by(Movie.id)).all()
+
+                lean = json.loads(serializer.dumps(serializer.rows(Movie.__table__, rows)))
+                formatted = jsonify([movie.format() for movie in Movie.query.order_by(Movie.id)]).get_json()
+                self.assertEqual(lean, formatted)
+
+    def test_custom_backend(self):
+        serializer = Serializer.from_config({'JSON_BACKEND': lambda body: 'custom'})
+
+        self.assertEqual(serializer.response({}).get_data(as_text=True), 'custom')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            Serializer.from_config({'JSON_BACKEND': 'yaml'})
+
+
+class ConditionalGetTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Movie(title='movie', release_date=datetime(1990, 1, 22)).insert()
+        self.headers = self.auth_header('get:movies', 'patch:movies')
+
+    def test_304_if_none_match(self):
+        res = self.client().get('/movies', headers=self.headers)
+        etag = res.headers['ETag']
+
+        res = self.client().get('/movies', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_write_changes_etag(self):
+        etag = self.client().get('/movies', headers=self.headers).headers['ETag']
+        self.client().patch('/movies/1', headers=self.headers, json={'title': 'patched'})
+
+        res = self.client().get('/movies', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_version_is_summed_over_slots(self):
+        version, _ = CollectionVersion.current('movies')
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        with mock.patch('models.random.randrange', side_effect=[3, 3, 5]):
+            for _ in range(3):
+                CollectionVersion.bump('movies')
+                db.session.commit()
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertEqual(CollectionVersion.current('movies')[0], version + 3)
+        slots = db.session.query(CollectionVersion.slot).filter_by(name='movies')
+        self.assertIn(3, [slot for slot, in slots])
+        # one upsert per bump, a first write cannot race another into an IntegrityError
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(all('ON CONFLICT' in statement for statement in statements))
+
+    def test_304_if_modified_since(self):
+        last_modified = self.client().get('/movies', headers=self.headers).headers['Last-Modified']
+
+        res = self.client().get('/movies', headers=dict(self.headers, **{'If-Modified-Since': last_modified}))
+        self.assertEqual(res.status_code, 304)
+
+
+class ResponseCacheTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Movie(title='movie', release_date=datetime(1990, 1, 22)).insert()
+        Actor(name='actor', age=21, gender='M').insert()
+        self.cache = self.app.extensions['response_cache']
+        self.headers = self.auth_header('get:movies', 'get:actors', 'patch:movies')
+
+    def get_titles(self):
+        data = json.loads(self.client().get('/movies', headers=self.headers).data)
+        return [movie['title'] for movie in data['movies']]
+
+    def test_hit_after_miss(self):
+        self.get_titles()
+        self.get_titles()
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_write_invalidates_collection(self):
+        self.client().get('/actors', headers=self.headers)
+        self.get_titles()
+        self.client().patch('/movies/1', headers=self.headers, json={'title': 'patched'})
+
+        self.assertEqual(self.get_titles(), ['patched'])
+        self.client().get('/actors', headers=self.headers)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_conditional_hit(self):
+        etag = self.client().get('/movies', headers=self.headers).headers['ETag']
+
+        res = self.client().get('/movies', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_shared_backend(self):
+        client = FakeSharedClient()
+        worker_a, worker_b = ResponseCache(SharedBackend(client)), ResponseCache(SharedBackend(client))
+        key = worker_a.key(['movies'], '/movies', MultiDict(), ['get:movies'])
+        worker_a.backend.set(key, (b'[]', 'application/json', []))
+
+        self.assertIsNotNone(worker_b.get(key))
+        worker_a.invalidate(['movies'])
+        self.assertNotEqual(worker_b.key(['movies'], '/movies', MultiDict(), ['get:movies']), key)
+
+    def test_lru_eviction(self):
+        backend = LRUBackend(maxsize=2)
+        for key in 'abc':
+            backend.set(key, key)
+        backend.incr('gen:movies')
+
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.counter('gen:movies'), 1)
+        self.assertEqual(backend.stats(), {'size': 2, 'evictions': 1})
+
+
+class CastingTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            Movie(title=f'movie_{i}', release_date=datetime(1990, 1, 22)).insert()
+            Actor(name=f'actor_{i}', age=20 + i, gender='F').insert()
+        self.headers = self.auth_header('get:movies', 'get:actors', 'patch:movies')
+        for movie_id in (1, 2, 3):
+            self.client().post(f'/movies/{movie_id}/actors', headers=self.headers,
+                               json={'actor_ids': sorted({1, movie_id})})
+
+    def test_movie_actors(self):
+        data = json.loads(self.client().get('/movies/2/actors', headers=self.headers).data)
+
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 2])
+
+    def test_actor_movies(self):
+        data = json.loads(self.client().get('/actors/1/movies', headers=self.headers).data)
+
+        self.assertEqual([movie['id'] for movie in data['movies']], [1, 2, 3])
+
+    def test_404_unknown_actor(self):
+        res = self.client().post('/movies/1/actors', headers=self.headers, json={'actor_ids': [99]})
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_remove_cast(self):
+        self.client().delete('/movies/2/actors/2', headers=self.headers)
+        data = json.loads(self.client().get('/movies/2/actors', headers=self.headers).data)
+
+        self.assertEqual([actor['id'] for actor in data['actors']], [1])
+
+    def test_embed_uses_one_query_per_page(self):
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        res = self.client().get('/movies?embed=actors', headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual([len(movie['actors']) for movie in data['movies']], [1, 2, 2])
+        self.assertEqual(sum('movie_actors' in statement for statement in statements), 1)
+
+    def test_actor_write_invalidates_embedded_cast(self):
+        self.client().get('/movies?embed=actors', headers=self.headers)
+        Actor.query.get(1).name = 'renamed'
+        Actor.query.get(1).update()
+
+        data = json.loads(self.client().get('/movies?embed=actors', headers=self.headers).data)
+        self.assertEqual(data['movies'][0]['actors'][0]['name'], 'renamed')
+
+
+class FilterSortTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        titles = ['Alien', 'Aliens', 'Blade Runner', None, 'x_1', 'xa1', None, 'Alien']
+        for i, title in enumerate(titles):
+            release_date = datetime(1980 + i, 1, 1) if i % 3 else None
+            Movie(title=title, release_date=release_date).insert()
+        for i in range(6):
+            Actor(name=f'actor_{i}', age=20 + i % 3, gender='MF'[i % 2]).insert()
+        self.headers = self.auth_header('get:movies', 'get:actors')
+
+    def get(self, path):
+        res = self.client().get(path, headers=self.headers)
+        return res.status_code, json.loads(res.data)
+
+    def walk(self, path, key, limit=2):
+        rows, cursor = [], None
+        while True:
+            url = f'{path}&limit={limit}' + (f'&cursor={cursor}' if cursor else '')
+            status, data = self.get(url)
+            self.assertEqual(status, 200)
+            rows.extend(data[key])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return rows
+
+    def test_title_prefix(self):
+        _, data = self.get('/movies?title=Alien')
+
+        self.assertEqual([movie['id'] for movie in data['movies']], [1, 2, 8])
+
+    def test_prefix_escapes_wildcards(self):
+        _, data = self.get('/movies?title=x_')
+
+        self.assertEqual([movie['id'] for movie in data['movies']], [5])
+
+    def test_release_date_range(self):
+        _, data = self.get('/movies?release_date_from=1981-01-01&release_date_to=1984-12-31')
+
+        self.assertEqual([movie['id'] for movie in data['movies']], [2, 3, 5])
+
+    def test_actor_filters(self):
+        _, data = self.get('/actors?age_min=21&gender=F&sort=-age')
+
+        self.assertEqual([(actor['age'], actor['id']) for actor in data['actors']], [(22, 6), (21, 2)])
+
+    def test_sorted_pages_with_nulls(self):
+        movies = Movie.query.all()
+        for sort, column in (('title', 'title'), ('release_date', 'release_date')):
+            present = sorted((m for m in movies if getattr(m, column) is not None),
+                             key=lambda m: (getattr(m, column), m.id))
+            missing = [m for m in movies if getattr(m, column) is None]
+            expected = [m.id for m in present + missing]
+            with self.subTest(sort=sort):
+                rows = self.walk(f'/movies?sort={sort}', 'movies')
+                self.assertEqual([row['id'] for row in rows], expected)
+                rows = self.walk(f'/movies?sort=-{sort}', 'movies')
+                self.assertEqual([row['id'] for row in rows], expected[::-1])
+
+    def test_400_unknown_filter_or_sort(self):
+        self.assertEqual(self.get('/movies?director=x')[0], 400)
+        self.assertEqual(self.get('/movies?sort=budget')[0], 400)
+        self.assertEqual(self.get('/actors?age_min=old')[0], 400)
+
+    def test_400_cursor_from_other_sort(self):
+        _, data = self.get('/movies?sort=title&limit=2')
+
+        self.assertEqual(self.get(f'/movies?sort=release_date&cursor={data["next_cursor"]}')[0], 400)
+
+    def test_400_crafted_cursor(self):
+        crafted = {
+            '/movies': ['[1]', '{"id":true}', '{"id":"1"}', '{"id":1,"s":["id"]}'],
+            '/movies?sort=release_date': ['{"id":1,"s":"release_date","v":"yesterday"}',
+                                          '{"id":1,"s":"release_date","v":{}}',
+                                          '{"id":1,"s":"release_date","v":5}'],
+            '/movies?sort=title': ['{"id":1,"s":"title","v":5}'],
+            '/actors?sort=age': ['{"id":1,"s":"age","v":"old"}', '{"id":1,"s":"age","v":false}'],
+        }
+        for path, documents in crafted.items():
+            for document in documents:
+                cursor = base64.urlsafe_b64encode(document.encode()).decode().rstrip('=')
+                separator = '&' if '?' in path else '?'
+                with self.subTest(path=path, cursor=document):
+                    status, data = self.get(f'{path}{separator}cursor={cursor}')
+                    self.assertEqual(status, 400)
+                    self.assertFalse(data['success'])
+
+
+class SearchTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for title in ['Jurassic Park', 'The Lost World: Jurassic Park', 'Parking Lot', 'Alien']:
+            Movie(title=title, release_date=datetime(1993, 6, 11)).insert()
+        Actor(name='Jeff Goldblum', age=70, gender='M').insert()
+
+    def search(self, path, *permissions):
+        res = self.client().get(path, headers=self.auth_header(*permissions))
+        return res.status_code, json.loads(res.data)
+
+    def test_ranked_fuzzy_matches(self):
+        status, data = self.search('/search?q=jurasic', 'get:movies', 'get:actors')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1, 2])
+        self.assertEqual(data['actors'], [])
+        self.assertFalse(data['timed_out'])
+
+    def test_substring_ranks_first(self):
+        _, data = self.search('/search?q=park', 'get:movies')
+
+        self.assertEqual([movie['id'] for movie in data['movies']], [1, 2, 3])
+        self.assertEqual(data['movies'][0]['score'], 1.0)
+        self.assertNotIn('actors', data)
+
+    def test_index_follows_writes(self):
+        self.search('/search?q=goldblum', 'get:actors')
+        Actor(name='Laura Dern', age=57, gender='F').insert()
+
+        _, data = self.search('/search?q=dern', 'get:actors')
+
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Laura Dern'])
+
+    def test_exhausted_budget_times_out(self):
+        searcher = Searcher(budget_ms=0)
+
+        results, timed_out = searcher.search(db.session, SEARCH_TARGETS, 'park', 10)
+
+        self.assertTrue(timed_out)
+        self.assertEqual(results, {'movies': [], 'actors': []})
+
+    def test_400_without_query(self):
+        self.assertEqual(self.search('/search?q=', 'get:movies')[0], 400)
+        self.assertEqual(self.search('/search?q=park&limit=0', 'get:movies')[0], 400)
+
+    def test_403_without_read_permission(self):
+        self.assertEqual(self.search('/search?q=park', 'post:movies')[0], 403)
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pool_config_from_env({})
+
+    def test_options_for_postgres(self):
+        self.config['DB_STATEMENT_TIMEOUT_MS'] = 2000
+        options = pool_options(self.config, make_url('postgresql://db/capstone'),
+                               {'connect_args': {'options': '-c search_path=app'}})
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual((options['pool_size'], options['max_overflow']), (5, 10))
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args']['options'],
+                         '-c search_path=app -c statement_timeout=2000')
+        self.assertEqual(options['executemany_mode'], 'values_plus_batch')
+
+    def test_sqlite_keeps_its_pool(self):
+        options = pool_options(self.config, make_url('sqlite://'), {})
+
+        self.assertEqual(options, {'pool_pre_ping': True})
+
+    def test_env_parsing(self):
+        config = pool_config_from_env({'DB_POOL_SIZE': '20', 'DB_POOL_PRE_PING': 'false'})
+
+        self.assertEqual(config['DB_POOL_SIZE'], 20)
+        self.assertFalse(config['DB_POOL_PRE_PING'])
+
+    def test_checkout_metrics_and_timeout(self):
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.05)
+        held = engine.connect()
+
+        self.assertEqual(pool_stats(engine)['saturation'], 1.0)
+        with self.assertRaises(sqlalchemy_exc.TimeoutError):
+            engine.connect()
+        held.close()
+
+        stats = pool_stats(engine)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checkout_seconds']['count'], 2)
+        self.assertGreaterEqual(stats['checkout_seconds']['max'], 0.05)
+
+    def test_metrics_survive_recreate(self):
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool)
+        engine.connect().close()
+
+        engine.pool = engine.pool.recreate()
+
+        self.assertEqual(pool_stats(engine)['checkout_seconds']['count'], 1)
+
+
+class RequestMetricsTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Movie(title='Timed', release_date=datetime(2020, 1, 1)).insert()
+
+    def test_server_timing_header(self):
+        res = self.client().get('/movies', headers=self.auth_header('get:movies'))
+
+        timing = dict(part.split(';', 1) for part in res.headers['Server-Timing'].split(', '))
+        self.assertEqual(sorted(timing), ['auth', 'db', 'serialize', 'total'])
+        self.assertIn('desc="2 queries"', timing['db'])
+
+    def test_prometheus_histograms(self):
+        self.client().get('/movies', headers=self.auth_header('get:movies'))
+        self.client().get('/movies/1/actors')
+
+        res = self.client().get('/metrics', headers=self.auth_header('read:metrics'))
+        text = res.get_data(as_text=True)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('# TYPE capstone_request_duration_seconds histogram', text)
+        self.assertIn('capstone_request_duration_seconds_count{route="/movies",method="GET"} 1', text)
+        self.assertIn('capstone_request_queries_sum{route="/movies"} 2', text)
+        self.assertIn('capstone_responses_total{route="/movies/<int:movie_id>/actors",'
+                      'method="GET",status="401"} 1', text)
+        self.assertIn('capstone_tokens_hits', text)
+
+        summary = self.client().get('/metrics?format=json',
+                                    headers=self.auth_header('read:metrics')).get_json()
+        self.assertEqual(summary['requests']['GET /movies']['count'], 1)
+        self.assertIn('jwks', summary)
+
+    def test_metrics_need_a_permission(self):
+        self.assertEqual(self.client().get('/metrics').status_code, 401)
+        res = self.client().get('/metrics', headers=self.auth_header('get:movies'))
+        self.assertEqual(res.status_code, 403)
+        res = self.client().get('/writes/status', headers=self.auth_header('get:movies'))
+        self.assertEqual(res.status_code, 403)
+
+
+class RequestMetricsOffTestCase(OfflineApiTestCase):
+    app_config = {'REQUEST_METRICS': False}
+
+    def test_no_timing(self):
+        res = self.client().get('/movies', headers=self.auth_header('get:movies'))
+
+        self.assertNotIn('Server-Timing', res.headers)
+        summary = self.client().get('/metrics?format=json',
+                                    headers=self.auth_header('read:metrics')).get_json()
+        self.assertNotIn('requests', summary)
+
+
+class LoggingTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.output = io.StringIO()
+        pipeline.output.setStream(self.output)
+        self.addCleanup(pipeline.output.setStream, sys.stdout)
+
+    def records(self):
+        pipeline.stop()
+        return [json.loads(line) for line in self.output.getvalue().splitlines()]
+
+    def test_request_id(self):
+        given = self.client().get('/movies', headers={'X-Request-ID': 'req-1'})
+        generated = self.client().get('/movies', headers={'X-Request-ID': 'not valid!'})
+
+        self.assertEqual(given.headers['X-Request-ID'], 'req-1')
+        self.assertEqual(len(generated.headers['X-Request-ID']), 32)
+
+    def test_database_error_is_422_and_logged(self):
+        res = self.client().post('/movies', json={'title': 'Logged', 'release_date': '1/22/1990'},
+                                 headers={**self.auth_header('post:movies'), 'X-Request-ID': 'req-2'})
+
+        self.assertEqual(res.status_code, 422)
+        record, = [record for record in self.records() if record['level'] == 'WARNING']
+        self.assertEqual(record['request_id'], 'req-2')
+        self.assertEqual(record['path'], '/movies')
+        self.assertEqual(record['status'], 422)
+        self.assertIn('StatementError', record['exception'])
+
+    def test_repeated_records_are_sampled(self):
+        sampler = RepeatFilter(window=0.05, burst=2)
+        record = logging.makeLogRecord({'msg': 'database error: %s', 'levelno': logging.ERROR})
+
+        self.assertEqual([sampler.filter(record) for _ in range(5)], [True, True, False, False, False])
+        time.sleep(0.06)
+        self.assertTrue(sampler.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_full_queue_drops(self):
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        for _ in range(3):
+            handler.handle(logging.makeLogRecord({'msg': 'record'}))
+
+        self.assertEqual(handler.dropped, 2)
+
+
+class RateLimitTestCase(OfflineApiTestCase):
+    app_config = {'RATE_LIMIT_DEFAULT': '2/m', 'RATE_LIMITS': {'get:actors': 'off'},
+                  'MAX_IN_FLIGHT': 4}
+
+    def test_limited_per_subject_and_permission(self):
+        statuses = [self.client().get('/movies', headers=self.auth_header('get:movies')).status_code
+                    for _ in range(3)]
+        limited = self.client().get('/movies', headers=self.auth_header('get:movies'))
+
+        self.assertNotIn(429, statuses[:2])
+        self.assertEqual(statuses[2], 429)
+        self.assertEqual(limited.get_json()['message'], 'Too Many Requests')
+        self.assertGreaterEqual(int(limited.headers['Retry-After']), 1)
+        other = self.client().get('/movies', headers=self.auth_header('get:movies', sub='auth0|other'))
+        self.assertNotEqual(other.status_code, 429)
+        for _ in range(3):
+            res = self.client().get('/actors', headers=self.auth_header('get:actors'))
+            self.assertNotEqual(res.status_code, 429)
+
+    def test_shared_store(self):
+        store = SharedBucketStore(FakeRateLimitClient())
+        workers = [RateLimiter(parse_rate('3/m'), store=store) for _ in range(2)]
+        rule = auth.PermissionRule.compile('post:movies')
+
+        workers[0].check('auth0|a', rule)
+        workers[1].check('auth0|a', rule)
+        workers[0].check('auth0|a', rule)
+        with self.assertRaises(Exception) as raised:
+            workers[1].check('auth0|a', rule)
+        self.assertEqual(raised.exception.code, 429)
+        self.assertEqual(raised.exception.retry_after, 20)
+
+    def test_fake_client_runs_only_the_bucket_script(self):
+        with self.assertRaises(ValueError) as raised:
+            FakeRateLimitClient().register_script("return redis.call('GET', KEYS[1])")
+        self.assertIn("redis.call('GET'", str(raised.exception))
+
+    def test_parse_rates(self):
+        self.assertEqual(parse_rates('post:movies=5/s, get:actors=off'),
+                         {'post:movies': (5, 5), 'get:actors': None})
+
+    def test_off_by_default(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('RATE_LIMIT_DEFAULT', None)
+            app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+
+        self.assertIsNone(app.extensions['rate_limiter'])
+        with self.assertRaises(ValueError) as raised:
+            parse_rates('post:movies=5/s,get:actors')
+        self.assertIn("'get:actors'", str(raised.exception))
+
+    def test_sheds_load_before_auth(self):
+        shedder = self.app.extensions['load_shedder']
+        shedder.in_flight = shedder.max_in_flight
+
+        res = self.client().get('/movies')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(shedder.stats()['shed'], 1)
+
+        shedder.in_flight = 0
+        res = self.client().get('/movies')
+        self.assertEqual(shedder.in_flight, 1)
+        # a server closes the body once it is sent
+        res.close()
+        self.assertEqual(shedder.in_flight, 0)
+
+    def test_invalid_rate(self):
+        self.assertEqual(parse_rate('120/m'), (2.0, 120))
+        with self.assertRaises(ValueError):
+            parse_rate('5 per second')
+
+
+class IdempotencyTestCase(OfflineApiTestCase):
+    actor = json.dumps({'name': 'Ana', 'age': 30, 'gender': 'F'})
+
+    def post_actor(self, key, body=None):
+        headers = {**self.auth_header('post:actors'), 'Idempotency-Key': key}
+        return self.client().post('/actors', data=body or self.actor,
+                                  content_type='application/json', headers=headers)
+
+    def pending_key(self, key, body=None):
+        # the key as claimed by a request in flight on another worker
+        fingerprint = hashlib.sha256((body or self.actor).encode()).hexdigest()
+        store = self.app.extensions['idempotency']
+        name = f'idem:auth0|offline:POST:/actors:{key}'
+        store.backend.add(name, ('pending', fingerprint), 30)
+        return store, name, fingerprint
+
+    def test_replays_without_running_again(self):
+        first = self.post_actor('k-1')
+        second = self.post_actor('k-1')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(Actor.query.count(), 1)
+        self.assertEqual(self.post_actor('k-2').get_json()['actor']['id'], 2)
+
+    def test_replays_validation_errors(self):
+        body = json.dumps({'name': 'Ana'})
+        self.assertEqual(self.post_actor('k-1', body).status_code, 422)
+        res = self.post_actor('k-1', body)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+
+    def test_key_reused_for_another_body(self):
+        self.post_actor('k-1')
+        res = self.post_actor('k-1', json.dumps({'name': 'Bo', 'age': 40, 'gender': 'M'}))
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_keys_are_per_subject(self):
+        self.post_actor('k-1')
+        headers = {**self.auth_header('post:actors', sub='auth0|other'), 'Idempotency-Key': 'k-1'}
+        res = self.client().post('/actors', data=self.actor, content_type='application/json',
+                                 headers=headers)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+        self.assertEqual(Actor.query.count(), 2)
+
+    def test_waits_for_request_in_flight(self):
+        store, name, fingerprint = self.pending_key('k-1')
+        body = json.dumps({'success': True, 'actor': {'id': 7}}).encode()
+        done = ('done', fingerprint, 200, [('Content-Type', 'application/json')], body)
+        finish = threading.Timer(0.2, store.backend.set, (name, done, 60))
+        finish.start()
+
+        res = self.post_actor('k-1')
+        finish.join()
+        self.assertEqual(res.get_json()['actor']['id'], 7)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Actor.query.count(), 0)
+        self.assertEqual(store.stats()['waited'], 1)
+
+    def test_conflict_after_wait_timeout(self):
+        store, name, _ = self.pending_key('k-1')
+        store.wait_timeout = 0.1
+
+        res = self.post_actor('k-1')
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        # the claim is released, as when the first request fails
+        store.backend.delete(name)
+        self.assertEqual(self.post_actor('k-1').status_code, 200)
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_invalid_key(self):
+        self.assertEqual(self.post_actor('x' * 256).status_code, 400)
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_pending_seconds(self):
+        store = idempotency_from_config({'IDEMPOTENCY_PENDING_SECONDS': 120})
+        self.assertEqual(store.pending_ttl, 120)
+        self.assertEqual(create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+                         .extensions['idempotency'].pending_ttl, 30)
+
+    def test_pending_claims_are_not_evicted(self):
+        store = idempotency_from_config({'IDEMPOTENCY_STORE_SIZE': 2})
+        store.backend.add('idem:running', ('pending', 'f'), 30)
+        for i in range(3):
+            store.backend.set(f'idem:{i}', ('done', 'f', 200, [], b''), 60)
+
+        self.assertEqual(store.backend.get('idem:running'), ('pending', 'f'))
+        self.assertIsNone(store.backend.get('idem:0'))
+        self.assertFalse(store.backend.add('idem:running', ('pending', 'g'), 30))
+        # once done, it ages out like any other entry
+        store.backend.set('idem:running', ('done', 'f', 200, [], b''), 60)
+        for i in range(3, 5):
+            store.backend.set(f'idem:{i}', ('done', 'f', 200, [], b''), 60)
+        self.assertIsNone(store.backend.get('idem:running'))
+
+    def test_shared_backend(self):
+        client = FakeSharedClient()
+        workers = [IdempotencyStore(SharedBackend(client)) for _ in range(2)]
+        self.assertTrue(workers[0].backend.add('idem:k', ('pending', 'f'), 30))
+        self.assertFalse(workers[1].backend.add('idem:k', ('pending', 'f'), 30))
+        workers[0].backend.delete('idem:k')
+        self.assertTrue(workers[1].backend.add('idem:k', ('pending', 'f'), 30))
+
+
+class WriteBehindTestCase(OfflineApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        # a file, the writer thread uses a connection of its own
+        self.spool_dir = tempfile.mkdtemp(dir=self.tmp.name)
+        self.app_config = {
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.spool_dir}/capstone.db',
+            'WRITE_BEHIND': True,
+            'WRITE_BEHIND_SPOOL_DIR': f'{self.spool_dir}/spool',
+            'WRITE_BEHIND_FSYNC': False,
+            # sqlite has no sequences to reserve ids from
+            'WRITE_BEHIND_IDS': FakeIdAllocator(),
+            'RESPONSE_CACHE': 'off',
+        }
+        super().setUp()
+        self.writer = self.app.extensions['write_behind']
+
+    def tearDown(self):
+        self.writer.stop()
+        super().tearDown()
+
+    def post(self, path, item, permission):
+        return self.client().post(path, json=item, headers=self.auth_header(permission))
+
+    def test_queued_creates_are_written_in_batches(self):
+        responses = [self.post('/actors', {'name': f'actor_{i}', 'age': 30, 'gender': 'F'},
+                               'post:actors') for i in range(3)]
+        movie = self.post('/movies', {'title': 'Queued', 'release_date': '1/22/1990'},
+                          'post:movies')
+
+        self.assertEqual([res.status_code for res in responses], [202] * 3)
+        self.assertTrue(all(res.get_json()['queued'] for res in responses))
+        self.assertEqual([res.get_json()['actor']['id'] for res in responses], [1, 2, 3])
+        self.assertEqual(movie.status_code, 202)
+        self.assertTrue(self.writer.drain(5))
+
+        db.session.remove()
+        self.assertEqual([actor.name for actor in Actor.query.order_by(Actor.id)],
+                         ['actor_0', 'actor_1', 'actor_2'])
+        self.assertEqual(Movie.query.one().release_date, datetime(1990, 1, 22))
+        status = self.client().get('/writes/status',
+                                   headers=self.auth_header('read:metrics')).get_json()
+        self.assertTrue(status['enabled'])
+        self.assertEqual(status['queue_depth'], 0)
+        self.assertEqual(status['committed'], 4)
+        self.assertEqual(status['flush_seconds']['count'], 4)
+
+    def test_validated_before_queueing(self):
+        res = self.post('/actors', {'name': 'Ana', 'age': 'thirty', 'gender': 'F'}, 'post:actors')
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.writer.stats()['accepted'], 0)
+
+    def test_full_queue(self):
+        self.writer.max_queue = 0
+        res = self.post('/actors', {'name': 'Ana', 'age': 30, 'gender': 'F'}, 'post:actors')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+    def test_recovers_spool_after_crash(self):
+        Actor(name='written', age=40, gender='M').insert()
+        crashed = Spool(f'{self.spool_dir}/spool', fsync=False)
+        crashed.append('actors', {'id': 1, 'name': 'written', 'age': 40, 'gender': 'M'})
+        crashed.append('movies', {'id': 5, 'title': 'Spooled',
+                                  'release_date': datetime(2001, 2, 3)})
+        # the process dies: its segment is closed without being removed
+        crashed.segment.file.close()
+
+        self.writer.recover()
+        db.session.remove()
+        self.assertEqual(Actor.query.count(), 1)
+        self.assertEqual(Movie.query.get(5).release_date, datetime(2001, 2, 3))
+        self.assertEqual(self.writer.stats()['recovered'], 1)
+        self.assertEqual(os.listdir(f'{self.spool_dir}/spool'), [])
+
+    def test_recovery_skips_segments_deleted_meanwhile(self):
+        crashed = Spool(f'{self.spool_dir}/spool', fsync=False)
+        crashed.append('movies', {'id': 5, 'title': 'Spooled',
+                                  'release_date': datetime(2001, 2, 3)})
+        crashed.segment.file.close()
+        # another worker recovered and deleted the first segment after listdir
+        listed = ['0-recovered.spool'] + os.listdir(f'{self.spool_dir}/spool')
+
+        with mock.patch('writebehind.os.listdir', return_value=listed):
+            self.writer.recover()
+        db.session.remove()
+        self.assertEqual(Movie.query.get(5).title, 'Spooled')
+        self.assertIsNone(self.writer.stats()['last_error'])
+
+    def test_refused_without_sequences(self):
+        with self.assertRaises(RuntimeError):
+            create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'WRITE_BEHIND': True})
+
+    def test_off_by_default(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        self.assertIsNone(app.extensions['write_behind'])
+        res = app.test_client().get('/writes/status', headers=self.auth_header('read:metrics'))
+        self.assertFalse(res.get_json()['enabled'])
+
+
+class WarmUpTestCase(OfflineApiTestCase):
+
+    def test_connects_and_fetches_keys_before_traffic(self):
+        refreshes = auth.jwks_cache.stats()['refreshes']
+        timings = warm_up(self.app, connections=2)
+        self.assertEqual(set(timings), {'primary', 'jwks'})
+        self.assertEqual(auth.jwks_cache.stats()['keys'], 1)
+
+        res = self.client().get('/actors', headers=self.auth_header('get:actors'))
+        # fetched by the warm up, not by the request
+        self.assertEqual(auth.jwks_cache.stats()['refreshes'], refreshes + 1)
+        self.assertNotEqual(res.status_code, 401)
+
+    def test_fresh_keys_are_not_fetched_again(self):
+        # the keys inherited from the preloaded master, fetched longer ago
+        # than the refetch interval but still within their ttl
+        auth.jwks_cache.refresh()
+        refreshes = auth.jwks_cache.stats()['refreshes']
+        interval = auth.jwks_cache.min_refresh_interval
+        auth.jwks_cache.min_refresh_interval = 0
+        self.addCleanup(setattr, auth.jwks_cache, 'min_refresh_interval', interval)
+
+        warm_up(self.app, connections=0)
+        self.assertEqual(auth.jwks_cache.stats()['refreshes'], refreshes)
+
+    def test_without_database(self):
+        self.assertEqual(set(warm_up(self.app, connections=0)), {'jwks'})
+
+
+class DataCommandsTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.runner = self.app.test_cli_runner()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def test_seed(self):
+        result = self.runner.invoke(data, ['seed', '--movies', '30', '--actors', '10',
+                                           '--cast', '2', '--batch-size', '7',
+                                           '--random-seed', '1'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Movie.query.count(), 30)
+        self.assertEqual(Actor.query.count(), 10)
+        self.assertEqual(db.session.query(movie_actors).count(), 60)
+        self.assertIn('movies: loaded 30 rows', result.output)
+        self.assertEqual(CollectionVersion.current('movies')[0], 1)
+
+    def test_import_csv_and_ndjson(self):
+        movies = self.write('movies.csv', 'title,release_date\nOne,1/22/1990\nTwo,2001-02-03\n')
+        actors = self.write('cast.ndjson', '{"id": 7, "name": "Ana", "age": 30, "gender": "F"}\n')
+        result = self.runner.invoke(data, ['import', movies])
+        self.assertEqual(result.exit_code, 0, result.output)
+        result = self.runner.invoke(data, ['import', '--table', 'actors', actors])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertEqual([(movie.title, movie.release_date) for movie in Movie.query.order_by(Movie.id)],
+                         [('One', datetime(1990, 1, 22)), ('Two', datetime(2001, 2, 3))])
+        self.assertEqual(Actor.query.get(7).name, 'Ana')
+
+    def test_export_round_trip(self):
+        Movie(title='Exported', release_date=datetime(1999, 12, 31)).insert()
+        exported = self.client().get('/movies/export', headers=self.auth_header('get:movies'))
+        path = self.write('movies.ndjson', exported.get_data(as_text=True))
+        Movie.query.delete()
+        db.session.commit()
+
+        result = self.runner.invoke(data, ['import', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        movie = Movie.query.one()
+        self.assertEqual((movie.id, movie.release_date), (1, datetime(1999, 12, 31)))
+
+    def test_invalid_rows(self):
+        path = self.write('actors.csv', 'name,age,gender\nAna,30,F\nBo,old,M\nCy,40,M\n')
+        result = self.runner.invoke(data, ['import', path])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('line 3: invalid age', result.output)
+
+        result = self.runner.invoke(data, ['import', '--skip-invalid', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('skipped 1 invalid rows (lines 3)', result.output)
+        self.assertEqual(Actor.query.count(), 2)
+
+        unknown = self.write('actors.ndjson', '{"name": "Ana", "age": 30, "gender": "F", "x": 1}\n')
+        result = self.runner.invoke(data, ['import', unknown])
+        self.assertIn('unknown columns x', result.output)
+
+
+class ReplicaTestCase(OfflineApiTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.app_config = {
+            'RESPONSE_CACHE': 'off',
+            'DATABASE_REPLICA_URLS': [f'sqlite:///{cls.tmp.name}/replica.db'],
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        super().setUp()
+        self.replica = db.get_engine(self.app, bind='replica_0')
+        db.metadata.create_all(self.replica)
+        with self.replica.begin() as connection:
+            connection.execute(Movie.__table__.insert(),
+                               {'title': 'On the replica', 'release_date': datetime(2000, 1, 1)})
+
+    def tearDown(self):
+        db.metadata.drop_all(self.replica)
+        super().tearDown()
+
+    def titles(self, sub):
+        res = self.client().get('/movies', headers=self.auth_header('get:movies', sub=sub))
+        return [movie['title'] for movie in json.loads(res.data).get('movies', [])]
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.titles('auth0|reader'), ['On the replica'])
+
+    def test_writer_reads_the_primary(self):
+        res = self.client().post('/movies/bulk', json=[{'title': 'On the primary', 'release_date': '2021-01-01'}],
+                                 headers=self.auth_header('post:movies', sub='auth0|writer'))
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.titles('auth0|writer'), ['On the primary'])
+        self.assertEqual(self.titles('auth0|reader'), ['On the replica'])
+
+    def test_sticky_window_expires(self):
+        router = self.app.extensions['replicas']
+        router.sticky_seconds = 0.05
+        self.client().post('/movies/bulk', json=[{'title': 'On the primary', 'release_date': '2021-01-01'}],
+                           headers=self.auth_header('post:movies', sub='auth0|writer'))
+        time.sleep(0.1)
+
+        self.assertEqual(self.titles('auth0|writer'), ['On the replica'])
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        router = self.app.extensions['replicas']
+        router.mark_down(router.replicas[0])
+        Movie(title='On the primary', release_date=datetime(2021, 1, 1)).insert()
+
+        self.assertEqual(self.titles('auth0|reader'), ['On the primary'])
+
+    def test_least_loaded_replica(self):
+        router = ReplicaRouter(db, self.app, ['sqlite://', 'sqlite://'], LRUBackend())
+        for replica in router.replicas:
+            replica.healthy = True
+        first = router.acquire()
+
+        self.assertIsNot(router.acquire(), first)
+        router.release(first)
+        self.assertIs(router.acquire(), first)
+
+
+class AsgiTestCase(OfflineApiTestCase):
+
+    def setUp(self):
+        auth.jwks_cache.use_provider(self.issuer)
+        auth.jwks_cache.refresh()
+        auth.token_cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.asgi_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.tmp.name}/asgi.db',
+            'SERVING_MODE': 'asgi',
+        })
+        flask_app = self.asgi_app.state.flask_app
+        with flask_app.app_context():
+            db.create_all()
+            Movie(title='Async', release_date=datetime(2020, 1, 1)).insert()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_list_is_served_async(self):
+        from starlette.testclient import TestClient
+
+        with TestClient(self.asgi_app) as client:
+            res = client.get('/movies', headers=self.auth_header('get:movies'))
+            not_modified = client.get('/movies', headers={
+                **self.auth_header('get:movies'), 'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in res.json()['movies']], ['Async'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_errors_match_flask(self):
+        from starlette.testclient import TestClient
+
+        with TestClient(self.asgi_app) as client:
+            unauthorized = client.get('/movies')
+            forbidden = client.get('/movies', headers=self.auth_header('get:actors'))
+            flask_route = client.post('/movies', json={})
+
+        self.assertEqual(unauthorized.json(), {'success': False, 'error': 401, 'message': 'Unathorized'})
+        self.assertEqual(forbidden.status_code, 403)
+        self.assertEqual(flask_route.status_code, 401)
+
+    def test_native_routes_run_the_flask_hooks(self):
+        from starlette.testclient import TestClient
+        import asgi
+
+        flask_app = self.asgi_app.state.flask_app
+        headers = {**self.auth_header('get:movies'), 'X-Request-ID': 'req-1'}
+        with mock.patch.object(asgi, 'run_in_threadpool', wraps=asgi.run_in_threadpool) as threadpool, \
+                TestClient(self.asgi_app) as client:
+            first = client.get('/movies', headers=headers)
+            cached = client.get('/movies', headers=headers)
+
+        self.assertEqual(cached.json(), first.json())
+        self.assertEqual(flask_app.extensions['response_cache'].stats()['hits'], 1)
+        self.assertEqual(first.headers['X-Request-ID'], 'req-1')
+        self.assertIn('db;dur=', first.headers['Server-Timing'])
+        stats = flask_app.extensions['request_metrics'].stats()
+        self.assertEqual(stats['GET /movies']['count'], 2)
+        # one verification, off the event loop, the second request hits the token cache
+        threadpool.assert_called_once_with(auth.verify_token, mock.ANY, 'offline')
+
+    def test_native_routes_are_shed(self):
+        from starlette.testclient import TestClient
+
+        self.asgi_app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.tmp.name}/asgi.db',
+            'SERVING_MODE': 'asgi', 'MAX_IN_FLIGHT': 1,
+        })
+        shedder = self.asgi_app.state.flask_app.extensions['load_shedder']
+        with TestClient(self.asgi_app) as client:
+            shedder.in_flight = 1
+            res = client.get('/movies', headers=self.auth_header('get:movies'))
+            shedder.in_flight = 0
+            admitted = client.get('/movies', headers=self.auth_header('get:movies'))
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(admitted.status_code, 200)
+        self.assertEqual(shedder.stats(), {'in_flight': 0, 'max_in_flight': 1, 'shed': 1})
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fetches = 0
+        self.jwks = {'keys': [{'kid': 'key-1', 'kty': 'RSA'}]}
+        self.fail = False
+
+        def fetch():
+            self.fetches += 1
+            if self.fail:
+                raise OSError('auth0 unreachable')
+            return self.jwks
+
+        self.cache = JWKSCache('https://example.test/jwks.json', ttl=600,
+                               min_refresh_interval=30, fetch=fetch)
+
+    def test_keys_are_fetched_once(self):
+        for _ in range(100):
+            self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+
+        stats = self.cache.stats()
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(stats['hits'], 99)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['refreshes'], 1)
+
+    def test_unknown_kid_refreshes_once(self):
+        self.cache.get_key('key-1')
+        self.jwks = {'keys': [{'kid': 'key-2', 'kty': 'RSA'}]}
+        self.cache.min_refresh_interval = 0
+
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        self.cache.min_refresh_interval = 30
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key('key-3'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_needs_refresh_follows_rate_limit(self):
+        self.assertTrue(self.cache.needs_refresh('key-1'))
+        self.cache.get_key('key-1')
+
+        self.assertFalse(self.cache.needs_refresh('key-1'))
+        self.assertFalse(self.cache.needs_refresh('key-2'))
+
+    def test_load_keeps_keys_on_failed_fetch(self):
+        self.cache.load({'keys': [{'kid': 'key-1', 'kty': 'RSA'}]})
+        self.cache.load(None)
+
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.cache.stats()['refresh_failures'], 1)
+        self.assertEqual(self.fetches, 0)
+
+    def test_load_failure_without_keys_is_503(self):
+        with self.assertRaises(AuthError) as raised:
+            self.cache.load(None)
+
+        self.assertEqual(raised.exception.status_code, 503)
+
+    def test_serves_last_known_good_keys(self):
+        self.cache.get_key('key-1')
+        self.cache.ttl = 0
+        self.cache.min_refresh_interval = 0
+        self.fail = True
+
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.cache.stats()['refresh_failures'], 1)
+
+    def test_unavailable_without_keys(self):
+        self.fail = True
+
+        with self.assertRaises(AuthError) as ctx:
+            self.cache.get_key('key-1')
+        self.assertEqual(ctx.exception.status_code, 503)
+
+
+class KeyProviderTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.issuer = TestIssuer(kid='provider')
+
+    def test_sources(self):
+        self.assertIsInstance(key_provider('https://example.test/jwks.json'), RemoteJWKS)
+        self.assertIsInstance(key_provider('/etc/capstone/jwks.json'), LocalJWKS)
+        self.assertIs(key_provider(self.issuer), self.issuer)
+        self.assertIsNone(JWKSCache(self.issuer).url)
+
+    def test_local_file_is_reread(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as jwks_file:
+            json.dump(self.issuer.fetch(), jwks_file)
+        self.addCleanup(os.unlink, jwks_file.name)
+        cache = JWKSCache(jwks_file.name, min_refresh_interval=0)
+        self.assertEqual(cache.get_key('provider')['kid'], 'provider')
+
+        rotated = TestIssuer(kid='rotated', private_pem=self.issuer.private_pem)
+        with open(jwks_file.name, 'w') as rotated_file:
+            json.dump(rotated.fetch(), rotated_file)
+        self.assertEqual(cache.get_key('rotated')['kid'], 'rotated')
+
+    def test_issuer_tokens_verify(self):
+        auth.jwks_cache.use_provider(LocalJWKS(self.issuer.fetch()))
+
+        payload = verify_decode_jwt(self.issuer.mint('get:movies', sub='auth0|minted'))
+        self.assertEqual(payload['sub'], 'auth0|minted')
+        self.assertEqual(payload['permissions'], ['get:movies'])
+
+        with self.assertRaises(AuthError) as expired:
+            verify_decode_jwt(self.issuer.mint('get:movies', ttl=-10))
+        self.assertEqual(expired.exception.error['code'], 'token_expired')
+
+    def test_header_parsed_once_per_miss(self):
+        auth.jwks_cache.use_provider(self.issuer)
+        token = self.issuer.mint('get:movies')
+
+        with mock.patch.object(auth.jwt, 'get_unverified_header',
+                               wraps=auth.jwt.get_unverified_header) as parse:
+            auth.get_verified_token(token)
+            auth.get_verified_token(token)
+        self.assertEqual(parse.call_count, 1)
+
+    def test_switching_provider_drops_keys_and_tokens(self):
+        other = TestIssuer(kid='other', key_size=1024)
+        auth.jwks_cache.use_provider(self.issuer)
+        token = self.issuer.mint('get:movies')
+        auth.get_verified_token(token)
+        self.assertIsNotNone(auth.token_cache.get(token))
+
+        auth.jwks_cache.use_provider(other)
+        self.assertIsNone(auth.token_cache.get(token))
+        with self.assertRaises(AuthError):
+            verify_decode_jwt(token)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.payload = {'sub': 'auth0|1', 'exp': time.time() + 60}
+
+    def test_hit_after_put(self):
+        self.assertIsNone(self.cache.get('token-a'))
+        self.cache.put('token-a', 'key-1', self.payload)
+
+        self.assertEqual(self.cache.get('token-a'), (self.payload, None))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_expired_tokens_are_dropped(self):
+        self.cache.put('token-a', 'key-1', dict(self.payload, exp=time.time() - 1))
+        self.cache.put('token-b', 'key-1', {'sub': 'auth0|no-exp'})
+
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertIsNone(self.cache.get('token-b'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('token-a', 'key-1', self.payload)
+        self.cache.put('token-b', 'key-1', self.payload)
+        self.cache.get('token-a')
+        self.cache.put('token-c', 'key-1', self.payload)
+
+        self.assertIsNotNone(self.cache.get('token-a'))
+        self.assertIsNone(self.cache.get('token-b'))
+
+    def test_rotated_keys_are_evicted(self):
+        jwks = {'keys': [{'kid': 'key-1'}, {'kid': 'key-2'}]}
+        # keys stale at once, so each refresh refetches
+        jwks_cache = JWKSCache('https://example.test/jwks.json', ttl=0,
+                               min_refresh_interval=0, fetch=lambda: jwks)
+        jwks_cache.on_keys_removed(self.cache.evict_kids)
+        jwks_cache.refresh()
+        self.cache.put('token-a', 'key-1', self.payload)
+        self.cache.put('token-b', 'key-2', self.payload)
+
+        jwks = {'keys': [{'kid': 'key-2'}]}
+        jwks_cache.refresh()
+
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertIsNotNone(self.cache.get('token-b'))
+
+
+class PermissionRuleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = {'permissions': ['get:movies', 'get:actors']}
+
+    def test_single_permission(self):
+        self.assertTrue(check_permissions('get:movies', self.payload))
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('post:movies', self.payload)
+        self.assertEqual(ctx.exception.status_code, 403)
+
+    def test_all_of(self):
+        granted = frozenset(self.payload['permissions'])
+
+        self.assertTrue(PermissionRule.compile(
+            all_of=['get:movies', 'get:actors']).allows(granted))
+        self.assertFalse(PermissionRule.compile(
+            'get:movies', all_of=['post:movies']).allows(granted))
+
+    def test_any_of(self):
+        granted = frozenset(self.payload['permissions'])
+
+        self.assertTrue(PermissionRule.compile(
+            any_of=['post:movies', 'get:movies']).allows(granted))
+        self.assertFalse(PermissionRule.compile(
+            any_of=['post:movies', 'delete:movies']).allows(granted))
+
+    def test_empty_permission_is_denied(self):
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('', self.payload)
+        self.assertEqual(ctx.exception.status_code, 403)
+        self.assertFalse(PermissionRule.compile().allows(frozenset(self.payload['permissions'])))
+
+    def test_missing_permissions_claim(self):
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('get:movies', {})
+        self.assertEqual(ctx.exception.status_code, 400)
 
 
 # Make the tests conveniently executable
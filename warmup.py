@@ -0,0 +1,92 @@
+import time
+
+from sqlalchemy.orm import configure_mappers
+
+from auth.auth import AuthError, jwks_cache
+from log import log
+from models import db
+
+
+def flask_app_of(application):
+    '''the flask app behind what create_app returned (the ASGI app in
+    SERVING_MODE=asgi)'''
+    state = getattr(application, 'state', None)
+    return getattr(state, 'flask_app', application)
+
+
+def _timed(timings, name, step):
+    start = time.perf_counter()
+    try:
+        step()
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def _fetch_keys():
+    try:
+        jwks_cache.refresh()
+    except AuthError:
+        # the first authenticated request tries again
+        log.warning('could not fetch the JWKS during warm up')
+
+
+'''
+prepare(application)
+    work shared by every worker, done once in the gunicorn master before it
+    forks (preload_app): configures the ORM mappers and fetches the JWKS,
+    which the workers inherit. no database connection is opened here, a
+    socket shared by the workers would be used by all of them at once.
+    returns the milliseconds per step
+'''
+
+
+def prepare(application):
+    timings = {}
+    _timed(timings, 'mappers', configure_mappers)
+    _timed(timings, 'jwks', _fetch_keys)
+    log.info('app prepared', extra={'warmup_ms': timings})
+    return timings
+
+
+'''
+warm_up(application, connections=None)
+    run in each worker before it takes traffic: opens `connections` (the
+    pool size by default) connections to the primary and one to each
+    replica (none with connections=0), and fetches the JWKS unless the
+    keys inherited from the master are still fresh, so none of that lands
+    on the first requests.
+    a database that cannot be reached is logged, not raised: the worker
+    still starts and the pool connects on demand. returns the milliseconds
+    per step
+'''
+
+
+def warm_up(application, connections=None):
+    app = flask_app_of(application)
+    timings = {}
+    with app.app_context():
+        if connections is None:
+            connections = app.config.get('DB_POOL_SIZE', 5)
+        if connections:
+            _timed(timings, 'primary', lambda: _connect(db.get_engine(app), connections))
+            for bind in app.config.get('SQLALCHEMY_BINDS') or {}:
+                _timed(timings, bind, lambda: _connect(db.get_engine(app, bind=bind), 1))
+        _timed(timings, 'jwks', _fetch_keys)
+    log.info('worker warmed up', extra={'warmup_ms': timings})
+    return timings
+
+
+def _connect(engine, count):
+    opened = []
+    try:
+        # held at once, so the pool really opens `count` of them
+        for _ in range(count):
+            connection = engine.connect()
+            opened.append(connection)
+            connection.exec_driver_sql('SELECT 1')
+    except Exception as error:
+        log.warning('could not open database connections during warm up',
+                    exc_info=error, extra={'database': engine.url.render_as_string()})
+    finally:
+        for connection in opened:
+            connection.close()
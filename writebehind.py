@@ -0,0 +1,527 @@
+import atexit
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from functools import wraps
+
+from flask import abort, jsonify, request
+from sqlalchemy import insert, text
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import ServiceUnavailable
+
+from bulk import ACTOR_FIELDS, MOVIE_FIELDS, validate_batch
+from log import log
+from models import Actor, Movie, db, error_status
+from pool import Histogram
+
+
+FLUSH_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# the tables writes can be queued for: model and the fields of a create
+MODELS = {'movies': (Movie, MOVIE_FIELDS), 'actors': (Actor, ACTOR_FIELDS)}
+
+
+'''
+IdAllocator(block_size)
+    hands out primary keys before the row is written, so a queued create
+    can answer with its id. a block of ids is taken from the table's
+    postgres serial sequence in one statement, so other workers and inserts
+    that do not go through the queue never get one of them. there is no
+    such sequence on other databases (sqlite), init_write_behind refuses
+    them: ids continued from max(id) could be handed out twice, and the
+    second row would be dropped after its 202
+'''
+
+
+class IdAllocator:
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def _block(self, table):
+        with db.engine.connect() as connection:
+            return connection.execute(
+                text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                     "FROM generate_series(1, :n)"),
+                {'table': table.name, 'n': self.block_size}).scalars().all()
+
+    def next_id(self, table):
+        with self._lock:
+            free = self._free.get(table.name)
+            if not free:
+                free = self._free[table.name] = deque(self._block(table))
+            return free.popleft()
+
+
+'''
+FakeIdAllocator(start=1)
+    ids counted per table in this process, for tests of the queue on
+    sqlite. nothing else may insert into the tables meanwhile
+'''
+
+
+class FakeIdAllocator:
+    def __init__(self, start=1):
+        self._next = {}
+        self._start = start
+        self._lock = threading.Lock()
+
+    def next_id(self, table):
+        with self._lock:
+            row_id = self._next.get(table.name, self._start)
+            self._next[table.name] = row_id + 1
+            return row_id
+
+
+'''
+Segment(path)
+    one spool file, flock'ed for as long as it is open
+'''
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.entries = 0
+        self.pending = 0
+        self.written = 0
+        self.synced = 0
+        self.closed = False
+        self.sync_lock = threading.Lock()
+
+    def sync(self, upto):
+        with self.sync_lock:
+            if self.synced >= upto:
+                return
+            target = self.written
+            os.fsync(self.file.fileno())
+            self.synced = target
+
+    def remove(self):
+        os.unlink(self.path)
+        self.file.close()
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'cannot spool {type(value).__name__}')
+
+
+'''
+Spool(directory, segment_entries, fsync)
+    the durable side of the queue: every accepted row is appended as a
+    JSON line to a segment file and (with fsync) on disk before the 202 is
+    sent. concurrent appends share one fsync. a segment is deleted once
+    all its rows are committed, so after a crash the directory holds what
+    was accepted and possibly not written yet. segments are flock'ed while
+    their process has them open, recover() only takes unlocked ones, so
+    workers sharing the directory never replay each other's live queues
+'''
+
+
+class Spool:
+    def __init__(self, directory, segment_entries=10000, fsync=True):
+        self.directory = directory
+        self.segment_entries = segment_entries
+        self.fsync = fsync
+        self.segment = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        name = f'{os.getpid()}-{time.time_ns()}-{uuid.uuid4().hex[:8]}.spool'
+        return Segment(os.path.join(self.directory, name))
+
+    def append(self, table, row):
+        '''writes the row, returns its segment once it is durable'''
+        line = json.dumps({'table': table, 'row': row}, default=_encode).encode() + b'\n'
+        with self._lock:
+            segment = self.segment
+            if segment is None or segment.entries >= self.segment_entries:
+                if segment is not None:
+                    segment.closed = True
+                    if segment.pending == 0:
+                        segment.remove()
+                segment = self.segment = self._open_segment()
+            segment.file.write(line)
+            segment.file.flush()
+            segment.entries += 1
+            segment.pending += 1
+            segment.written += 1
+            position = segment.written
+        if self.fsync:
+            segment.sync(position)
+        return segment
+
+    def done(self, segments):
+        '''marks one row of each of `segments` committed'''
+        with self._lock:
+            for segment in segments:
+                segment.pending -= 1
+                if segment.pending == 0 and segment.closed:
+                    segment.remove()
+
+    def close(self):
+        '''closes the current segment, deleting it when nothing is pending'''
+        with self._lock:
+            segment, self.segment = self.segment, None
+            if segment is not None:
+                segment.closed = True
+                if segment.pending == 0:
+                    segment.remove()
+                else:
+                    segment.file.close()
+
+    def forget(self):
+        # after a fork: the open segments belong to the parent
+        self._lock = threading.Lock()
+        self.segment = None
+
+    def recover(self):
+        '''yields (path, [(table, row)]) of each segment left by a process
+        that is gone, the caller deletes the file once the rows are in.
+        segments another worker recovers meanwhile are skipped'''
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.spool'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                # recovered and deleted since listdir
+                continue
+            with file:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    # deleted by the worker that held the lock before us
+                    if os.stat(path).st_ino != os.fstat(file.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries = []
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line torn by the crash, it was never acknowledged
+                        continue
+                    entries.append((entry['table'], entry['row']))
+                yield path, entries
+
+
+def _decode(table, row):
+    _, fields = MODELS[table]
+    values = {name: fields[name](value) for name, value in row.items() if name != 'id'}
+    values['id'] = row['id']
+    return values
+
+
+'''
+WriteBehind(app, spool, batch_size, max_latency, max_queue, ids)
+    write-behind for creates: a queued POST is validated, given an id from
+    `ids` (an IdAllocator), spooled and answered 202 right away. a writer
+    thread inserts the queued rows in batches of up to batch_size, waiting
+    at most max_latency seconds after the oldest row, with one executemany
+    per table and a single commit per batch. the collection versions and caches
+    are updated on that commit, so readers see a row once it is written.
+
+    when the database is unreachable the batch is retried with backoff and
+    new rows keep queueing up to max_queue, past which creates get 503. a
+    batch the database refuses (a constraint) is retried row by row and
+    the refused rows are logged and dropped. rows accepted before a crash
+    are inserted from the spool when the app next starts
+'''
+
+
+class WriteBehind:
+    def __init__(self, app, spool, batch_size=500, max_latency=0.05, max_queue=10000,
+                 ids=None):
+        self.app = app
+        self.spool = spool
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_queue = max_queue
+        self.ids = ids if ids is not None else IdAllocator()
+        self.flush_seconds = Histogram(FLUSH_BUCKETS)
+        self.batch_sizes = Histogram(BATCH_BUCKETS)
+        self._reset()
+
+    def _reset(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self.depth = 0
+        self._stats = {'accepted': 0, 'committed': 0, 'dropped': 0, 'recovered': 0,
+                       'rejected': 0, 'retries': 0, 'batches': 0}
+        self.last_flush = None
+        self.last_error = None
+
+    def start(self):
+        '''starts the writer in this process, once. after a fork (gunicorn
+        --preload) the child starts its own'''
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self.spool.forget()
+                self._reset()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def submit(self, table, row):
+        '''queues a validated row, returns it with its new id'''
+        self.start()
+        with self._lock:
+            if self.depth >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise ServiceUnavailable('The write queue is full.')
+            self.depth += 1
+        try:
+            model, _ = MODELS[table]
+            row = dict(row, id=self.ids.next_id(model.__table__))
+            segment = self.spool.append(table, row)
+        except BaseException:
+            self._finished(1)
+            raise
+        self._queue.put((time.monotonic(), table, row, segment))
+        with self._lock:
+            self._stats['accepted'] += 1
+        return row
+
+    def _finished(self, count, committed=0, dropped=0):
+        with self._lock:
+            self.depth -= count
+            self._stats['committed'] += committed
+            self._stats['dropped'] += dropped
+            if self.depth == 0:
+                self._idle.notify_all()
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = batch[0][0] + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        with self.app.app_context():
+            self.recover()
+        while not (self._stopping and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                with self.app.app_context():
+                    self._write(batch)
+
+    def _insert(self, rows):
+        tables = {}
+        for table, row in rows:
+            tables.setdefault(table, []).append(row)
+        try:
+            for table, table_rows in tables.items():
+                model, _ = MODELS[table]
+                db.session.execute(insert(model.__table__), table_rows)
+                model.bump_version()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+    def _write(self, batch):
+        rows = [(table, row) for _, table, row, _ in batch]
+        delay = 0.1
+        while True:
+            try:
+                self._insert(rows)
+                dropped = 0
+                break
+            except Exception as error:
+                self.last_error = f'{type(error).__name__}: {error}'
+                if error_status(error) == 503 and not self._stopping:
+                    # unreachable or timed out: keep the batch and retry
+                    log.warning('write-behind batch failed, retrying in %.1fs', delay,
+                                exc_info=error, extra={'rows': len(rows)})
+                    with self._lock:
+                        self._stats['retries'] += 1
+                    time.sleep(delay)
+                    delay = min(delay * 2, 5)
+                    continue
+                if error_status(error) == 503:
+                    # shutting down: the rows stay in the spool
+                    self._finished(len(batch))
+                    return
+                dropped = self._write_each(rows)
+                break
+
+        now = time.monotonic()
+        for accepted_at, _, _, _ in batch:
+            self.flush_seconds.observe(now - accepted_at)
+        self.batch_sizes.observe(len(batch))
+        self.spool.done([segment for _, _, _, segment in batch])
+        self.last_flush = time.time()
+        with self._lock:
+            self._stats['batches'] += 1
+        self._finished(len(batch), committed=len(batch) - dropped, dropped=dropped)
+
+    def _write_each(self, rows):
+        dropped = 0
+        for table, row in rows:
+            try:
+                self._insert([(table, row)])
+            except Exception as error:
+                dropped += 1
+                log.error('write-behind dropped a row the database refused',
+                          exc_info=error, extra={'table': table, 'row': row})
+        return dropped
+
+    def recover(self):
+        '''inserts the rows of spool segments left by a crash, those not
+        already written, and deletes the segments'''
+        try:
+            recovered = self.spool.recover()
+            for path, entries in recovered:
+                rows = [(table, _decode(table, row)) for table, row in entries]
+                # the process may have died after committing some of them
+                written = set()
+                for table, (model, _) in MODELS.items():
+                    ids = [row['id'] for name, row in rows if name == table]
+                    for start in range(0, len(ids), self.batch_size):
+                        chunk = model.existing_ids(ids[start:start + self.batch_size])
+                        written.update((table, row_id) for row_id in chunk)
+                rows = [(table, row) for table, row in rows if (table, row['id']) not in written]
+                db.session.remove()
+                for start in range(0, len(rows), self.batch_size):
+                    self._insert(rows[start:start + self.batch_size])
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    # another worker recovered the same rows, skipped above
+                    pass
+                with self._lock:
+                    self._stats['recovered'] += len(rows)
+                log.info('write-behind recovered %d rows', len(rows), extra={'spool': path})
+        except Exception as error:
+            # the segments stay for the next start
+            self.last_error = f'{type(error).__name__}: {error}'
+            log.error('write-behind recovery failed', exc_info=error)
+
+    def drain(self, timeout=None):
+        '''waits until every queued row is written, returns whether it was'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self.depth:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stop(self, timeout=10):
+        '''writes what is queued (within timeout) and ends the writer, rows
+        left are written from the spool on the next start'''
+        thread = self._thread
+        if thread is None or self._pid != os.getpid():
+            return
+        self._stopping = True
+        thread.join(timeout)
+        if not thread.is_alive():
+            self.spool.close()
+
+    def queued(self, table, key):
+        '''decorator for the create view of `table`, goes below
+        @requires_auth (and @idempotent, so the 202 is replayed)'''
+        _, fields = MODELS[table]
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(payload, *args, **kwargs):
+                rows, errors = validate_batch([request.get_json(silent=True)], fields)
+                if errors:
+                    abort(422)
+                row = self.submit(table, rows[0])
+                return jsonify({'success': True, 'queued': True, key: row}), 202
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queue_depth'] = self.depth
+        flush = self.flush_seconds.snapshot()
+        stats['flush_seconds'] = flush
+        stats['flush_mean_seconds'] = flush['sum'] / flush['count'] if flush['count'] else 0.0
+        stats['flush_max_seconds'] = flush['max']
+        stats['batch_size'] = self.batch_sizes.snapshot()
+        stats['last_flush'] = self.last_flush
+        stats['last_error'] = self.last_error
+        return stats
+
+
+'''
+init_write_behind(app)
+    WRITE_BEHIND on queues POST /movies and POST /actors through a
+    WriteBehind spooling to WRITE_BEHIND_SPOOL_DIR, with
+    WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_MAX_LATENCY_MS,
+    WRITE_BEHIND_MAX_QUEUE and WRITE_BEHIND_ID_BLOCK. the writer starts
+    with the first request of each worker and is drained at exit.
+    app.extensions['write_behind'] is None when it is off.
+    ids come from the postgres sequences, on other databases it raises
+    RuntimeError unless WRITE_BEHIND_IDS (set through test_config) brings
+    an allocator
+'''
+
+
+def init_write_behind(app):
+    config = app.config
+    if not config['WRITE_BEHIND']:
+        app.extensions['write_behind'] = None
+        return None
+    ids = config.get('WRITE_BEHIND_IDS')
+    if ids is None:
+        if make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'postgresql':
+            raise RuntimeError('WRITE_BEHIND needs PostgreSQL: ids are reserved from the '
+                               'table sequences before the rows are written')
+        ids = IdAllocator(config['WRITE_BEHIND_ID_BLOCK'])
+    spool = Spool(config['WRITE_BEHIND_SPOOL_DIR'],
+                  fsync=config.get('WRITE_BEHIND_FSYNC', True))
+    writer = app.extensions['write_behind'] = WriteBehind(
+        app, spool,
+        batch_size=config['WRITE_BEHIND_BATCH_SIZE'],
+        max_latency=config['WRITE_BEHIND_MAX_LATENCY_MS'] / 1000,
+        max_queue=config['WRITE_BEHIND_MAX_QUEUE'],
+        ids=ids)
+
+    app.before_first_request(writer.start)
+    atexit.register(writer.stop)
+    return writer